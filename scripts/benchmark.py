@@ -0,0 +1,270 @@
+"""
+Benchmark swap on synthetic workloads of several sizes.
+
+Classification dumps are generated with swap.utils.synthetic and kept in
+--data-dir, so later runs time the same data. Every (scale, backend) runs
+in its own process and goes through parse, classify, scoring, retirement,
+save and load, report, the exports and offline EM, recording the wall
+time and the peak RSS after each step. Results are printed and appended
+to --output as JSON lines. With --baseline, steps that got slower or
+bigger than a previous run by more than --tolerance are flagged.
+
+    python scripts/benchmark.py --scales 10k,1M --output bench.jsonl
+    python scripts/benchmark.py --scales 10k,1M --baseline bench.jsonl
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark swap')
+parser.add_argument('--scales', default='10k,1M,10M',
+                    help='Comma separated numbers of classifications, '
+                         'with k and M suffixes. Default: 10k,1M,10M')
+parser.add_argument('--backends', default='array',
+                    help='Comma separated backends to run. Default: array')
+parser.add_argument('--ingest', default='rows', choices=['rows', 'chunks'],
+                    help='rows times ClassificationParser.parse and '
+                         'SWAP.classify, chunks times read_classifications '
+                         'and SWAP.classify_many. Default: rows')
+parser.add_argument('--storage', default='pickle', choices=['pickle', 'mmap'])
+parser.add_argument('--shards', type=int, default=1,
+                    help='Processes scoring and retiring subjects. Default: 1')
+parser.add_argument('--reference-history', action='store_true',
+                    help='Only keep user references in subject histories')
+parser.add_argument('--export-format', default='csv',
+                    choices=['csv', 'parquet', 'feather', 'arrow'])
+parser.add_argument('--data-dir', default='benchmark_data',
+                    help='Directory of the generated dumps')
+parser.add_argument('--users', type=float, default=.02,
+                    help='Users per classification. Default: 0.02')
+parser.add_argument('--subjects', type=float, default=.1,
+                    help='Subjects per classification. Default: 0.1')
+parser.add_argument('--golds', type=float, default=.1,
+                    help='Fraction of subjects with a gold label')
+parser.add_argument('--activity', type=float, default=1.2,
+                    help='Pareto shape of the user activity')
+parser.add_argument('--duplicates', type=float, default=.01,
+                    help='Fraction of duplicate (user, subject) rows')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--skip', default='',
+                    help='Comma separated steps to leave out')
+parser.add_argument('--output', default=None,
+                    help='Append the results to this file as JSON lines')
+parser.add_argument('--baseline', default=None,
+                    help='JSON lines of an earlier run to compare with')
+parser.add_argument('--tolerance', type=float, default=1.2,
+                    help='Ratio to the baseline that counts as a regression')
+
+steps = ['golds', 'parse', 'classify', 'score', 'retire', 'save', 'load',
+         'report', 'export_subjects', 'export_users',
+         'export_classifications', 'offline']
+
+
+def scale(text):
+    units = {'k': 10**3, 'M': 10**6, 'G': 10**9}
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def max_rss_mb():
+    # kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def dataset(args, n):
+    """
+    Generate the dump and golds for n classifications, unless they are
+    already in the data directory
+    """
+    from swap.utils.synthetic import Workload
+    workload = Workload(
+        n, max(1, int(n * args.users)), max(1, int(n * args.subjects)),
+        activity=args.activity, duplicates=args.duplicates, seed=args.seed)
+
+    name = 'synthetic_%d_%d_%d_%g_%g_%d' % (
+        n, workload.users, workload.subjects, args.activity,
+        args.duplicates, args.seed)
+    classifications = os.path.join(args.data_dir, name + '.csv')
+    golds = os.path.join(args.data_dir, name + '_golds_%g.csv' % args.golds)
+    if not os.path.isfile(classifications):
+        os.makedirs(args.data_dir, exist_ok=True)
+        print('Generating %s' % classifications, file=sys.stderr)
+        start = time.time()
+        workload.write_classifications(classifications + '.tmp')
+        os.replace(classifications + '.tmp', classifications)
+        print('Generated in %.1fs' % (time.time() - start), file=sys.stderr)
+    if not os.path.isfile(golds):
+        workload.write_golds(golds, args.golds)
+    return workload.dump(), classifications, golds
+
+
+def run(args, backend, workload, classifications, golds):
+    import swap.data
+    from swap.utils.control import SWAP, Config
+    from swap.utils.ingest import read_classifications
+    from swap.utils.parser import ClassificationParser
+
+    directory = tempfile.mkdtemp()
+    swap.data.dir = lambda: directory
+    skip = set(args.skip.split(','))
+    results = {}
+
+    def step(name, function, *a, **kw):
+        if name in skip:
+            return None
+        start = time.perf_counter()
+        value = function(*a, **kw)
+        results[name] = {'seconds': round(time.perf_counter() - start, 3),
+                         'max_rss_mb': max_rss_mb()}
+        return value
+
+    config = Config(backend=backend, storage=args.storage, shards=args.shards,
+                    reference_history=args.reference_history)
+    s = SWAP('benchmark', config)
+
+    with open(golds) as file:
+        gold = [(int(row['subject']), int(row['gold']))
+                for row in csv.DictReader(file)]
+    step('golds', s.apply_golds, gold)
+
+    # parse and classify are timed in one pass over the dump
+    timers = {'parse': 0., 'classify': 0.}
+    counts = {'classifications': 0, 'ingested': 0}
+    clock = time.perf_counter
+    if args.ingest == 'rows':
+        parser = ClassificationParser(config)
+        with open(classifications, newline='') as file:
+            for row in csv.DictReader(file):
+                a = clock()
+                cl = parser.parse(row)
+                b = clock()
+                counts['ingested'] += s.classify(
+                    cl['user'], cl['subject'], cl['cl'], cl['id_'])
+                timers['parse'] += b - a
+                timers['classify'] += clock() - b
+                counts['classifications'] += 1
+    else:
+        chunks = read_classifications(classifications, config, 100000)
+        while True:
+            a = clock()
+            chunk = next(chunks, None)
+            b = clock()
+            timers['parse'] += b - a
+            if chunk is None:
+                break
+            counts['ingested'] += s.classify_many(
+                chunk.users, chunk.subjects, chunk.labels, chunk.ids)
+            timers['classify'] += clock() - b
+            counts['classifications'] += len(chunk)
+    for name, seconds in timers.items():
+        results[name] = {'seconds': round(seconds, 3),
+                         'max_rss_mb': max_rss_mb()}
+
+    step('score', s)
+    step('retire', s.retire, config.p_retire_dud, config.p_retire_lens)
+    step('save', s.save)
+    if 'load' not in skip:
+        del s
+        s = step('load', SWAP.load, 'benchmark')
+
+    path = os.path.join(directory, 'benchmark')
+    suffix = '.' + args.export_format
+    step('report', s.report, path + '_report.txt')
+    step('export_subjects', s.export_subjects, path + '_scores' + suffix,
+         args.export_format)
+    step('export_users', s.export_users, path + '_skills' + suffix,
+         args.export_format)
+    step('export_classifications', s.export_classifications,
+         path + '_classifications' + suffix, args.export_format)
+    step('offline', s.offline)
+
+    shutil.rmtree(directory)
+    return dict(counts, **{
+        'backend': backend,
+        'ingest': args.ingest,
+        'storage': args.storage,
+        'shards': args.shards,
+        'reference_history': args.reference_history,
+        'export_format': args.export_format,
+        'workload': workload,
+        'golds': args.golds,
+        'skip': sorted(skip - {''}),
+        'steps': {name: results[name] for name in steps if name in results},
+        'max_rss_mb': max_rss_mb(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+
+
+def key(result):
+    # every setting that changes the run, results written before a field
+    # was added count as its default
+    return (json.dumps(result['workload'], sort_keys=True),
+            result.get('golds', .1), result['backend'], result['ingest'],
+            result.get('storage', 'pickle'), result.get('shards', 1),
+            result.get('reference_history', False),
+            result.get('export_format', 'csv'), tuple(result.get('skip', [])))
+
+
+def compare(result, baseline, tolerance):
+    """
+    Lines describing the steps that regressed against the baseline
+    """
+    lines = []
+    for name, new in result['steps'].items():
+        old = baseline['steps'].get(name)
+        if old is None:
+            continue
+        for field, floor in [('seconds', .05), ('max_rss_mb', 10)]:
+            if old[field] >= floor and new[field] > tolerance * old[field]:
+                lines.append('REGRESSION %s %s %s: %s -> %s (x%.2f)' % (
+                    key(result), name, field, old[field], new[field],
+                    new[field] / old[field]))
+    return lines
+
+
+def main():
+    args = parser.parse_args()
+    baselines = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            for line in file:
+                result = json.loads(line)
+                baselines[key(result)] = result
+
+    regressions = []
+    context = multiprocessing.get_context('spawn')
+    for n in [scale(s) for s in args.scales.split(',')]:
+        # generated in another process too, the peak RSS of a process
+        # starts at that of its parent
+        with context.Pool(1) as pool:
+            workload, classifications, golds = pool.apply(dataset, (args, n))
+        for backend in args.backends.split(','):
+            with context.Pool(1) as pool:
+                result = pool.apply(
+                    run, (args, backend, workload, classifications, golds))
+            print(json.dumps(result))
+            if args.output is not None:
+                with open(args.output, 'a') as file:
+                    file.write(json.dumps(result) + '\n')
+            if key(result) in baselines:
+                regressions += compare(
+                    result, baselines[key(result)], args.tolerance)
+
+    for line in regressions:
+        print(line, file=sys.stderr)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Compare throughput and peak memory of the agent storage backends.
+
+Every backend runs in its own process and goes through the same steps on
+a classification export: ingest, score, retire, save, load and export.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='Benchmark swap backends')
+parser.add_argument('classifications', help='Location of classifications csv')
+parser.add_argument('--golds', default=None, help='Location of golds csv')
+parser.add_argument('--backends', default='dict,array,sqlite',
+                    help='Comma separated backends to run')
+parser.add_argument('--cache-size', type=int, default=100000,
+                    help='Object cache size of the sqlite backend')
+parser.add_argument('--chunksize', type=int, default=100000)
+
+
+def run(args, backend):
+    import swap.data
+    from swap.utils.control import SWAP, Config
+    from swap.utils.ingest import read_classifications
+
+    directory = tempfile.mkdtemp()
+    swap.data.dir = lambda: directory
+    times = {}
+
+    def step(name, function, *args):
+        start = time.time()
+        value = function(*args)
+        times[name] = round(time.time() - start, 3)
+        return value
+
+    config = Config(backend=backend, cache_size=args.cache_size)
+    s = SWAP('benchmark', config)
+    if args.golds is not None:
+        import csv
+        with open(args.golds) as file:
+            golds = [(int(row['subject']), int(row['gold']))
+                     for row in csv.DictReader(file)]
+        step('golds', s.apply_golds, golds)
+
+    def ingest():
+        n = 0
+        for chunk in read_classifications(
+                args.classifications, s.config, args.chunksize):
+            n += s.classify_many(chunk.users, chunk.subjects,
+                                 chunk.labels, chunk.ids)
+        return n
+
+    n = step('ingest', ingest)
+    step('score', s)
+    step('retire', s.retire, config.p_retire_dud, config.p_retire_lens)
+    step('save', s.save)
+    del s
+    s = step('load', SWAP.load, 'benchmark')
+    step('export', s.export_subjects, os.path.join(directory, 'scores.csv'))
+
+    shutil.rmtree(directory)
+    return {
+        'backend': backend,
+        'classifications': n,
+        'classifications_per_second': round(n / times['ingest'], 1),
+        'seconds': times,
+        # kilobytes on linux
+        'max_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    context = multiprocessing.get_context('spawn')
+    for backend in args.backends.split(','):
+        with context.Pool(1) as pool:
+            print(json.dumps(pool.apply(run, (args, backend))))
+
+
+if __name__ == '__main__':
+    main()
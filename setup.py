@@ -92,6 +92,7 @@ setup(
     # $ pip install -e .[dev,test]
     extras_require={
         'online': ['caesar_external'],
+        'arrow': ['pyarrow'],
         'docs': [
             'sphinx',
             'sphinxcontrib-napoleon',
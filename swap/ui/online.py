@@ -1,11 +1,12 @@
 
 
+import asyncio
 import click
 import code
 
 from swap.ui import ui
 from swap.utils.control import SWAP
-from swap.utils.online import Online
+from swap.utils.online import Online, Pipeline
 
 
 try:
@@ -56,6 +57,7 @@ def run(name):
     logger.debug('Saved swap status')
     logger.info('Sending reductions to caesar')
     Online.send(swap)
+    swap.save()
 
     logger.debug('Done sending reductions to caesar')
     code.interact(local={**globals(), **locals()})
@@ -66,30 +68,27 @@ def run(name):
 def run_continuous(name):
     swap = SWAP.load(name)
     ce.Config.load(swap.config.online_name)
+    pipeline = Pipeline(swap)
     try:
         logger.info('Starting SWAP (%s) in continuous online mode...' % name)
-        while True:
-            _, haveItems = Online.receive(swap)
-            if haveItems:
-                swap.save()
-                ce.Config.instance().save()
-                logger.debug('Saved swap status')
-                logger.info('Sending reductions to caesar')
-                Online.send(swap)
-                logger.debug('Done sending reductions to caesar')
+        asyncio.run(pipeline.run())
     except KeyboardInterrupt as e:
         logger.debug('Received KeyboardInterrupt {}'.format(e))
         logger.debug('Terminating SWAP instance ({}).'.format(name))
-        return
+    finally:
+        pipeline.close()
+        logger.debug('Saved swap status')
 
 
 @online.command()
 @click.argument('name')
-def send(name):
+@click.option('--full', is_flag=True, help='Send every subject, not only the ones that changed since the last send.')
+def send(name, full):
     swap = SWAP.load(name)
     ce.Config.load(swap.config.online_name)
     logger.info('Sending reductions to caesar')
-    Online.send(swap)
+    Online.send(swap, full or None)
+    swap.save()
 
     logger.debug('Done sending reductions to caesar')
     code.interact(local={**globals(), **locals()})
@@ -7,7 +7,7 @@ import sys
 
 from swap.ui import ui
 from swap.utils.control import SWAP, Config, Thresholds
-from swap.utils.parser import ClassificationParser
+from swap.utils.ingest import read_classifications, read_classifications_parallel
 from swap.utils.plots import trajectory_plot
 
 
@@ -15,6 +15,27 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def ingest(swap, data, chunksize, workers=1):
+    # parse the csv dump in chunks and hand each chunk to swap in one go
+    if workers > 1:
+        chunks = read_classifications_parallel(
+            data, swap.config, workers, chunksize)
+    else:
+        chunks = read_classifications(data, swap.config, chunksize)
+
+    classifications = 0
+    classifications_ingested = 0
+    for chunk in chunks:
+        classifications += len(chunk)
+        # appends to agent and subject histories
+        classifications_ingested += swap.classify_many(
+            chunk.users, chunk.subjects, chunk.labels, chunk.ids)
+
+        sys.stdout.flush()
+        sys.stdout.write("%d records processed\r" % classifications)
+    return classifications, classifications_ingested
+
+
 @ui.cli.command()
 @click.argument('name')
 def clear(name):
@@ -30,34 +51,14 @@ def clear(name):
 @click.option('--report', default=None, help='Save report about analysis to this specified path, if provided.')
 @click.option('--scores', default=None, help='Save subject scores about analysis to this specified path, if provided.')
 @click.option('--skills', default=None, help='Save user skills about analysis to this specified path, if provided.')
-def run(name, data, trajectory=None, report=None, scores=None, skills=None):
+@click.option('--history', default=None, help='Save every ingested classification to this specified path (.parquet, .feather, .arrow or .csv), if provided.')
+@click.option('--chunksize', default=100000, help='Number of csv rows to parse and ingest at a time. Default: 100000')
+@click.option('--workers', default=1, help='Number of processes used to parse the csv dump. Default: 1')
+def run(name, data, trajectory=None, report=None, scores=None, skills=None, history=None, chunksize=100000, workers=1):
     swap = SWAP.load(name)
     config = swap.config
-    parser = ClassificationParser(config)
 
-    classifications = 0
-    classifications_ingested = 0
-    with open(data, 'r') as file:
-        reader = csv.DictReader(file)
-        for i, row in enumerate(reader):
-            row = parser.parse(row)
-            if row is None:
-                logger.error(row)
-                continue
-
-            if i % 100 == 0:
-                sys.stdout.flush()
-                sys.stdout.write("%d records processed\r" % i)
-
-            did_classify = swap.classify(**row)  # appends to agent and subject histories
-            classifications += 1
-            classifications_ingested += did_classify
-
-            # if i > 0 and i % 1e6 == 0:
-                # print()
-                # print('Applying records')
-                # swap()
-                # swap.truncate()
+    classifications, classifications_ingested = ingest(swap, data, chunksize, workers)
     logger.info('Processed {0} classifications, of which {1} were ingested as unique (user,subject) pairs'.format(classifications, classifications_ingested))
 
     swap()  # score_users, apply_subjects, score_subjects
@@ -75,6 +76,9 @@ def run(name, data, trajectory=None, report=None, scores=None, skills=None):
     if skills is not None:
         logger.info('exporting user skill to {0}'.format(skills))
         swap.export_users(path=skills)
+    if history is not None:
+        logger.info('exporting classifications to {0}'.format(history))
+        swap.export_classifications(path=history)
     logger.info('entering interactive after applying classifications but before saving')
     logger.warning('\n#####Press ctrl-d to continue the code. Type exit() to stop the code')
     code.interact(local={**globals(), **locals()})
@@ -89,30 +93,14 @@ def run(name, data, trajectory=None, report=None, scores=None, skills=None):
 @click.option('--report', default=None, help='Save report about analysis to this specified path, if provied.')
 @click.option('--scores', default=None, help='Save exported scores about analysis to this specified path, if provided.')
 @click.option('--skills', default=None, help='Save user skills about analysis to this specified path, if provided.')
-def offline(name, data, unsupervised=False, ignore_gold_status=False, report=None, scores=None, skills=None):
+@click.option('--history', default=None, help='Save every ingested classification to this specified path (.parquet, .feather, .arrow or .csv), if provided.')
+@click.option('--chunksize', default=100000, help='Number of csv rows to parse and ingest at a time. Default: 100000')
+@click.option('--workers', default=1, help='Number of processes used to parse the csv dump. Default: 1')
+def offline(name, data, unsupervised=False, ignore_gold_status=False, report=None, scores=None, skills=None, history=None, chunksize=100000, workers=1):
     swap = SWAP.load(name)
     config = swap.config
-    parser = ClassificationParser(config)
-
-    with open(data, 'r') as file:
-        reader = csv.DictReader(file)
-        for i, row in enumerate(reader):
-            row = parser.parse(row)
-            if row is None:
-                logger.error(row)
-                continue
-
-            if i % 100 == 0:
-                sys.stdout.flush()
-                sys.stdout.write("%d records processed\r" % i)
-
-            swap.classify(**row)  # appends to agent and subject histories
 
-            # if i > 0 and i % 1e6 == 0:
-                # print()
-                # print('Applying records')
-                # swap()
-                # swap.truncate()
+    ingest(swap, data, chunksize, workers)
 
     logger.info('Entering expectation_maximization')
     swap.offline(unsupervised=unsupervised, ignore_gold_status=ignore_gold_status)
@@ -127,6 +115,9 @@ def offline(name, data, unsupervised=False, ignore_gold_status=False, report=Non
     if skills is not None:
         logger.info('exporting user skills to {0}'.format(skills))
         swap.export_users(path=skills)
+    if history is not None:
+        logger.info('exporting classifications to {0}'.format(history))
+        swap.export_classifications(path=history)
     logger.info('entering interactive after applying classifications but before saving')
     logger.warning('\n#####Press ctrl-d to continue the code. Type exit() to stop the code')
     code.interact(local={**globals(), **locals()})
@@ -172,18 +163,25 @@ def copy(old_name, new_name):
 @ui.cli.command()
 @click.argument('name')
 @click.argument('directory')
-def export(name, directory):
+@click.option('--format', 'format_', default='csv', type=click.Choice(['csv', 'parquet', 'feather', 'arrow']), help='File format of the scores, skills and classifications. Default: csv')
+def export(name, directory, format_='csv'):
     logger.info('loading swap {0}'.format(name))
     swap = SWAP.load(name)
     report_path = directory + '/{0}_report.txt'.format(swap.name)
     logger.info('reporting')
     swap.report(path=report_path, report_classifications=True)
     logger.info('exporting score')
-    score_path = directory + '/{0}_scores.csv'.format(swap.name)
-    swap.export_subjects(path=score_path)
+    score_path = directory + '/{0}_scores.{1}'.format(swap.name, format_)
+    swap.export_subjects(path=score_path, format=format_)
     logger.info('exporting score')
-    score_path = directory + '/{0}_skills.csv'.format(swap.name)
-    swap.export_users(path=score_path)
+    score_path = directory + '/{0}_skills.{1}'.format(swap.name, format_)
+    swap.export_users(path=score_path, format=format_)
+    logger.info('exporting classifications')
+    history_path = directory + '/{0}_classifications.{1}'.format(swap.name, format_)
+    swap.export_classifications(path=history_path, format=format_)
+    logger.info('exporting score trajectories')
+    trajectory_path = directory + '/{0}_trajectories.{1}'.format(swap.name, format_)
+    swap.export_trajectories(path=trajectory_path, format=format_)
     trajectory_path = directory + '/{0}_trajectory.pdf'.format(swap.name)
     logger.info('Plotting some trajectories to {0}'.format(trajectory_path))
     trajectory_plot(swap=swap, path=trajectory_path)
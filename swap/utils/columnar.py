@@ -0,0 +1,495 @@
+"""
+Columnar storage for subject and user agent state.
+
+Every agent gets a dense integer index the first time its id is seen, and
+each numeric field lives in one NumPy array indexed by it. Histories are
+still plain python lists, one per row.
+"""
+import numpy as np
+
+from swap.utils.collection import Collection
+
+
+def compact(ids):
+    """
+    Store a list of ids as an int64 array when they are all integers
+    """
+    if isinstance(ids, MappedList) and ids.unchanged():
+        return ids.array
+    if all(type(i) is int for i in ids):
+        return np.array(ids, dtype=np.int64)
+    return np.array(ids, dtype=object)
+
+
+class MappedList:
+    """
+    List-like view of an array of ids or names, usually memory-mapped from
+    a snapshot. Entries are turned into python objects when they are read,
+    entries added or replaced after loading are kept as python objects.
+
+    present: Entries that are not None, all of them if not given
+    """
+
+    def __init__(self, array, present=None):
+        # indexing a plain ndarray is much faster than a numpy.memmap
+        self.array = array.view(np.ndarray)
+        self.present = present
+        self.stored = len(array)
+        self.changed = {}
+        self.extra = []
+
+    def _stored(self, i):
+        if self.present is not None and not self.present[i]:
+            return None
+        value = self.array[i]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i >= self.stored:
+            return self.extra[i - self.stored]
+        if i in self.changed:
+            return self.changed[i]
+        return self._stored(i)
+
+    def __setitem__(self, i, value):
+        if i < 0:
+            i += len(self)
+        if i >= self.stored:
+            self.extra[i - self.stored] = value
+        else:
+            self.changed[i] = value
+
+    def append(self, value):
+        self.extra.append(value)
+
+    def unchanged(self):
+        """
+        Whether the entries are still the ones in the array
+        """
+        return len(self.changed) == 0 and len(self.extra) == 0
+
+    def __iter__(self):
+        # convert the stored entries a block at a time
+        block = 1 << 16
+        for a in range(0, self.stored, block):
+            values = self.array[a:a + block].tolist()
+            if self.present is not None:
+                present = self.present[a:a + block].tolist()
+                values = [v if p else None for v, p in zip(values, present)]
+            for i, value in enumerate(values, a):
+                yield self.changed.get(i, value) if self.changed else value
+        yield from self.extra
+
+    def __len__(self):
+        return self.stored + len(self.extra)
+
+
+class IdIndex:
+    """
+    Assigns dense integer indices to arbitrary ids
+    """
+
+    def __init__(self, ids=None):
+        if isinstance(ids, MappedList):
+            self.ids = ids
+        else:
+            self.ids = list(ids or [])
+        # built the first time an id is looked up
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {id_: i for i, id_ in enumerate(self.ids)}
+        return self._index
+
+    def add(self, id_):
+        """
+        Return the index of id_, adding it if it is new
+        """
+        i = self.index.get(id_)
+        if i is None:
+            i = len(self.ids)
+            self.ids.append(id_)
+            self.index[id_] = i
+        return i
+
+    def get(self, id_):
+        return self.index.get(id_)
+
+    def add_many(self, ids):
+        """
+        Array of indices for a sequence of ids, adding new ones
+        """
+        get = self.index.get
+        indices = [get(i) for i in ids]
+        for j, i in enumerate(indices):
+            if i is None:
+                indices[j] = self.add(ids[j])
+        return np.array(indices, dtype=np.int64)
+
+    def __contains__(self, id_):
+        return id_ in self.index
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ClassificationBuffer:
+    """
+    Growable columns of (user index, subject index, label, classification
+    id), one row per ingested classification
+
+    Users and subjects get dense indices in order of first appearance.
+    column() hands out views of the rows in use without copying.
+    """
+    fields = {
+        'user': np.int64,
+        'subject': np.int64,
+        'label': np.int8,
+        'id': np.int64,
+    }
+
+    def __init__(self, capacity=1024):
+        self.users = IdIndex()
+        self.subjects = IdIndex()
+        self.size = 0
+        self.capacity = max(capacity, 1)
+        for name, dtype in self.fields.items():
+            setattr(self, name, np.zeros(self.capacity, dtype=dtype))
+
+    def _reserve(self, n):
+        if self.size + n <= self.capacity:
+            return
+        capacity = max(2 * self.capacity, self.size + n)
+        for name, dtype in self.fields.items():
+            array = np.zeros(capacity, dtype=dtype)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def append(self, user, subject, label, id_=-1):
+        self._reserve(1)
+        i = self.size
+        self.user[i] = self.users.add(user)
+        self.subject[i] = self.subjects.add(subject)
+        self.label[i] = label
+        self.id[i] = id_
+        self.size += 1
+
+    def extend(self, users, subjects, labels, ids):
+        """
+        Append a batch of classifications given as sequences
+        """
+        n = len(labels)
+        self._reserve(n)
+        i = self.size
+        self.user[i:i + n] = self.users.add_many(users)
+        self.subject[i:i + n] = self.subjects.add_many(subjects)
+        self.label[i:i + n] = labels
+        self.id[i:i + n] = ids
+        self.size += n
+
+    def column(self, name):
+        """
+        View of a column trimmed to the rows in use
+        """
+        return getattr(self, name)[:self.size]
+
+    def __getitem__(self, i):
+        return [self.users.ids[self.user[i]],
+                self.subjects.ids[self.subject[i]],
+                int(self.label[i])]
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+    def __len__(self):
+        return self.size
+
+    def dump(self):
+        # 32-bit indices, like the packed keys of PairSet
+        return {
+            'users': compact(self.users.ids),
+            'subjects': compact(self.subjects.ids),
+            'user': self.column('user').astype(np.uint32),
+            'subject': self.column('subject').astype(np.uint32),
+            'label': self.column('label').copy(),
+            'id': self.column('id').copy(),
+        }
+
+    @classmethod
+    def load(cls, data):
+        if type(data) is not dict:
+            # list of [user, subject, label]
+            buffer = cls(len(data))
+            for user, subject, label in data:
+                buffer.append(user, subject, label)
+            return buffer
+
+        buffer = cls(1)
+        buffer.users = IdIndex(MappedList(data['users']))
+        buffer.subjects = IdIndex(MappedList(data['subjects']))
+        buffer.size = len(data['label'])
+        buffer.capacity = max(buffer.size, 1)
+        if buffer.size > 0:
+            # memory-mapped columns of the right type are used as they are
+            for name, dtype in cls.fields.items():
+                setattr(buffer, name, np.asarray(data[name], dtype=dtype))
+        return buffer
+
+    def __str__(self):
+        return '%d classifications' % self.size
+
+    def __repr__(self):
+        return str(self)
+
+
+class Table:
+    """
+    Struct-of-arrays store for one kind of agent
+    """
+    # name -> (dtype, shape of one row, default value)
+    fields = {}
+
+    def __init__(self, capacity=1024):
+        self.ids = []
+        self._index = {}
+        self.history = []
+        self.capacity = max(capacity, 1)
+
+        for name, (dtype, shape, default) in self.fields.items():
+            array = np.full((self.capacity,) + shape, default, dtype=dtype)
+            setattr(self, name, array)
+
+    @classmethod
+    def empty(cls):
+        """
+        Table with no rows whose fields are not allocated, for opening a
+        snapshot whose fields are set afterwards
+        """
+        table = cls.__new__(cls)
+        table.ids = []
+        table._index = {}
+        table.history = []
+        table.capacity = 0
+        return table
+
+    @property
+    def index(self):
+        # tables opened from a memory-mapped snapshot build the id lookup
+        # the first time it is needed
+        if self._index is None:
+            self._index = {id_: i for i, id_ in enumerate(self.ids)}
+        return self._index
+
+    @index.setter
+    def index(self, value):
+        self._index = value
+
+    def add(self, id_):
+        """
+        Add a new row for id_ and return its index
+        """
+        i = len(self.ids)
+        if i == self.capacity:
+            self._grow()
+
+        self.ids.append(id_)
+        self.index[id_] = i
+        self.history.append([])
+        return i
+
+    def _grow(self):
+        capacity = 2 * self.capacity
+        for name, (dtype, shape, default) in self.fields.items():
+            array = np.full((capacity,) + shape, default, dtype=dtype)
+            array[:self.capacity] = getattr(self, name)
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def column(self, name):
+        """
+        View of a field trimmed to the rows in use
+        """
+        return getattr(self, name)[:len(self.ids)]
+
+    def dump(self):
+        data = {
+            'ids': list(self.ids),
+            'history': list(self.history),
+        }
+        for name in self.fields:
+            data[name] = self.column(name).copy()
+        return data
+
+    @classmethod
+    def load(cls, data):
+        table = cls(capacity=len(data['ids']))
+        for id_ in data['ids']:
+            table.add(id_)
+        table.history = data['history']
+
+        n = len(table.ids)
+        for name in cls.fields:
+            if name in data:
+                getattr(table, name)[:n] = data[name]
+        return table
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class SubjectTable(Table):
+    fields = {
+        'gold': (np.int8, (), -1),
+        # -1 stands for a subject that is not retired (None)
+        'retired': (np.int8, (), -1),
+        'score': (np.float64, (), 0),
+        'prior': (np.float64, (), 0),
+        'seen': (np.int32, (), 0),
+        'logodds': (np.float64, (), 0),
+        # score and retirement as last sent to caesar, nan and -2 for a
+        # subject that was never sent
+        'sent_score': (np.float64, (), np.nan),
+        'sent_retired': (np.int8, (), -2),
+    }
+
+
+def confusion_matrices(correct, seen, gamma=1):
+    """
+    Confusion matrices (PD, PL) from arrays of correct and seen counters,
+    one user per row, mirrors User.score
+    """
+    correct = correct[:, :2]
+    seen = seen[:, :2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = (correct + gamma) / (seen + 2 * gamma)
+    return np.where(seen > 0, score, .5)
+
+
+class UserTable(Table):
+    # Counters are float64 because offline EM writes fractional
+    # pseudo-counts into seen and correct
+    fields = {
+        'correct': (np.float64, (2,), 0),
+        'seen': (np.float64, (3,), 0),
+        'prior_correct': (np.float64, (2,), 0),
+        'prior_seen': (np.float64, (3,), 0),
+        # confusion matrix last applied by incremental scoring, nan if none
+        'applied': (np.float64, (2,), np.nan),
+    }
+
+    def __init__(self, capacity=1024):
+        super().__init__(capacity)
+        self.names = []
+
+    @classmethod
+    def empty(cls):
+        table = super().empty()
+        table.names = []
+        return table
+
+    def add(self, id_):
+        self.names.append(None)
+        return super().add(id_)
+
+    def scores(self, gamma=1):
+        """
+        Confusion matrix (PD, PL) of every user, mirrors User.score
+        """
+        return confusion_matrices(
+            self.column('correct'), self.column('seen'), gamma)
+
+    def dump(self):
+        data = super().dump()
+        data['names'] = list(self.names)
+        return data
+
+    @classmethod
+    def load(cls, data):
+        table = super().load(data)
+        table.names = data['names']
+        return table
+
+
+def counts(row):
+    """
+    Hand counters back as python numbers, keeping whole values as ints so
+    reports and exports look the same as with plain lists
+    """
+    return [int(v) if v == int(v) else v for v in row.tolist()]
+
+
+class ArrayCollection(Collection):
+    """
+    Collection whose items are views over a Table
+    """
+    table_class = Table
+    view_class = None
+
+    def __init__(self, table=None):
+        if table is None:
+            table = self.table_class()
+        self.table = table
+
+    def view(self, i):
+        return self.view_class(self.table, i)
+
+    def add(self, item):
+        self._insert(item.dump())
+
+    def subset(self, items):
+        return self.dict_class([self[i] for i in items])
+
+    def iter(self):
+        for i in range(len(self.table)):
+            yield self.view(i)
+
+    def list(self):
+        return list(self.iter())
+
+    def keys(self):
+        return list(self.table.ids)
+
+    def __getitem__(self, item):
+        i = self.table.index.get(item)
+        if i is None:
+            i = self._new(item)
+        return self.view(i)
+
+    def __contains__(self, item):
+        return item in self.table.index
+
+    def _new(self, item):
+        return self.table.add(item)
+
+    def _insert(self, data):
+        pass
+
+    def dump(self):
+        return self.table.dump()
+
+    @classmethod
+    def load(cls, data):
+        if isinstance(data, Table):
+            return cls(data)
+        if type(data) is dict:
+            return cls(cls.table_class.load(data))
+
+        # Dump from the dict backend, one record per item
+        items = cls()
+        for item in data:
+            items._insert(item)
+        return items
+
+    def __str__(self):
+        return '%d items' % len(self.table)
+
+    def __len__(self):
+        return len(self.table)
@@ -1,9 +1,25 @@
 
 import pickle
 import os
-
-from swap.utils.subject import Subjects, ScoreStats, Thresholds
-from swap.utils.user import Users
+import copy
+import time
+import threading
+from collections import deque
+import numpy as np
+
+from swap.utils.subject import Subject, Subjects, ArraySubjects, ScoreCounter, ScoreStats, Thresholds, retirement, scores_of, logodds_term, logodds_terms, history_arrays, running_logodds, logistic
+from swap.utils.user import Users, ArrayUsers
+from swap.utils.em import expectation_maximization
+from swap.utils.columnar import ClassificationBuffer
+from swap.utils.pairs import PairSet
+from swap.utils.trajectory import TrajectoryCache
+from swap.utils.journal import Journal, write_atomic
+from swap.utils.database import Database, SQLiteUsers, SQLiteSubjects
+import swap.utils.state as state
+from swap.utils.report import open_report, write_sections
+import swap.utils.export as export
+import swap.utils.metrics as metrics
+import swap.utils.shards as shards
 from swap.utils.plots import thresholds_setting
 import swap.data
 
@@ -11,6 +27,20 @@ import logging
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.INFO)
 
+# Storage engines for agent state, selected with Config.backend
+backends = {
+    'dict': (Users, Subjects),
+    'array': (ArrayUsers, ArraySubjects),
+    'sqlite': (SQLiteUsers, SQLiteSubjects),
+}
+
+# file or directory that holds the snapshot for each kind of storage
+snapshot_suffix = {
+    'pickle': '.pkl',
+    'mmap': '.state',
+    'sqlite': '.sqlite',
+}
+
 class Config:
 
     def __init__(self, **kwargs):
@@ -28,6 +58,64 @@ class Config:
         self.p_retire_dud = kwargs.get('p_retire_dud', 1e-3)
         self.p_real, self.p_bogus = thresholds_setting()
         self.online_name = kwargs.get('online_name', None)
+        # 'dict' keeps one python object per agent, 'array' keeps agent
+        # state in numpy columns (see swap.utils.columnar), 'sqlite' keeps
+        # agents in ${NAME}.sqlite (see swap.utils.database)
+        self.backend = kwargs.get('backend', 'dict')
+        # number of agents of each kind the sqlite backend keeps in memory
+        self.cache_size = kwargs.get('cache_size', 100000)
+        # Online.send only sends subjects whose retirement changed or whose
+        # score moved by at least online_min_delta since it was last sent,
+        # and sends everything every online_resync sends (0 for never)
+        self.online_min_delta = kwargs.get('online_min_delta', 0.)
+        self.online_resync = kwargs.get('online_resync', 0)
+        # reductions per request, number of requests in flight, and retries
+        # per request with exponential backoff starting at online_backoff
+        # seconds
+        self.online_batch_size = kwargs.get('online_batch_size', 1000)
+        self.online_workers = kwargs.get('online_workers', 4)
+        self.online_retries = kwargs.get('online_retries', 3)
+        self.online_backoff = kwargs.get('online_backoff', 1.)
+        # continuous online mode polls an empty extractor after
+        # online_idle_min seconds, doubling up to online_idle_max, and logs
+        # stage latencies every online_stats_interval cycles
+        self.online_idle_min = kwargs.get('online_idle_min', 1.)
+        self.online_idle_max = kwargs.get('online_idle_max', 60.)
+        self.online_stats_interval = kwargs.get('online_stats_interval', 100)
+        # Subject histories only keep a reference to the user, and user
+        # scores are read at scoring time instead of being copied around
+        self.reference_history = kwargs.get('reference_history', False)
+        # 'full' rescores every subject from its history, 'incremental'
+        # keeps a running log-odds sum per subject
+        self.scoring = kwargs.get('scoring', 'full')
+        # save appends operations to a journal, and only writes a full
+        # snapshot once the journal holds snapshot_interval records
+        self.journal = kwargs.get('journal', False)
+        self.snapshot_interval = kwargs.get('snapshot_interval', 1000000)
+        # 'pickle' saves a single ${NAME}.pkl, 'mmap' saves a directory of
+        # memory-mapped arrays (array backend only, see swap.utils.state)
+        self.storage = kwargs.get('storage', 'pickle')
+        # 'fork' lets the continuous online mode write the snapshots that
+        # compact the journal from a forked child process, with at most
+        # checkpoint_inflight of them running at once
+        self.checkpoint = kwargs.get('checkpoint', 'sync')
+        self.checkpoint_inflight = kwargs.get('checkpoint_inflight', 1)
+        # worker processes formatting the sections of SWAP.report
+        self.report_processes = kwargs.get('report_processes', 1)
+        # keep the score trajectories of up to trajectory_cache
+        # classifications for reports, plots and exports (0 disables the
+        # cache), evicting subjects by trajectory_eviction, 'lru' or 'fifo'
+        # (see swap.utils.trajectory)
+        self.trajectory_cache = kwargs.get('trajectory_cache', 0)
+        self.trajectory_eviction = kwargs.get('trajectory_eviction', 'lru')
+        # time the phases of a run and count events, logged as JSON lines
+        # (see swap.utils.metrics). Saving writes the totals as a
+        # Prometheus text file to metrics_path, ${NAME}.prom by default
+        self.metrics = kwargs.get('metrics', False)
+        self.metrics_path = kwargs.get('metrics_path', None)
+        # score and retire in this many forked processes, split by a hash
+        # of the user and subject ids (see swap.utils.shards)
+        self.shards = kwargs.get('shards', 1)
 
     def dump(self):
         return self.__dict__.copy()
@@ -47,186 +135,293 @@ class Config:
 
 class SWAP:
 
-    def __init__(self, name, config=None):
+    def __init__(self, name, config=None, fresh=True):
+        """
+        fresh: start without any agents. SWAP.load passes False so the
+               sqlite backend keeps the records in its database
+        """
         self.name = name
-        self.users = Users()
-        self.subjects = Subjects()
 
         if config is None:
             config = Config()
         self.config = config
+        if getattr(config, 'metrics', False):
+            metrics.enable()
+
+        users, subjects = backends[config.backend]
+        if config.backend == 'sqlite':
+            db = Database.open(swap.data.path(name + '.sqlite'))
+            if fresh:
+                db.clear()
+            self.users = users(db, config.cache_size)
+            self.subjects = subjects(db, config.cache_size)
+        else:
+            self.users = users()
+            self.subjects = subjects()
 
         self.thresholds = None
-        self._performance = None
         self.last_id = None
 
-        self.classifications = []
-
-        self.seen_classifications = {}
+        # ScoreCounter of every pair of thresholds that statistics were
+        # asked for, and the (gold, score) of the subjects that changed
+        # since the counters were last updated, from before the change
+        self.score_counters = {}
+        self._score_changes = {}
+
+        # every ingested classification, as columns of dense indices
+        self.classifications = ClassificationBuffer()
+
+        # (user, subject) pairs that were already classified
+        self._seen_classifications = PairSet()
+        # dump of the seen pairs, only loaded when they are needed
+        self._seen_dump = None
+
+        # agents that got classifications, golds or score changes since
+        # the last call, and how many agents the last call touched
+        self.dirty_users = set()
+        self.dirty_subjects = set()
+        self.touched = {'users': 0, 'changed_users': 0, 'subjects': 0}
+
+        # subject id -> (score, retired) as last sent to caesar (see
+        # SWAP.sent), subjects whose score or retirement may have changed
+        # since, and the number of sends
+        self._sent = {}
+        self.unsent = set()
+        self.sends = 0
+
+        # operations since the last save, written to the journal on save.
+        # A new instance always starts with a snapshot.
+        self._journal = None
+        self._records = []
+        self._snapshot_needed = True
+        self._saved_config = None
+        # snapshots being written by child processes, as
+        # (pid, temporary path, path, storage, journal seq)
+        self._checkpoints = deque()
+
+        # running log-odds of recently used subjects
+        self.trajectory_cache = TrajectoryCache(
+            config.trajectory_cache, config.trajectory_eviction)
 
     @classmethod
     def load(cls, name):
-        fname = name + '.pkl'
-
-        path = swap.data.path(fname)
-        if os.path.isfile(path):
-            with open(swap.data.path(path), 'rb') as file:
+        start = time.perf_counter()
+        path = swap.data.path(name + '.pkl')
+        state_path = swap.data.path(name + '.state')
+        db_path = swap.data.path(name + '.sqlite')
+        data = None
+        if state.exists(state_path):
+            data = state.read_state(state_path)
+        elif os.path.isfile(db_path):
+            data = Database.open(db_path).snapshot()
+        if data is None and os.path.isfile(path):
+            with open(path, 'rb') as file:
                 data = pickle.load(file)
+        if data is None:
+            return SWAP(name)
+
+        config = Config.load(data['config'])
+
+        swp = SWAP(name, config, fresh=False)
+        swp.last_id = data['last_id']
+        users, subjects = backends[config.backend]
+        if config.backend != 'sqlite':
+            swp.users = users.load(data['users'])
+            swp.subjects = subjects.load(data['subjects'])
+        elif 'users' in data:
+            # snapshot of another backend, move its records into the
+            # database
+            for i, key in enumerate(['users', 'subjects']):
+                items = data[key]
+                if type(items) is dict:
+                    items = [item.dump() for item in
+                             backends['array'][i].load(items).iter()]
+                getattr(swp, key).restore(items)
+
+        if data.get('thresholds'):
+            swp.thresholds = Thresholds.load(
+                swp.subjects, data['thresholds'])
+        if data.get('seen_classifications'):
+            swp._seen_classifications = None
+            swp._seen_dump = data['seen_classifications']
+        if data.get('classifications') is not None:
+            swp.classifications = ClassificationBuffer.load(
+                data['classifications'])
+        swp.trajectory_cache = TrajectoryCache.load(
+            data.get('trajectories'), config.trajectory_cache,
+            config.trajectory_eviction)
+        if 'dirty' in data:
+            swp.dirty_users, swp.dirty_subjects = data['dirty']
+        else:
+            swp.mark_dirty()
+        if 'unsent' in data:
+            # snapshots written before the array and sqlite backends kept
+            # the sent state with their subjects have it in the dict
+            swp.sent.update(data['sent'])
+            swp.unsent, swp.sends = data['unsent'], data['sends']
+        else:
+            # never tracked, the next send covers every subject
+            swp.unsent = set(swp.subjects.keys())
+        if config.scoring == 'incremental' and not data.get('logodds'):
+            # saved without incremental scoring, build the sums now
+            swp.rebuild_logodds()
+
+        # replay the operations saved after the snapshot. The journal is
+        # removed when a snapshot covers all of it, so new records have
+        # to continue from the sequence number of the snapshot
+        journal_seq = data.get('journal_seq', 0)
+        swp.journal.seq = max(swp.journal.seq, journal_seq)
+        swp._records = None
+        replayed = 0
+        for record in swp.journal.replay(journal_seq):
+            getattr(swp, record[0])(*record[1:])
+            replayed += 1
+        swp._records = []
+        metrics.observe('load', time.perf_counter() - start,
+                        subjects=len(swp.subjects), replayed=replayed)
+        swp._snapshot_needed = False
+        swp._saved_config = copy.deepcopy(swp.config.dump())
+        return swp
 
-            config = Config.load(data['config'])
+    @property
+    def seen_classifications(self):
+        if self._seen_classifications is None:
+            self._seen_classifications = PairSet.load(self._seen_dump)
+            self._seen_dump = None
+        return self._seen_classifications
 
-            swp = SWAP(name, config)
-            swp.last_id = data['last_id']
-            swp.users = Users.load(data['users'])
-            swp.subjects = Subjects.load(data['subjects'])
+    @seen_classifications.setter
+    def seen_classifications(self, value):
+        self._seen_classifications = value
+        self._seen_dump = None
 
-            if data.get('thresholds'):
-                swp.thresholds = Thresholds.load(
-                    swp.subjects, data['thresholds'])
-            if data.get('seen_classifications'):
-                swp.seen_classifications = data['seen_classifications']
+    @property
+    def journal(self):
+        if self._journal is None:
+            self._journal = Journal(swap.data.path(self.name + '.journal'))
+        return self._journal
+
+    def _record(self, *record):
+        # keep an operation for the journal, records are
+        # (method name, args...) and are replayed by calling the method
+        if self._records is None:
+            return
+        if self.config.journal:
+            self._records.append(record)
         else:
-            swp = SWAP(name)
-        return swp
+            self._snapshot_needed = True
+
+    def _update_config(self, config):
+        self.config.__dict__.update(config)
+
+    def __call__(self, full=False):
+        # only agents marked dirty and the subjects that depend on users
+        # whose score changed are recomputed
+        self._record('__call__', full)
+        start = time.perf_counter()
+        if full:
+            self.mark_dirty()
+        users = self.dirty_users
+        self.dirty_users = set()
+
+        if shards.available(self):
+            changed, subjects = shards.score(self, users)
+        else:
+            changed, subjects = self._score(users)
+        self.unsent.update(subjects)
 
-    def __call__(self):
-#        logger.info('score users')
-        self.score_users()
-#        logger.info('apply subjects')
-        self.apply_subjects()
-#        logger.info('score_subjects')
-        self.score_subjects()
+        self.touched = {
+            'users': len(users),
+            'changed_users': len(changed),
+            'subjects': len(subjects),
+        }
+        logger.debug('Touched %(users)d users (%(changed_users)d changed) '
+                     'and %(subjects)d subjects', self.touched)
+        metrics.observe('score', time.perf_counter() - start, **self.touched)
+
+    def _score(self, users):
+        # score users and then the subjects that depend on them in this
+        # process, returns the users whose score changed and the subjects
+        # that were scored
+        with metrics.timer('score_users', users=len(users)):
+            changed = self.score_users(users)
+        with metrics.timer('apply_subjects', users=len(changed)):
+            self.apply_subjects(changed)
+
+        subjects = self.dirty_subjects
+        self.dirty_subjects = set()
+        for user in changed:
+            for subject, _, _ in self.users[user].history:
+                subjects.add(subject)
+                self.trajectory_cache.discard(subject)
+        if self.score_counters:
+            for subject in subjects:
+                self._score_changing(self.subjects[subject])
+
+        if self.config.scoring == 'incremental':
+            with metrics.timer('apply_logodds', users=len(changed)):
+                self.apply_logodds(changed)
+        else:
+            with metrics.timer('score_subjects', subjects=len(subjects)):
+                self.score_subjects(subjects)
+        return changed, subjects
+
+    def mark_dirty(self, users=None, subjects=None):
+        # mark agents for recomputation on the next call, everything if
+        # neither users nor subjects are given
+        if users is None and subjects is None:
+            users = self.users.keys()
+            subjects = self.subjects.keys()
+        self.dirty_users.update(users or [])
+        self.dirty_subjects.update(subjects or [])
 
     def offline(self, unsupervised=False, ignore_gold_status=False):
         # like __call__, but now we incorporate the probabilities of the unknown samples. In order to avoid breaking pieces of user and subject, I do the math here, and then apply the info
-        import numpy as np
-
         logger.info('OfflineSwap: ignore_gold_status={0}, unsupervised={1}'.format(ignore_gold_status, unsupervised))
-
-        # need to turn the classifications into a more easily manipulatable form
-
-#        logger.debug('OfflineSwap: Getting scores')
-        uids = []
-        sids = []
-        classifications = []
-        for classification in self.classifications:
-            user_id, subject_id, cl = classification
-
-            if user_id not in uids:
-                uids.append(user_id)
-
-            if subject_id not in sids:
-                sids.append(subject_id)
-            subject = self.subjects[subject_id]
-            classifications.append([uids.index(user_id), sids.index(subject_id), cl, subject.gold])
-        classifications = np.array(classifications)
-
-#        logger.debug('OfflineSwap: confusions')
-        confusions = []
-        for uid in uids:
-            confusions.append(self.users[uid].score)
-        confusions = np.array(confusions)  # confusions[:,0] == PD, confusions[:,1] == PL
-
-#        logger.debug('OfflineSwap: probabilities')
-        probabilities = []
-        unknown_indices = []
-        for i, sid in enumerate(sids):
-            subject = self.subjects[sid]
-            probabilities.append(subject.score)
-            if subject.gold != -1:
-                unknown_indices.append(i)
-        unknown_indices = np.array(unknown_indices)
-        probabilities = np.array(probabilities)
+        start = time.perf_counter()
+        self._snapshot_needed = True
+
+        # index columns of the classifications, users and subjects are
+        # numbered in order of their first classification
+        classifications = self.classifications
+        users = classifications.column('user')
+        subjects = classifications.column('subject')
+        labels = classifications.column('label')
+        uids = classifications.users.ids
+        sids = classifications.subjects.ids
+        golds = np.array([self.subjects[sid].gold for sid in sids], dtype=np.int64)
+
+        # confusions[:,0] == PD, confusions[:,1] == PL
+        confusions = np.array([self.users[uid].score for uid in uids], dtype=float).reshape(-1, 2)
+        probabilities = np.array([self.subjects[sid].score for sid in sids], dtype=float)
 
         # EM parameters
         N_min = 40
         N_max = 1000
         if not ignore_gold_status and not unsupervised:
             N_min = 2  # this should converge right away
-        epsilon_min = 1e-8
         gamma = 1
 
-        epsilon_taus = 10
-        N_try = 0
-#        logger.info('Running Expectation Maximization')
-        while (epsilon_taus > epsilon_min) * (N_try < N_max) + (N_try < N_min):
-            # collect old probabilities for assessing convergence
-            old_probabilities = probabilities.copy()
-
-            # E step
-            p_real = np.zeros_like(probabilities)
-            p_bogus = np.zeros_like(probabilities)
-            n_observations = np.zeros_like(probabilities)
-            n_user_observations = np.zeros(len(confusions))
-            # this for loop could probably be done in a smarter fashion. Or at least in numba instead
-            for ci in classifications:
-                uid, sid, cid, gold = ci
-
-                # TODO: I forget which of these is the bestest way
-                # p0i = probabilities[sid]
-                # p0i = np.mean(probabilities)
-                p0i = subject.p0  # this converges much quicker
-                p_real[sid] += (confusions[uid, 1] ** cid *
-                                (1 - confusions[uid, 1]) ** (1 - cid) *
-                                p0i)
-                p_bogus[sid] += ((1 - confusions[uid, 0]) ** cid *
-                                 confusions[uid, 0] ** (1 - cid) *
-                                 (1 - p0i))
-                n_observations[sid] += 1.
-                n_user_observations[uid] += 1.
-
-            # any subjects with no observations get put back to their prior score
-            probabilities = np.where(n_observations > 0, p_real / (p_real + p_bogus) / n_observations, old_probabilities)
-
-            # assess convergence
-            epsilon_taus = np.sum(np.abs(probabilities - old_probabilities) / len(probabilities))
-
-            # M step
-            confusions_numer = np.zeros_like(confusions)
-            confusions_denom = np.zeros_like(confusions)
-            for ci in classifications:
-                uid, sid, cid, gold = ci
-
-                if not unsupervised and gold == -1:
-                    # ignore non golds in supervised mode
-                    continue
-
-                if ignore_gold_status:
-                    pi = probabilities[sid]
-                else:
-                    if gold == 0:
-                        pi = 0
-                    elif gold == 1:
-                        pi = 1
-                    else:
-                        pi = probabilities[sid]
-
-                confusions_numer[uid, 0] += (1 - cid) * (1 - pi)
-                confusions_numer[uid, 1] += cid * pi
-                confusions_denom[uid, 0] += 1 - pi
-                confusions_denom[uid, 1] += pi
-
-            confusions = (gamma + confusions_numer) / (2 * gamma + confusions_denom)
-
-            N_try += 1
-            logger.debug('EM Step {0} out of max {1}. Convergence Score: {2:.2e}.'.format(N_try, N_max, epsilon_taus))
+        with metrics.timer('em', classifications=len(labels)) as timer:
+            confusions, probabilities, N_try, epsilon_taus = expectation_maximization(
+                users, subjects, labels, golds[subjects], confusions, probabilities,
+                Subject.p0, unsupervised=unsupervised,
+                ignore_gold_status=ignore_gold_status,
+                N_min=N_min, N_max=N_max, gamma=gamma)
+            timer.add(iterations=N_try, convergence=epsilon_taus)
+        metrics.count('em_iterations', N_try)
 
         logger.info('Finished EM at Step {0}. Convergence Score: {1:.2e}'.format(N_try, epsilon_taus))
 
 #        logger.info('score users')
         # apply scores
-        for user in self.users.iter():
-            # hacky: set prior, seen, and correct values, and truncate history
-            # this is because we cannot set the score itself (it is a method that is considered a property of the user class)
-            try:
-                uid = uids.index(user.id)
-            except ValueError:
-                continue
-            p_bogus, p_real = confusions[uid]
-            # take total seen and translate this into that
-            n_real = probabilities.sum()
-            n_bogus = len(probabilities) - n_real
-
+        # hacky: set prior, seen, and correct values, and truncate history
+        # this is because we cannot set the score itself (it is a method that is considered a property of the user class)
+        # take total seen and translate this into that
+        n_real = probabilities.sum()
+        n_bogus = len(probabilities) - n_real
+        for uid, (p_bogus, p_real) in zip(uids, confusions):
+            user = self.users[uid]
             user.seen = [n_bogus - 2 * gamma, n_real - 2 * gamma, user.seen[2]]
             user.correct = [n_bogus * p_bogus - gamma, n_real * p_real - gamma]
             # # truncate history
@@ -235,105 +430,487 @@ class SWAP:
 
 #        logger.info('apply subjects')
         self.apply_subjects()
+        # recompute everything from the histories on the next call
+        self.mark_dirty()
+        self.trajectory_cache.clear()
+        # every score changes, count them again when they are needed
+        self.score_counters = {}
+        self._score_changes = {}
 
 #        logger.info('score subjects')
-        for subject in self.subjects.iter():
-            # emulate update_score
-            try:
-                sid = sids.index(subject.id)
-            except ValueError:
-                continue
-            probability = probabilities[sid]
-            print(sid, subject.id, probability)
+        for i, (sid, probability) in enumerate(zip(sids, probabilities)):
+            subject = self.subjects[sid]
+            logger.debug('%d %s %s', i, subject.id, probability)
             # modify prior == score
             subject.score = probability
+        self.unsent.update(sids)
             # # truncate history for the truncate step
             # subject.prior = probability
             # subject.history = []
+        metrics.observe('offline', time.perf_counter() - start,
+                        subjects=len(sids), users=len(uids))
 
     def classify(self, user, subject, cl, id_):
+        self._record('classify', user, subject, cl, id_)
+        metrics.count('classifications_received')
         if self.last_id is None or id_ > self.last_id:
             self.last_id = id_
 
         # check if classification pair is in seen_classifications
-        try:
-            self.seen_classifications[(user, subject)]
+        if not self.seen_classifications.add(user, subject):
             # we have already had this pair happen. ignore
 #            logger.debug('Already saw {0} classify {1}. Ignoring Classification {2},{3}'.format(user, subject, cl, id_))
             return 0
-        except KeyError:
-            # have not seen this, so we may add this classification
-            self.seen_classifications[(user, subject)] = True
 
+        self._classify(user, subject, cl)
+        self.classifications.append(user, subject, cl, id_)
+        metrics.count('classifications_ingested')
+        return 1
+
+    def _classify(self, user, subject, cl):
+        # add a classification that passed the duplicate check
         user = self.users[user]
         subject = self.subjects[subject]
 
         user.classify(subject, cl)
-        subject.classify(user, cl)
+        subject.classify(user, cl, reference=self.config.reference_history)
+        self.users.classified(user, subject)
+        self.dirty_users.add(user.id)
+        self.dirty_subjects.add(subject.id)
+
+        if subject.id in self.trajectory_cache:
+            u0, u1 = user.score
+            self.trajectory_cache.extend(
+                subject.id, float(logodds_terms(u0, u1, cl)))
+
+        if self.config.scoring == 'incremental':
+            if user.applied is None:
+                user.applied = user.score
+            self._score_changing(subject)
+            subject.add_logodds(logodds_term(user.applied, cl))
+
+    def classify_many(self, users, subjects, labels, ids):
+        # batch version of classify, takes parallel arrays and returns the
+        # number of classifications that were ingested
+        if len(ids) == 0:
+            return 0
+        self._record('classify_many', users, subjects, labels, ids)
+        start = time.perf_counter()
+        id_ = int(ids.max())
+        if self.last_id is None or id_ > self.last_id:
+            self.last_id = id_
 
-        self.classifications.append([user.id, subject.id, cl])
-        return 1
+        users = users.tolist()
+        subjects = subjects.tolist()
+        labels = labels.tolist()
+        new = self.seen_classifications.add_many(users, subjects)
+        index = np.flatnonzero(new).tolist()
+        for i in index:
+            self._classify(users[i], subjects[i], labels[i])
+        self.classifications.extend(
+            [users[i] for i in index], [subjects[i] for i in index],
+            [labels[i] for i in index], ids[new])
+        metrics.observe('classify', time.perf_counter() - start,
+                        classifications=len(ids), ingested=len(index))
+        metrics.count('classifications_received', len(ids))
+        metrics.count('classifications_ingested', len(index))
+        return len(index)
 
     def truncate(self):
+        self._snapshot_needed = True
         self.users.truncate()
         self.subjects.truncate()
+        self.trajectory_cache.clear()
+
+    @staticmethod
+    def _agents(collection, ids=None):
+        if ids is None:
+            return collection.iter()
+        return (collection[i] for i in ids)
+
+    def score_users(self, users=None):
+        # returns the ids of users whose score changed
+        changed = []
+        for u in self._agents(self.users, users):
+            score = u.score
+            if u.update_score() != score:
+                changed.append(u.id)
+        return changed
+
+    def score_subjects(self, subjects=None):
+        users = self.score_source
+        for s in self._agents(self.subjects, subjects):
+            s.update_score(users=users)
 
-    def score_users(self):
-        for u in self.users.iter():
-            u.update_score()
-
-    def score_subjects(self):
-        for s in self.subjects.iter():
-            s.update_score()
-
-    def apply_subjects(self):
+    @property
+    def score_source(self):
+        # users to read scores from when subject histories hold references
+        if self.config.reference_history:
+            return self.users
+        return None
+
+    def apply_subjects(self, users=None):
+        if self.config.reference_history:
+            # subjects read user scores directly, nothing to propagate
+            return
         # update user scores to each subject
-        for ui, u in enumerate(self.users.iter()):
+        for ui, u in enumerate(self._agents(self.users, users)):
 #            logger.debug('User {0} of {1}: {2} with {3} classifications'.format(ui, len(self.users), u.id, len(u.history)))
             for subject, _, _ in u.history:
                 self.subjects[subject].update_user(u)
 
+    def apply_logodds(self, users=None):
+        # incremental scoring: swap the terms of every user whose score
+        # changed since it was last applied
+        for user in self._agents(self.users, users):
+            applied = user.applied
+            score = user.score
+            if applied is None or applied == score:
+                continue
+
+            delta = [logodds_term(score, cl) - logodds_term(applied, cl)
+                     for cl in [0, 1]]
+            for subject, _, cl in user.history:
+                self.subjects[subject].add_logodds(delta[cl])
+            user.applied = score
+
+    def rebuild_logodds(self):
+        # recompute the incremental log-odds sums from the full histories
+        self._snapshot_needed = True
+        for user in self.users.iter():
+            user.applied = user.score
+
+        for subject in self.subjects.iter():
+            logodds = 0.
+            for user, _, cl in subject.history:
+                logodds += logodds_term(self.users[user].applied, cl)
+            subject.logodds = 0.
+            if len(subject.history) > 0:
+                subject.add_logodds(logodds)
+
     def apply_gold(self, subject, gold):
         # update gold subjects to each user
+        self._record('apply_gold', subject, gold)
         subject = self.subjects[subject]
+        self._score_changing(subject)
         subject.gold = gold
-        for user, _, _ in subject.history:
-            self.users[user].update_subject(subject)
+        self.dirty_subjects.add(subject.id)
+        for user, i in self.users.positions(subject.id):
+            self.users[user].update_subject(subject, i)
+            self.dirty_users.add(user)
 
     def apply_golds(self, golds):
+        # set all gold labels first, then rewrite the affected user history
+        # entries at once
+        golds = list(golds)
+        self._record('apply_golds', golds)
+        users = []
+        positions = []
+        labels = []
         for subject, gold in golds:
-            self.apply_gold(subject, gold)
+            self._score_changing(self.subjects[subject])
+            self.subjects[subject].gold = gold
+            self.dirty_subjects.add(subject)
+            for user, i in self.users.positions(subject):
+                users.append(user)
+                positions.append(i)
+                labels.append(gold)
+        self.dirty_users.update(users)
+        self.users.set_golds(users, positions, labels)
+
+    def _score_changing(self, subject):
+        # keep the gold label and score of a subject before they change,
+        # for updating the score counters
+        if self.score_counters and subject.id not in self._score_changes:
+            self._score_changes[subject.id] = (subject.gold, subject.score)
+
+    def score_counts(self, bogus, real):
+        """
+        ScoreCounter of all subjects at a pair of thresholds. Counters are
+        made the first time a pair is asked for, and then updated with the
+        subjects that changed since.
+        """
+        changes = self._score_changes
+        self._score_changes = {}
+        if self.score_counters:
+            ids = list(changes)
+            old = (np.fromiter((changes[i][0] for i in ids), np.int64, len(ids)),
+                   np.fromiter((changes[i][1] for i in ids), np.float64, len(ids)))
+            new = scores_of((self.subjects[i] for i in ids), len(ids))
+            for counter in self.score_counters.values():
+                # subjects made since are counted as they were made, and
+                # the ones that changed since are in changes
+                n = len(self.subjects) - counter.size
+                counter.add(np.full(n, -1), np.full(n, Subject.p0))
+                counter.update(old, new)
+
+        key = (bogus, real)
+        if key not in self.score_counters:
+            self.score_counters[key] = ScoreCounter.from_subjects(
+                self.subjects, bogus, real)
+        return self.score_counters[key]
 
     def retire(self, p_retire_dud, p_retire_lens):
+        self._record('retire', p_retire_dud, p_retire_lens)
         t = Thresholds(self.subjects, p_retire_dud, p_retire_lens)
         self.thresholds = t
         bogus, real = t()  # these are the threshold scores: p < bogus -> object is retired as bogus, and p > real -> object is retired as real.
 
-        for subject in self.subjects.iter():
-            # subject.update_score((bogus, real))
-            subject.retire((bogus, real))
+        changed = 0
+        with metrics.timer('retire', subjects=len(self.subjects)) as timer:
+            if shards.available(self):
+                retired = shards.retire(self, (bogus, real))
+                self.unsent.update(retired)
+                changed = len(retired)
+            elif isinstance(self.subjects, ArraySubjects):
+                table = self.subjects.table
+                retired = table.column('retired')
+                classified = state.history_lengths(table.history) > 0
+                new = retirement(table.column('score'), retired,
+                                 classified, (bogus, real))
+                positions = np.flatnonzero(new != retired)
+                retired[positions] = new[positions]
+                self.unsent.update(table.ids[i] for i in positions.tolist())
+                changed = len(positions)
+            else:
+                for subject in self.subjects.iter():
+                    # subject.update_score((bogus, real))
+                    retired = subject.retired
+                    # only dirty subjects are rescored, so retirement
+                    # under earlier thresholds is dropped here like
+                    # update_score drops it
+                    if len(subject.history) > 0:
+                        subject.retired = None
+                    subject.retire((bogus, real))
+                    if subject.retired != retired:
+                        self.unsent.add(subject.id)
+                        changed += 1
+            timer.add(changed=changed)
 
-    def save(self, name=None):
+    @property
+    def sent(self):
+        """
+        Score and retirement of each subject as last sent to caesar. The
+        array backend keeps them in columns of the subject table, the
+        sqlite backend in a table of its database, and the dict backend
+        in a dict of subject id -> (score, retired)
+        """
+        return getattr(self.subjects, 'sent', self._sent)
+
+    def mark_sent(self, sent, checked):
+        """
+        Record a successful send to caesar
+
+        sent: (subject id, score, retired) of the subjects that were sent
+        checked: ids of the subjects that were compared with their last
+                 sent state
+        """
+        self._record('mark_sent', sent, checked)
+        self.sent.update(
+            {subject: (score, retired) for subject, score, retired in sent})
+        self.unsent.difference_update(checked)
+        self.sends += 1
+
+    def save(self, name=None, background=False):
+        # Saving under the own name appends to the journal when it is
+        # enabled, and writes a snapshot when the journal is full, when it
+        # is disabled, or after operations that rewrite the whole state.
+        #
+        # background: write a snapshot of a full journal from a forked
+        #     process instead of waiting for it. The journal already holds
+        #     every record, so the state is on disk when save returns.
+        #     Only forks when called from the main thread, while no other
+        #     thread holds a lock. Call flush before exiting.
+        with metrics.timer('save', background=background):
+            self._save(name, background)
+        if metrics.enabled and name is None:
+            self.write_metrics()
+
+    def write_metrics(self, path=None):
+        # write the metrics as a Prometheus text file, to
+        # config.metrics_path or ${NAME}.prom by default
+        if path is None:
+            path = getattr(self.config, 'metrics_path', None) or \
+                swap.data.path(self.name + '.prom')
+        metrics.write_prometheus(path, {'swap': self.name})
+
+    def _save(self, name, background):
+        if name is not None:
+            self._snapshot(name, 0)
+            return
+
+        storage = self.storage
+        path = swap.data.path(self.name + snapshot_suffix[storage])
+        journal = self.journal
+        if self.config.journal and not self._snapshot_needed \
+                and os.path.exists(path):
+            config = self.config.dump()
+            if config != self._saved_config:
+                self._record('_update_config', copy.deepcopy(config))
+            journal.append(self._records)
+            self._records = []
+            self._saved_config = copy.deepcopy(config)
+
+            self._reap()
+            if len(self._checkpoints) > 0:
+                pending = journal.seq - self._checkpoints[-1][4]
+            else:
+                pending = len(journal)
+            if pending < self.config.snapshot_interval:
+                return
+            if background and storage != 'sqlite' and hasattr(os, 'fork'):
+                # the child only gets the calling thread, so fork from the
+                # main thread, with any other threads paused by the caller
+                # (see Pipeline)
+                if threading.current_thread() is threading.main_thread():
+                    self._fork_snapshot(path, storage)
+                    return
+                logger.debug('Writing the snapshot in the foreground, '
+                             'not called from the main thread')
+
+        # an older snapshot still in flight must not replace this one
+        self.flush()
+        self._snapshot(path, journal.seq, storage)
+        self._remove_other_snapshots(storage)
+        journal.compact(journal.seq)
+        self._records = []
+        self._snapshot_needed = False
+        self._saved_config = copy.deepcopy(self.config.dump())
+
+    def _remove_other_snapshots(self, storage):
+        # only keep the snapshot in the format that was just written
+        for other, suffix in snapshot_suffix.items():
+            other_path = swap.data.path(self.name + suffix)
+            if other == storage:
+                continue
+            if other == 'mmap':
+                state.remove(other_path)
+            elif other == 'sqlite':
+                Database.remove(other_path)
+            elif os.path.isfile(other_path):
+                os.remove(other_path)
+
+    def _fork_snapshot(self, path, storage):
+        """
+        Write a snapshot from a child process, which works on a copy on
+        write image of the state at the time of the fork. The snapshot is
+        written to a temporary path, and moved into place by the parent
+        once the child exits.
+        """
+        while len(self._checkpoints) >= max(self.config.checkpoint_inflight, 1):
+            self._reap(block=True)
+
+        seq = self.journal.seq
+        tmp = '%s.%d.ckpt' % (path, seq)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._snapshot(tmp, seq, storage)
+                code = 0
+            except BaseException:
+                logger.exception('Background snapshot %s failed', tmp)
+            finally:
+                os._exit(code)
+
+        logger.debug('Writing snapshot %s in process %d', tmp, pid)
+        self._checkpoints.append((pid, tmp, path, storage, seq))
+
+    def _reap(self, block=False):
+        """
+        Move the snapshots of finished child processes into place, in the
+        order they were started, and compact the journal up to them
+
+        block: wait for the oldest child
+        """
+        while len(self._checkpoints) > 0:
+            pid, tmp, path, storage, seq = self._checkpoints[0]
+            done, status = os.waitpid(pid, 0 if block else os.WNOHANG)
+            if done == 0:
+                return
+            block = False
+            self._checkpoints.popleft()
+
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                if storage == 'mmap':
+                    state.install(tmp, path)
+                else:
+                    os.replace(tmp, path)
+                self._remove_other_snapshots(storage)
+                self.journal.compact(seq)
+            else:
+                # the journal still holds every record
+                logger.error('Background snapshot %s failed with status %d',
+                             tmp, status)
+                if storage == 'mmap':
+                    state.remove(tmp)
+                elif os.path.isfile(tmp):
+                    os.remove(tmp)
+
+    def flush(self):
+        """
+        Wait for snapshots that are written in the background
+        """
+        while len(self._checkpoints) > 0:
+            self._reap(block=True)
+
+    @property
+    def storage(self):
+        # the sqlite backend keeps its snapshot in the database
+        if self.config.backend == 'sqlite':
+            return 'sqlite'
+        return self.config.storage
+
+    def _snapshot(self, path, journal_seq, storage='pickle'):
         if self.thresholds is not None:
             thresholds = self.thresholds.dump()
         else:
             thresholds = None
+        if self._seen_classifications is None and 'pairs' in self._seen_dump:
+            # never loaded, write the arrays back as they are
+            seen_classifications = {
+                k: np.asarray(v) for k, v in self._seen_dump.items()}
+        else:
+            seen_classifications = self.seen_classifications.dump()
         data = {
             'config': self.config.dump(),
-            'users': self.users.dump(),
-            'subjects': self.subjects.dump(),
             'thresholds': thresholds,
             'last_id': self.last_id,
-            'seen_classifications': self.seen_classifications,
+            'logodds': self.config.scoring == 'incremental',
+            'dirty': (self.dirty_users, self.dirty_subjects),
+            'journal_seq': journal_seq,
+            'sent': self._sent,
+            'unsent': self.unsent,
+            'sends': self.sends,
+            'trajectories': self.trajectory_cache.dump(),
         }
 
-        if name is None:
-            name = swap.data.path(self.name + '.pkl')
-        with open(name, 'wb') as file:
-            pickle.dump(data, file)
-
-    def report(self, path=None, report_subjects=True, report_users=True, report_classifications=True):
-        # make a string for reporting, dumps to a text file located in same directory as pickle
+        if storage == 'mmap':
+            if self.config.backend != 'array':
+                raise ValueError(
+                    'mmap storage needs the array backend, not %s' %
+                    self.config.backend)
+            state.write_state(path, data, self.users.table,
+                              self.subjects.table, seen_classifications,
+                              self.classifications)
+        elif storage == 'sqlite':
+            self.users.flush()
+            self.subjects.flush()
+            data['seen_classifications'] = seen_classifications
+            data['classifications'] = self.classifications.dump()
+            self.users.db.commit(data)
+        else:
+            data['users'] = self.users.dump()
+            data['subjects'] = self.subjects.dump()
+            data['seen_classifications'] = seen_classifications
+            data['classifications'] = self.classifications.dump()
+            write_atomic(path, data)
+
+    def report(self, path=None, report_subjects=True, report_users=True, report_classifications=True, compress=None, processes=None):
+        # write a report to a text file located in same directory as pickle.
+        # The subject and user sections are streamed to the file, formatted
+        # by config.report_processes worker processes (see swap.utils.report).
+        # compress gzips the report, by default when path ends in .gz
         report = 'Report for SWAP Database {0}\n'.format(self.name)
 
         # number of subjects, users, and number of classifications
@@ -353,23 +930,13 @@ class SWAP:
             report += '\nTarget P_retire_dud: {0:.3f}, Target P_retire_lens: {1:.3f}, P(Retire Bogus): {2:.3f}, P(Retire Real): {3:.3f}\n'.format(self.thresholds.p_retire_dud, self.thresholds.p_retire_lens, p_bogus, p_real)
 
             # TODO: golds: give breakdown of golds classifications
-            scores = self.thresholds.get_scores()
-            total = [0, 0, 0]
-            bogus = [0, 0, 0]
-            real = [0, 0, 0]
-            inconclusive = [0, 0, 0]
-            for score in scores:
-                index = {0: 0, 1: 1, -1: 2}[score[0]]
-                total[index] += 1
-                p = score[1]
-                if p >= p_real:
-                    real[index] += 1
-                elif p <= p_bogus:
-                    bogus[index] += 1
-                else:
-                    inconclusive[index] += 1
-            for k, label in enumerate(['bogus', 'real', 'unknown']):
-                report += '{0} {1}: {2} classified real, {3} classified bogus, {4} inconclusive'.format(label, total[k], real[k], bogus[k], inconclusive[k])
+            counter = self.score_counts(p_bogus, p_real)
+            total = counter.total()
+            bogus = counter.low()
+            real = counter.high()
+            for gold, label in zip([0, 1, -1], ['bogus', 'real', 'unknown']):
+                inconclusive = total[gold] - real[gold] - bogus[gold]
+                report += '{0} {1}: {2} classified real, {3} classified bogus, {4} inconclusive'.format(label, total[gold], real[gold], bogus[gold], inconclusive)
                 report += '\n'
             # report += 'p_retire_dud: {0:.4f}, mdf: {1:.4f}'.format(1 - real[1] / total[1], 1 - bogus[0] / total[0])
             report += '\n'
@@ -377,34 +944,72 @@ class SWAP:
             logger.debug('skipping threshold reporting')
 
 
-        if report_subjects:
-            report += '\n#####\n# Subjects\n#####\n'
-            for key in self.subjects.keys():
-                subject = self.subjects[key]
-                subject_report = subject.report(report_classifications=report_classifications)
-                report += subject_report
-
-        if report_users:
-            report += '\n#####\n# Users\n#####\n\n'
-            for key in self.users.keys():
-                user = self.users[key]
-                user_report = user.report(report_classifications=report_classifications)
-                report += user_report
-
         # save it
         if path is None:
-            path = swap.data.path(self.name + '_report.txt')
+            suffix = '_report.txt.gz' if compress else '_report.txt'
+            path = swap.data.path(self.name + suffix)
+        if processes is None:
+            processes = self.config.report_processes
         logger.info('Saving report to {0}'.format(path))
-        with open(path, 'w') as file:
+        with open_report(path, compress) as file:
             file.write(report)
 
-    def export_subjects(self, path=None):
-        import csv
-
+            if report_subjects:
+                file.write('\n#####\n# Subjects\n#####\n')
+                write_sections(file, self, 'subjects',
+                               report_classifications, processes)
+
+            if report_users:
+                file.write('\n#####\n# Users\n#####\n\n')
+                write_sections(file, self, 'users',
+                               report_classifications, processes)
+
+    def trajectories(self, subjects):
+        # score of each subject after every classification in its history,
+        # as offsets and one flat array (see swap.utils.subject.trajectories).
+        # Subjects in the trajectory cache are read from it, the others are
+        # computed in one batch and added to it.
+        cache = self.trajectory_cache
+        if cache.size <= 0:
+            arrays = history_arrays(subjects, self.score_source)
+            return arrays[1], logistic(running_logodds(*arrays))
+
+        rows = [cache.get(subject.id) for subject in subjects]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if len(missing) > 0:
+            batch = [subjects[i] for i in missing]
+            arrays = history_arrays(batch, self.score_source)
+            offsets = arrays[1]
+            logodds = running_logodds(*arrays)
+            for k, i in enumerate(missing):
+                rows[i] = cache.store(
+                    batch[k].id, logodds[offsets[k]:offsets[k + 1]])
+
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        if len(rows) == 0:
+            return offsets, np.zeros(0)
+        return offsets, logistic(np.concatenate(rows).astype(np.float64))
+
+    def trajectory(self, subject):
+        # score of a subject after every classification in its history
+        return self.trajectories([self.subjects[subject]])[1]
+
+    def export_subjects(self, path=None, format=None):
+        # format: 'csv', or 'parquet', 'feather' or 'arrow' for a columnar
+        # export (see swap.utils.export), by default from the path suffix
         if path is None:
-            path = swap.data.path(self.name + '_scores.csv')
+            path = swap.data.path(self.name + '_scores.' + (format or 'csv'))
+        if format is None:
+            format = export.format_of(path)
         logger.info('Saving subject scores to {0}'.format(path))
 
+        if format != 'csv':
+            columns = export.subject_columns(self.subjects)
+            export.write(path, export.batches(columns), format)
+            return
+
+        import csv
         with open(path, 'w') as file:
             writer = csv.writer(file, delimiter=',')
             writer.writerow(["id","gold","score","retired","seen"])
@@ -415,24 +1020,55 @@ class SWAP:
                 row = [subject.id, subject.gold, subject.score, retired, subject.seen]
                 writer.writerow(row)
 
-    def export_users(self, path=None):
-        import csv
-
+    def export_users(self, path=None, format=None):
         if path is None:
-            path = swap.data.path(self.name + '_skills.csv')
+            path = swap.data.path(self.name + '_skills.' + (format or 'csv'))
+        if format is None:
+            format = export.format_of(path)
         logger.info('Saving user skills to {0}'.format(path))
 
+        if format != 'csv':
+            columns = export.user_columns(self.users)
+            export.write(path, export.batches(columns), format)
+            return
+
+        import csv
         with open(path, 'w') as file:
             writer = csv.writer(file, delimiter=',')
             writer.writerow(["id","name","bogus_seen","real_seen","other_seen","bogus_correct","real_correct","PD","PL"])
             for user in self.users.iter():
-                row = [user.id, user.name, user.seen[0], user.seen[1], user.seen[2], user.correct[0], user.correct[1], user.score[0], user.score[1]]
+                # score, and the counters of the array backend, are
+                # computed on every access
+                seen = user.seen
+                correct = user.correct
+                score = user.score
+                row = [user.id, user.name, seen[0], seen[1], seen[2], correct[0], correct[1], score[0], score[1]]
                 writer.writerow(row)
 
+    def export_classifications(self, path=None, format=None):
+        # one row per ingested classification: id, user, subject, label
+        if path is None:
+            path = swap.data.path(
+                self.name + '_classifications.' + (format or 'parquet'))
+        logger.info('Saving classifications to {0}'.format(path))
+        export.write(path, export.classification_batches(self.classifications),
+                     format)
+
+    def export_trajectories(self, path=None, format=None):
+        # one row per classification of every subject: subject, n and the
+        # score after the first n classifications
+        if path is None:
+            path = swap.data.path(
+                self.name + '_trajectories.' + (format or 'parquet'))
+        logger.info('Saving score trajectories to {0}'.format(path))
+        export.write(path, export.trajectory_batches(self), format)
 
     @property
     def performance(self):
-        if self._performance is None:
-            self._performance = ScoreStats(self.subjects, self.thresholds)
-            self._performance()
-        return self._performance
+        # statistics at the retirement thresholds, read from the score
+        # counters instead of sorting all subjects
+        bogus, real = self.thresholds()
+        performance = ScoreStats(self.subjects, self.thresholds,
+                                 self.score_counts(bogus, real))
+        performance()
+        return performance
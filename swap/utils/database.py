@@ -0,0 +1,449 @@
+"""
+SQLite storage for user and subject records, for projects whose state
+does not fit in memory.
+
+Each agent is a row holding its pickled dump. Agents that are in use are
+kept in a bounded LRU cache of objects, and are written back to the
+database when they are evicted and when SWAP saves. An evicted object
+that is still referenced elsewhere stays tracked through a weak
+reference: lookups return that same object and its later changes are
+written back too. Subjects also keep their gold label and retirement
+status in indexed columns, so gold() and retired() are queries, and the
+state last sent to caesar is kept in its own table. The positions of
+each subject in the user histories are kept in an indexed table as well.
+
+All writes between two snapshots happen inside one transaction, which
+SWAP commits together with the rest of its state when it saves.
+"""
+import os
+import pickle
+import sqlite3
+import weakref
+from collections import OrderedDict
+
+from swap.utils.collection import Collection
+from swap.utils.subject import Subjects
+from swap.utils.user import Users
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Database:
+    """
+    Connection to ${NAME}.sqlite shared by the user and subject collections
+    of a SWAP instance
+    """
+
+    # one connection per database file, so a SWAP instance that replaces
+    # another one in the same process sees the same transaction
+    _connections = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value BLOB);
+            CREATE TABLE IF NOT EXISTS users (
+                row INTEGER PRIMARY KEY, id UNIQUE, data BLOB);
+            CREATE TABLE IF NOT EXISTS subjects (
+                row INTEGER PRIMARY KEY, id UNIQUE,
+                gold INTEGER, retired INTEGER, data BLOB);
+            CREATE INDEX IF NOT EXISTS subjects_gold ON subjects (gold);
+            CREATE INDEX IF NOT EXISTS subjects_retired ON subjects (retired);
+            CREATE TABLE IF NOT EXISTS sent (
+                id PRIMARY KEY, score REAL, retired INTEGER);
+            CREATE TABLE IF NOT EXISTS positions (
+                subject, user, position INTEGER);
+            CREATE INDEX IF NOT EXISTS positions_subject
+                ON positions (subject);
+        ''')
+
+    @classmethod
+    def open(cls, path):
+        key = os.path.realpath(path)
+        if key not in cls._connections:
+            cls._connections[key] = cls(path)
+        return cls._connections[key]
+
+    @classmethod
+    def remove(cls, path):
+        """
+        Close the connection to a database file and delete it
+        """
+        db = cls._connections.pop(os.path.realpath(path), None)
+        if db is not None:
+            db.connection.close()
+        for p in [path, path + '-journal']:
+            if os.path.isfile(p):
+                os.remove(p)
+
+    def execute(self, *args):
+        return self.connection.execute(*args)
+
+    def executemany(self, *args):
+        return self.connection.executemany(*args)
+
+    def clear(self):
+        """
+        Delete all records, in the open transaction
+        """
+        for table in ['meta', 'users', 'subjects', 'sent', 'positions']:
+            self.execute('DELETE FROM %s' % table)
+
+    def snapshot(self):
+        """
+        Drop changes made since the last commit and return the saved SWAP
+        state, or None if nothing was saved yet
+        """
+        self.connection.rollback()
+        row = self.execute(
+            'SELECT value FROM meta WHERE key = ?', ('snapshot',)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def commit(self, data):
+        """
+        Store the SWAP state and commit everything written since the last
+        snapshot
+        """
+        self.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('snapshot', pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.connection.commit()
+
+
+class SQLiteCollection(Collection):
+    """
+    Collection of records in a Database table with an LRU object cache
+    """
+    table = None
+    dict_class = None
+    # indexed columns besides the pickled record
+    columns = []
+
+    # number of cached items written back at once when the cache is full
+    evict_batch = 1024
+
+    def __init__(self, db, cache_size=100000):
+        self.db = db
+        self.cache_size = cache_size
+        # id -> [row, item, pickled record when loaded]
+        self.cache = OrderedDict()
+        # evicted items that are still referenced outside the cache,
+        # id -> [weak reference to the item, row, pickled record]
+        self.held = {}
+
+    @staticmethod
+    def _pickle(item):
+        return pickle.dumps(item.dump(), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _values(self, item):
+        """
+        Values of the indexed columns of an item
+        """
+        return ()
+
+    def _cache(self, id_, row, item, record):
+        self.cache[id_] = [row, item, record]
+        if len(self.cache) > self.cache_size:
+            # the newest items always stay, they may still be in use
+            keep = max(self.cache_size - self.evict_batch, self.cache_size // 2, 1)
+            evict = []
+            while len(self.cache) > keep:
+                evict.append(self.cache.popitem(last=False))
+            self._write([entry for _, entry in evict])
+            for key, entry in evict:
+                self.held[key] = [
+                    weakref.ref(entry[1], self._released(key)),
+                    entry[0], entry[2]]
+        return item
+
+    def _released(self, id_):
+        # drop the held entry of an evicted item once it is garbage
+        held = self.held
+
+        def release(ref):
+            entry = held.get(id_)
+            if entry is not None and entry[0] is ref:
+                del held[id_]
+        return release
+
+    def _held(self, id_):
+        """
+        Move an evicted item that is still referenced back into the cache,
+        returns None if there is none
+        """
+        entry = self.held.pop(id_, None)
+        if entry is None:
+            return None
+        item = entry[0]()
+        if item is None:
+            return None
+        return self._cache(id_, entry[1], item, entry[2])
+
+    def _in_use(self):
+        """
+        Cache entries and entries of held items, [row, item, record]
+        """
+        entries = list(self.cache.values())
+        for entry in list(self.held.values()):
+            item = entry[0]()
+            if item is not None:
+                entries.append([entry[1], item, entry[2]])
+        return entries
+
+    def _write(self, entries):
+        """
+        Write back the items that changed since they were loaded
+        """
+        rows = []
+        for entry in entries:
+            row, item, record = entry
+            data = self._pickle(item)
+            if data != record:
+                rows.append((data,) + self._values(item) + (row,))
+                entry[2] = data
+
+        if len(rows) > 0:
+            columns = ', '.join(['data = ?'] + ['%s = ?' % c for c in self.columns])
+            self.db.executemany(
+                'UPDATE %s SET %s WHERE row = ?' % (self.table, columns), rows)
+
+    def _insert(self, item):
+        data = self._pickle(item)
+        columns = ', '.join(['id', 'data'] + self.columns)
+        values = ', '.join(['?'] * (2 + len(self.columns)))
+        cursor = self.db.execute(
+            'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (self.table, columns, values),
+            (item.id, data) + self._values(item))
+        return self._cache(item.id, cursor.lastrowid, item, data)
+
+    def flush(self):
+        """
+        Write back every cached or held item that changed
+        """
+        self._write(self.cache.values())
+        for id_, entry in list(self.held.items()):
+            item = entry[0]()
+            if item is not None:
+                written = [entry[1], item, entry[2]]
+                self._write([written])
+                entry[2] = written[2]
+
+    def add(self, item):
+        self.cache.pop(item.id, None)
+        self.held.pop(item.id, None)
+        self._insert(item)
+
+    def subset(self, items):
+        return self.dict_class([self[i] for i in items])
+
+    def iter(self):
+        # page through the table by row. Cached items are newer than their
+        # rows, and a record is only read when it is reached because items
+        # evicted in the meantime may have been written back.
+        last = 0
+        while True:
+            rows = self.db.execute(
+                'SELECT row, id FROM %s WHERE row > ? ORDER BY row LIMIT 1000'
+                % self.table, (last,)).fetchall()
+            if len(rows) == 0:
+                return
+            for row, id_ in rows:
+                entry = self.cache.get(id_)
+                if entry is not None:
+                    yield entry[1]
+                    continue
+                item = self._held(id_)
+                if item is not None:
+                    yield item
+                    continue
+                data = self.db.execute(
+                    'SELECT data FROM %s WHERE row = ?' % self.table,
+                    (row,)).fetchone()[0]
+                item = self._load_item(pickle.loads(data))
+                yield self._cache(id_, row, item, data)
+            last = rows[-1][0]
+
+    def list(self):
+        return list(self.iter())
+
+    def keys(self):
+        return [row[0] for row in self.db.execute(
+            'SELECT id FROM %s ORDER BY row' % self.table)]
+
+    def __getitem__(self, item):
+        entry = self.cache.get(item)
+        if entry is not None:
+            self.cache.move_to_end(item)
+            return entry[1]
+        held = self._held(item)
+        if held is not None:
+            return held
+
+        row = self.db.execute(
+            'SELECT row, data FROM %s WHERE id = ?' % self.table,
+            (item,)).fetchone()
+        if row is None:
+            return self._insert(self.new(item))
+        return self._cache(item, row[0], self._load_item(pickle.loads(row[1])), row[1])
+
+    def __contains__(self, item):
+        if item in self.cache:
+            return True
+        return self.db.execute(
+            'SELECT 1 FROM %s WHERE id = ?' % self.table,
+            (item,)).fetchone() is not None
+
+    def dump(self):
+        return [item.dump() for item in self.iter()]
+
+    def restore(self, data):
+        """
+        Replace all records with a dump from the dict backend
+        """
+        self.cache = OrderedDict()
+        self.held = {}
+        self.db.execute('DELETE FROM %s' % self.table)
+        for item in data:
+            self._insert(self._load_item(item))
+
+    @classmethod
+    def load(cls, data):
+        raise TypeError('%s records are loaded from their database' % cls.__name__)
+
+    def __str__(self):
+        return '%d items' % len(self)
+
+    def __len__(self):
+        return self.db.execute(
+            'SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+
+class SQLiteSubjects(SQLiteCollection, Subjects):
+    table = 'subjects'
+    dict_class = Subjects
+    columns = ['gold', 'retired']
+
+    def _values(self, subject):
+        return (subject.gold, subject.retired)
+
+    def _query(self, where):
+        # the indexed columns of cached subjects may be stale
+        self.db.executemany(
+            'UPDATE subjects SET gold = ?, retired = ? WHERE row = ?',
+            [(item.gold, item.retired, row) for row, item, _ in self._in_use()])
+        ids = [row[0] for row in self.db.execute(
+            'SELECT id FROM subjects WHERE %s ORDER BY row' % where)]
+        return self.subset(ids)
+
+    def retired(self):
+        return self._query('retired IN (0, 1)')
+
+    def gold(self):
+        return self._query('gold IN (0, 1)')
+
+    @property
+    def sent(self):
+        return SQLiteSent(self.db)
+
+
+class SQLiteSent:
+    """
+    Score and retirement of subjects as last sent to caesar, in the sent
+    table. Used like the dict of subject id -> (score, retired) of the
+    dict backend.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, id_, default=None):
+        row = self.db.execute(
+            'SELECT score, retired FROM sent WHERE id = ?', (id_,)).fetchone()
+        if row is None:
+            return default
+        return row
+
+    def __getitem__(self, id_):
+        value = self.get(id_)
+        if value is None:
+            raise KeyError(id_)
+        return value
+
+    def __setitem__(self, id_, value):
+        self.update({id_: value})
+
+    def update(self, sent):
+        """
+        Record (score, retired) for each subject id in a dict
+        """
+        self.db.executemany(
+            'INSERT OR REPLACE INTO sent (id, score, retired) VALUES (?, ?, ?)',
+            [(id_, score, retired) for id_, (score, retired) in sent.items()])
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM sent').fetchone()[0]
+
+
+class SQLiteUsers(SQLiteCollection, Users):
+    table = 'users'
+    dict_class = Users
+
+    # whether the positions table covers all user histories, read from
+    # the meta table the first time it is needed
+    _indexed = None
+
+    @property
+    def indexed(self):
+        if self._indexed is None:
+            self._indexed = self.db.execute(
+                'SELECT 1 FROM meta WHERE key = ?',
+                ('positions',)).fetchone() is not None
+        return self._indexed
+
+    def _index_positions(self):
+        """
+        Fill the positions table from the user histories
+        """
+        self.db.execute('DELETE FROM positions')
+        for user in self.iter():
+            self.db.executemany(
+                'INSERT INTO positions (subject, user, position) '
+                'VALUES (?, ?, ?)',
+                [(h[0], user.id, i) for i, h in enumerate(user.history)])
+        self._set_indexed()
+
+    def _set_indexed(self):
+        self.db.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            ('positions', b''))
+        self._indexed = True
+
+    def positions(self, subject):
+        if not self.indexed:
+            self._index_positions()
+        return self.db.execute(
+            'SELECT user, position FROM positions WHERE subject = ? '
+            'ORDER BY rowid', (subject,)).fetchall()
+
+    def classified(self, user, subject):
+        if self.indexed:
+            self.db.execute(
+                'INSERT INTO positions (subject, user, position) '
+                'VALUES (?, ?, ?)',
+                (subject.id, user.id, len(user.history) - 1))
+
+    def truncate(self):
+        super().truncate()
+        self.db.execute('DELETE FROM positions')
+        self._set_indexed()
+
+    def restore(self, data):
+        super().restore(data)
+        self.db.execute('DELETE FROM positions')
+        self.db.execute('DELETE FROM meta WHERE key = ?', ('positions',))
+        self._indexed = False
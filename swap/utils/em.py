@@ -0,0 +1,104 @@
+"""
+Vectorized expectation maximization kernel used by SWAP.offline.
+
+Classifications are passed as parallel int arrays (user index, subject
+index, label, gold) and every sum over classifications is a scatter-add
+with numpy.bincount.
+"""
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def expectation_maximization(
+        users, subjects, labels, golds, confusions, probabilities, p0,
+        unsupervised=False, ignore_gold_status=False,
+        N_min=40, N_max=1000, epsilon_min=1e-8, gamma=1):
+    """
+    Run EM over a set of classifications
+
+    Params
+    ------
+
+    users: user index of each classification
+    subjects: subject index of each classification
+    labels: label of each classification, 1 or 0
+    golds: gold label of the subject of each classification (-1, 0, 1)
+    confusions: starting (PD, PL) of each user, shape (n_users, 2)
+    probabilities: starting score of each subject
+    p0: prior probability used in the E step
+
+    Returns confusions, probabilities, number of steps and the final
+    convergence score
+    """
+    confusions = np.array(confusions, dtype=float)
+    probabilities = np.array(probabilities, dtype=float)
+    n_users = len(confusions)
+    n_subjects = len(probabilities)
+
+    labels = np.asarray(labels)
+    real = labels == 1
+    n_observations = np.bincount(subjects, minlength=n_subjects) \
+        .astype(float)
+
+    # classifications that contribute to the M step, and the ones whose
+    # subject probability is pinned to the gold label
+    if unsupervised:
+        m_mask = np.ones(len(labels), dtype=bool)
+    else:
+        m_mask = golds != -1
+    m_users = users[m_mask]
+    m_subjects = subjects[m_mask]
+    m_labels = labels[m_mask]
+    m_golds = golds[m_mask]
+    if ignore_gold_status:
+        pinned = np.zeros(len(m_golds), dtype=bool)
+    else:
+        pinned = m_golds != -1
+
+    epsilon_taus = 10
+    N_try = 0
+    while (epsilon_taus > epsilon_min) * (N_try < N_max) + (N_try < N_min):
+        # collect old probabilities for assessing convergence
+        old_probabilities = probabilities
+
+        # E step
+        pd = confusions[users, 0]
+        pl = confusions[users, 1]
+        p_real = np.bincount(
+            subjects, np.where(real, pl, 1 - pl) * p0,
+            minlength=n_subjects)
+        p_bogus = np.bincount(
+            subjects, np.where(real, 1 - pd, pd) * (1 - p0),
+            minlength=n_subjects)
+
+        # any subjects with no observations get put back to their prior score
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probabilities = np.where(
+                n_observations > 0,
+                p_real / (p_real + p_bogus) / n_observations,
+                old_probabilities)
+
+        # assess convergence
+        epsilon_taus = np.sum(
+            np.abs(probabilities - old_probabilities) / len(probabilities))
+
+        # M step
+        pi = np.where(pinned, m_golds, probabilities[m_subjects])
+        numer = np.stack([
+            np.bincount(m_users, (1 - m_labels) * (1 - pi),
+                        minlength=n_users),
+            np.bincount(m_users, m_labels * pi, minlength=n_users),
+        ], axis=1)
+        denom = np.stack([
+            np.bincount(m_users, 1 - pi, minlength=n_users),
+            np.bincount(m_users, pi, minlength=n_users),
+        ], axis=1)
+
+        confusions = (gamma + numer) / (2 * gamma + denom)
+
+        N_try += 1
+        logger.debug('EM Step {0} out of max {1}. Convergence Score: {2:.2e}.'.format(N_try, N_max, epsilon_taus))
+
+    return confusions, probabilities, N_try, epsilon_taus
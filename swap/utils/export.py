@@ -0,0 +1,236 @@
+"""
+Columnar exports of subject scores, user skills, classifications and
+score trajectories.
+
+Tables are built as numpy columns, straight from the arrays of the array
+backend or in a single pass over the agents of the other backends, and
+written with pyarrow in record batches:
+
+    .parquet    Parquet file
+    .feather    Feather (Arrow IPC file, lz4 compressed)
+    .arrow      Arrow IPC file, can be memory-mapped when read
+
+pyarrow is optional, install it with ``pip install swap[arrow]``.
+"""
+import csv
+import os
+
+import numpy as np
+
+from swap.utils.columnar import ArrayCollection, compact, confusion_matrices
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ModuleNotFoundError:
+    pa = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+formats = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'arrow',
+    '.csv': 'csv',
+}
+
+# rows per record batch
+batch_size = 1 << 20
+# subjects per batch of the trajectory export
+trajectory_batch_size = 1 << 16
+
+
+def format_of(path):
+    """
+    Export format for a file name, csv when the suffix is not known
+    """
+    return formats.get(os.path.splitext(path)[1].lower(), 'csv')
+
+
+def subject_columns(subjects):
+    """
+    Columns of the subject scores export: id, gold, score, retired (-1
+    when not retired) and seen
+    """
+    if isinstance(subjects, ArrayCollection):
+        table = subjects.table
+        return {
+            'id': compact(table.ids),
+            'gold': table.column('gold').astype(np.int8),
+            'score': table.column('score').astype(np.float64),
+            'retired': table.column('retired').astype(np.int8),
+            'seen': table.column('seen').astype(np.int64),
+        }
+
+    rows = [(s.id, s.gold, s.score, -1 if s.retired is None else s.retired,
+             s.seen) for s in subjects.iter()]
+    ids, gold, score, retired, seen = zip(*rows) if rows else ([],) * 5
+    return {
+        'id': compact(ids),
+        'gold': np.array(gold, dtype=np.int8),
+        'score': np.array(score, dtype=np.float64),
+        'retired': np.array(retired, dtype=np.int8),
+        'seen': np.array(seen, dtype=np.int64),
+    }
+
+
+def user_columns(users):
+    """
+    Columns of the user skills export: id, name, seen and correct counts,
+    and the confusion matrix (PD, PL). Counts are floats, offline EM can
+    make them fractional.
+    """
+    if isinstance(users, ArrayCollection):
+        table = users.table
+        ids = compact(table.ids)
+        names = np.array(table.names, dtype=object)
+        correct = table.column('correct')
+        seen = table.column('seen')
+    else:
+        ids = []
+        names = []
+        correct = []
+        seen = []
+        for user in users.iter():
+            ids.append(user.id)
+            names.append(user.name)
+            correct.append(user.correct)
+            seen.append(user.seen)
+        ids = compact(ids)
+        names = np.array(names, dtype=object)
+        correct = np.array(correct, dtype=np.float64).reshape(-1, 2)
+        seen = np.array(seen, dtype=np.float64).reshape(-1, 3)
+
+    score = confusion_matrices(correct, seen)
+    return {
+        'id': ids,
+        'name': names,
+        'bogus_seen': seen[:, 0].astype(np.float64),
+        'real_seen': seen[:, 1].astype(np.float64),
+        'other_seen': seen[:, 2].astype(np.float64),
+        'bogus_correct': correct[:, 0].astype(np.float64),
+        'real_correct': correct[:, 1].astype(np.float64),
+        'PD': score[:, 0],
+        'PL': score[:, 1],
+    }
+
+
+def classification_batches(classifications, size=None):
+    """
+    Columns of the classification history, in batches of rows: id
+    (-1 when unknown), user, subject and label
+    """
+    if size is None:
+        size = batch_size
+    user_ids = compact(classifications.users.ids)
+    subject_ids = compact(classifications.subjects.ids)
+    n = len(classifications)
+    for a in range(0, max(n, 1), size):
+        b = min(a + size, n)
+        yield {
+            'id': classifications.column('id')[a:b].astype(np.int64),
+            'user': user_ids[classifications.column('user')[a:b]],
+            'subject': subject_ids[classifications.column('subject')[a:b]],
+            'label': classifications.column('label')[a:b].astype(np.int8),
+        }
+
+
+def trajectory_batches(swap, size=None):
+    """
+    Columns of the score trajectories of all subjects, in batches of
+    subjects: subject, n and the score after the first n classifications
+    of the subject. Trajectories are read through SWAP.trajectories, and
+    so from its trajectory cache.
+    """
+    if size is None:
+        size = trajectory_batch_size
+    keys = swap.subjects.keys()
+    # compacted at once, so the column has the same type in every batch
+    all_ids = compact(keys)
+    for a in range(0, max(len(keys), 1), size):
+        ids = keys[a:a + size]
+        offsets, scores = swap.trajectories([swap.subjects[i] for i in ids])
+        lengths = np.diff(offsets)
+        yield {
+            'subject': np.repeat(all_ids[a:a + size], lengths),
+            'n': np.arange(1, len(scores) + 1) - np.repeat(offsets[:-1], lengths),
+            'score': scores,
+        }
+
+
+def batches(columns, size=None):
+    """
+    Split a dict of columns into batches of rows
+    """
+    if size is None:
+        size = batch_size
+    n = len(next(iter(columns.values())))
+    for a in range(0, max(n, 1), size):
+        yield {name: column[a:a + size] for name, column in columns.items()}
+
+
+def _array(column):
+    if column.dtype != object:
+        return pa.array(column)
+    # compact leaves ids as objects when they mix numeric ids and names
+    # of logged out users, and names are objects too. They are written as
+    # strings, so every batch of a column has the same type whatever ids
+    # it holds.
+    return pa.array([None if v is None else str(v) for v in column.tolist()],
+                    type=pa.string())
+
+
+def write(path, column_batches, format=None):
+    """
+    Write batches of columns to a file
+
+    format: 'parquet', 'feather', 'arrow' or 'csv', by default from the
+            suffix of path
+    """
+    if format is None:
+        format = format_of(path)
+    if format == 'csv':
+        return write_csv(path, column_batches)
+    if pa is None:
+        raise ImportError(
+            'Exporting %s needs pyarrow, install it with '
+            'pip install swap[arrow]' % format)
+
+    writer = None
+    try:
+        for columns in column_batches:
+            batch = pa.record_batch(
+                [_array(c) for c in columns.values()], names=list(columns))
+            if writer is None:
+                writer = _writer(path, batch.schema, format)
+            if format == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _writer(path, schema, format):
+    if format == 'parquet':
+        return pq.ParquetWriter(path, schema)
+    if format == 'feather':
+        options = pa.ipc.IpcWriteOptions(compression='lz4')
+        return pa.ipc.new_file(path, schema, options=options)
+    if format == 'arrow':
+        return pa.ipc.new_file(path, schema)
+    raise ValueError('Unknown export format %s' % format)
+
+
+def write_csv(path, column_batches):
+    with open(path, 'w') as file:
+        writer = csv.writer(file, delimiter=',')
+        header = False
+        for columns in column_batches:
+            if not header:
+                writer.writerow(list(columns))
+                header = True
+            writer.writerows(zip(*[c.tolist() for c in columns.values()]))
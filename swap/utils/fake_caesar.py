@@ -0,0 +1,111 @@
+"""
+In-process stand-in for caesar_external, for trying the online mode
+without the live service.
+
+Offers the parts of the caesar_external interface that swap uses
+(Config.load, Config.instance().save, Extractor.next and Reducer.reduce).
+Classifications to hand out are queued with Extractor.feed, and the
+reducer keeps the last reduction of every subject. Request latency,
+random failures and a request size limit can be set on the Reducer to
+see how sending behaves against a slow or flaky service.
+
+Use it with::
+
+    from swap.utils import fake_caesar
+    from swap.utils.online import Online
+    Online.caesar = fake_caesar
+"""
+import random
+import threading
+import time
+from collections import deque
+
+
+class Config:
+    _instance = None
+
+    def __init__(self, name):
+        self.name = name
+        self.saves = 0
+
+    @classmethod
+    def load(cls, name):
+        cls._instance = cls(name)
+        return cls._instance
+
+    @classmethod
+    def instance(cls):
+        return cls._instance
+
+    def save(self):
+        self.saves += 1
+
+
+class Extractor:
+    """
+    Queue of classification batches, each a list of dicts with user,
+    subject, annotations and id keys
+
+    latency: seconds per call to next
+    """
+    queue = deque()
+    latency = 0.
+
+    @classmethod
+    def feed(cls, items):
+        cls.queue.append(list(items))
+
+    @classmethod
+    def next(cls):
+        time.sleep(cls.latency)
+        if len(cls.queue) == 0:
+            return []
+        return cls.queue.popleft()
+
+
+class Reducer:
+    """
+    Records reductions in memory
+
+    latency: seconds per request
+    latency_per_item: extra seconds per reduction in a request
+    failure_rate: probability that a request raises ConnectionError
+    max_batch: largest number of reductions accepted in one request
+    """
+    latency = 0.
+    latency_per_item = 0.
+    failure_rate = 0.
+    max_batch = None
+
+    reductions = {}
+    requests = 0
+    failures = 0
+    _lock = threading.Lock()
+    _random = random.Random(0)
+
+    @classmethod
+    def reset(cls, latency=0., latency_per_item=0., failure_rate=0.,
+              max_batch=None, seed=0):
+        cls.latency = latency
+        cls.latency_per_item = latency_per_item
+        cls.failure_rate = failure_rate
+        cls.max_batch = max_batch
+        cls.reductions = {}
+        cls.requests = 0
+        cls.failures = 0
+        cls._random = random.Random(seed)
+
+    @classmethod
+    def reduce(cls, data):
+        data = list(data)
+        time.sleep(cls.latency + cls.latency_per_item * len(data))
+        with cls._lock:
+            cls.requests += 1
+            if cls.max_batch is not None and len(data) > cls.max_batch:
+                cls.failures += 1
+                raise ValueError('Request too large: %d reductions' % len(data))
+            if cls._random.random() < cls.failure_rate:
+                cls.failures += 1
+                raise ConnectionError('Simulated reducer failure')
+            for subject, reduction in data:
+                cls.reductions[subject] = reduction
@@ -0,0 +1,225 @@
+"""
+Chunked ingestion of Panoptes classification dumps.
+
+Reads only the columns swap needs, in blocks of rows, and parses each
+distinct annotation string once per block. Each block is handed over as
+arrays of (user, subject, label, classification_id) for SWAP.classify_many.
+"""
+import csv
+import numpy as np
+
+from swap.utils.parser import AnnotationParser
+import swap.utils.metrics as metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+columns = ['user_id', 'user_name', 'subject_ids', 'annotations',
+           'classification_id']
+
+
+class Chunk:
+    """
+    Block of parsed classifications as parallel arrays
+    """
+
+    def __init__(self, users, subjects, labels, ids, skipped=0):
+        self.users = users
+        self.subjects = subjects
+        self.labels = labels
+        self.ids = ids
+        self.skipped = skipped
+
+    @classmethod
+    def build(cls, users, subjects, labels, ids, skipped=0):
+        """
+        Build a chunk from python lists
+        """
+        if all(type(user) is int for user in users):
+            users = np.array(users, dtype=np.int64)
+        else:
+            # not-logged-in users are identified by name
+            users = np.array(users, dtype=object)
+        return cls(
+            users,
+            np.array(subjects, dtype=np.int64),
+            np.array(labels, dtype=np.int8),
+            np.array(ids, dtype=np.int64),
+            skipped)
+
+    @classmethod
+    def concatenate(cls, chunks):
+        chunks = list(chunks)
+        if len(chunks) == 0:
+            return cls.build([], [], [], [])
+        users = [c.users for c in chunks]
+        if any(u.dtype == object for u in users):
+            users = [u.astype(object) for u in users]
+        return cls(
+            np.concatenate(users),
+            np.concatenate([c.subjects for c in chunks]),
+            np.concatenate([c.labels for c in chunks]),
+            np.concatenate([c.ids for c in chunks]),
+            sum(c.skipped for c in chunks))
+
+    def take(self, index):
+        """
+        Chunk of the classifications at the positions in index
+        """
+        return Chunk(self.users[index], self.subjects[index],
+                     self.labels[index], self.ids[index])
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class RowParser:
+    """
+    Turns raw csv rows into chunks, caching parsed annotations
+    """
+
+    def __init__(self, config, header):
+        self.annotation = AnnotationParser(config)
+        self.cache = {}
+        self.index = [header.index(c) for c in columns]
+
+    def parse_annotation(self, annotation):
+        try:
+            return self.cache[annotation]
+        except KeyError:
+            value = self.annotation.parse(annotation)
+            self.cache[annotation] = value
+            return value
+
+    def __call__(self, rows):
+        with metrics.timer('parse', rows=len(rows)) as timer:
+            chunk = self._parse(rows)
+            timer.add(skipped=chunk.skipped)
+        metrics.count('classifications_parsed', len(rows))
+        metrics.count('classifications_skipped', chunk.skipped)
+        return chunk
+
+    def _parse(self, rows):
+        i_user, i_name, i_subject, i_annotation, i_id = self.index
+        users = []
+        subjects = []
+        labels = []
+        ids = []
+        skipped = 0
+        for row in rows:
+            label = self.parse_annotation(row[i_annotation])
+            if label is None:
+                logger.error('Skipping classification %s', row[i_id])
+                skipped += 1
+                continue
+
+            user = row[i_user]
+            if user == '':
+                user = row[i_name]
+            else:
+                user = int(user)
+
+            users.append(user)
+            subjects.append(int(row[i_subject]))
+            labels.append(label)
+            ids.append(int(row[i_id]))
+
+        return Chunk.build(users, subjects, labels, ids, skipped)
+
+
+def read_classifications(path, config, chunksize=100000):
+    """
+    Read a classification dump in chunks of chunksize rows
+
+    Yields a Chunk per block of rows
+    """
+    with open(path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        parser = RowParser(config, next(reader))
+
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == chunksize:
+                yield parser(rows)
+                rows = []
+        if len(rows) > 0:
+            yield parser(rows)
+
+
+def _parse_range(args):
+    """
+    Parse the rows that start inside the byte range [start, end)
+    """
+    path, config, header, start, end = args
+    parser = RowParser(config, header)
+
+    lines = []
+    with open(path, 'rb') as file:
+        file.seek(start - 1)
+        # skip the rest of a row that started in the previous range
+        file.readline()
+        position = file.tell()
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            lines.append(line.decode('utf-8'))
+            position += len(line)
+
+    return parser(list(csv.reader(lines)))
+
+
+def byte_ranges(path, n):
+    """
+    Split the body of a csv file into n byte ranges
+
+    Returns the header and a list of (start, end) offsets
+    """
+    with open(path, 'rb') as file:
+        header_line = file.readline()
+        first = file.tell()
+        file.seek(0, 2)
+        size = file.tell()
+
+    header = next(csv.reader([header_line.decode('utf-8')]))
+    bounds = np.linspace(first, size, n + 1).astype(np.int64).tolist()
+    ranges = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    return header, ranges
+
+
+def read_classifications_parallel(path, config, workers, chunksize=100000):
+    """
+    Parse a classification dump with a pool of worker processes
+
+    The file is split into byte ranges of roughly chunksize rows' worth
+    of bytes, and each range is parsed by a worker. The parsed arrays are
+    then sorted by classification_id (stably) and yielded in chunks of
+    chunksize, so the result is the same as read_classifications for
+    dumps in classification_id order, which Panoptes exports are. All
+    ranges are parsed before the first chunk is yielded. Rows must not
+    contain raw newlines inside quoted fields, which holds for Panoptes
+    exports.
+    """
+    import multiprocessing
+    import os
+
+    # estimate the number of ranges from the average row length of the
+    # first rows of the file
+    with open(path, 'rb') as file:
+        file.readline()
+        sample = file.readlines(1 << 20)
+    row_bytes = max(1, sum(len(line) for line in sample) // max(1, len(sample)))
+    n = max(workers, os.path.getsize(path) // (row_bytes * chunksize) + 1)
+
+    header, ranges = byte_ranges(path, n)
+    tasks = [(path, config, header, start, end) for start, end in ranges]
+    with multiprocessing.Pool(workers) as pool:
+        parsed = Chunk.concatenate(pool.imap(_parse_range, tasks))
+
+    order = np.argsort(parsed.ids, kind='stable')
+    for i in range(0, len(order), chunksize):
+        chunk = parsed.take(order[i:i + chunksize])
+        if i == 0:
+            chunk.skipped = parsed.skipped
+        yield chunk
@@ -0,0 +1,108 @@
+"""
+Append-only journal of the operations applied to a SWAP instance.
+
+SWAP.save appends the operations since the last save to the journal and
+only writes a full snapshot once the journal grows past
+Config.snapshot_interval records. SWAP.load reads the latest snapshot and
+replays the journal records that came after it.
+"""
+import os
+import pickle
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(path, data):
+    """
+    Pickle data to path by writing a temporary file and renaming it, so a
+    crash never leaves a half written file behind
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+
+
+class Journal:
+    """
+    File of (sequence number, record) pickles
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        self.size = 0
+
+        # find the last sequence number, and cut off a record that was
+        # only partially written
+        end = 0
+        for seq, _, offset in self._read():
+            self.seq = seq
+            self.size += 1
+            end = offset
+        if os.path.isfile(path) and os.path.getsize(path) > end:
+            logger.warning('Truncating incomplete journal record in %s', path)
+            with open(path, 'r+b') as file:
+                file.truncate(end)
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as file:
+            while True:
+                try:
+                    seq, record = pickle.load(file)
+                except (EOFError, pickle.UnpicklingError,
+                        ValueError, TypeError, AttributeError):
+                    return
+                yield seq, record, file.tell()
+
+    def append(self, records):
+        """
+        Append records and sync them to disk
+        """
+        if len(records) == 0:
+            return
+        with open(self.path, 'ab') as file:
+            for record in records:
+                self.seq += 1
+                pickle.dump((self.seq, record), file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        self.size += len(records)
+
+    def replay(self, after=0):
+        """
+        Iterate over the records with a sequence number larger than after
+        """
+        for seq, record, _ in self._read():
+            if seq > after:
+                yield record
+
+    def compact(self, seq):
+        """
+        Drop the records up to and including seq, they are covered by a
+        snapshot
+        """
+        records = [(s, r) for s, r, _ in self._read() if s > seq]
+        if len(records) == 0:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+            self.size = 0
+            return
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as file:
+            for record in records:
+                pickle.dump(record, file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
+        self.size = len(records)
+
+    def __len__(self):
+        return self.size
@@ -0,0 +1,210 @@
+"""
+Timers and counters for the phases of a SWAP run.
+
+Instrumented code wraps a phase in ``with metrics.timer('name'):`` and
+counts events with ``metrics.count('name', n)``. Both do nothing until
+metrics are enabled, which SWAP does when config.metrics is set, so the
+calls can stay in hot paths.
+
+When enabled, every timed phase is logged by this module's logger as one
+line of JSON::
+
+    {"metric": "score_subjects", "seconds": 0.412, "subjects": 20000, ...}
+
+and the totals can be written as a Prometheus text file, for the
+textfile collector of a node exporter::
+
+    swap_phase_seconds_sum{phase="score_subjects"} 12.3
+    swap_phase_seconds_count{phase="score_subjects"} 30
+    swap_events_total{event="classifications_ingested"} 1200000
+"""
+import json
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+enabled = False
+# log a line of JSON for every timed phase
+log = True
+
+# name -> [count, total seconds, last seconds, max seconds]
+timers = {}
+# name -> total
+counters = {}
+_lock = threading.Lock()
+
+
+class _Null:
+    """
+    Timer handed out while metrics are disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **fields):
+        pass
+
+
+_null = _Null()
+
+
+class Timer:
+    """
+    Times a with block, and records it under name when the block exits.
+    Fields are added to the JSON log line.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.fields)
+        return False
+
+    def add(self, **fields):
+        """
+        Add fields that are only known inside the block
+        """
+        self.fields.update(fields)
+
+
+def enable(log_phases=True):
+    global enabled, log
+    enabled = True
+    log = log_phases
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        timers.clear()
+        counters.clear()
+
+
+def timer(name, **fields):
+    """
+    Context manager timing a phase
+    """
+    if not enabled:
+        return _null
+    return Timer(name, fields)
+
+
+def count(name, n=1):
+    """
+    Add n to a counter
+    """
+    if not enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def observe(name, seconds, **fields):
+    """
+    Record a phase that took seconds
+    """
+    if not enabled:
+        return
+    with _lock:
+        stats = timers.get(name)
+        if stats is None:
+            stats = timers[name] = [0, 0., 0., 0.]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = seconds
+        stats[3] = max(stats[3], seconds)
+    if log and logger.isEnabledFor(logging.INFO):
+        fields.update(metric=name, seconds=round(seconds, 6),
+                      time=round(time.time(), 3))
+        logger.info(json.dumps(fields, default=str))
+
+
+def snapshot():
+    """
+    Copy of the timers and counters, as a dict
+    """
+    with _lock:
+        return {
+            'timers': {
+                name: {'count': s[0], 'seconds': s[1], 'last': s[2],
+                       'max': s[3]}
+                for name, s in timers.items()},
+            'counters': dict(counters),
+        }
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+    return ','.join('%s="%s"' % (k, escape(v)) for k, v in labels.items())
+
+
+def prometheus(labels=None):
+    """
+    Timers and counters in the Prometheus text format
+
+    labels: dict of labels added to every sample
+    """
+    labels = labels or {}
+    data = snapshot()
+    lines = []
+
+    def family(name, kind, help_, samples):
+        if len(samples) == 0:
+            return
+        lines.append('# HELP %s %s' % (name, help_))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample, extra, value in samples:
+            if not isinstance(value, int):
+                value = float(value)
+            lines.append('%s{%s} %r' % (
+                sample, _labels(dict(labels, **extra)), value))
+
+    phases = sorted(data['timers'].items())
+    family('swap_phase_seconds', 'summary', 'Time spent in each phase', [
+        (name, {'phase': phase}, stats[field])
+        for phase, stats in phases
+        for name, field in [('swap_phase_seconds_sum', 'seconds'),
+                            ('swap_phase_seconds_count', 'count')]])
+    family('swap_phase_last_seconds', 'gauge',
+           'Duration of the last run of each phase', [
+               ('swap_phase_last_seconds', {'phase': phase}, stats['last'])
+               for phase, stats in phases])
+    family('swap_phase_max_seconds', 'gauge',
+           'Longest run of each phase', [
+               ('swap_phase_max_seconds', {'phase': phase}, stats['max'])
+               for phase, stats in phases])
+    family('swap_events_total', 'counter', 'Number of events', [
+        ('swap_events_total', {'event': event}, value)
+        for event, value in sorted(data['counters'].items())])
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, labels=None):
+    """
+    Write the metrics to a Prometheus text file. The file is replaced in
+    one rename, so a scrape never reads half of it.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as file:
+        file.write(prometheus(labels))
+    os.replace(tmp, path)
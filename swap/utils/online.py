@@ -1,10 +1,15 @@
 
 from swap.utils.parser import AnnotationParser
+import swap.utils.metrics as metrics
 try:
     import caesar_external as ce
 except ModuleNotFoundError:
-    pass
+    ce = None
 import sys
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,21 +17,167 @@ logger = logging.getLogger(__name__)
 
 class Online:
 
+    # module providing Extractor and Reducer, swap.utils.fake_caesar can
+    # stand in for caesar_external
+    caesar = ce
+
     @staticmethod
-    def send(swap):
-        logger.debug('Sending data')
+    def changes(swap, full=False):
+        """
+        Reductions for the subjects whose retirement changed, or whose
+        score moved by at least config.online_min_delta, since they were
+        last sent
+
+        full: (bool) Include every subject
+
+        Returns the reductions, the (subject id, score, retired) of the
+        subjects in them, and the ids of all subjects that were checked
+        """
+        min_delta = swap.config.online_min_delta
+        if full:
+            checked = swap.subjects.keys()
+        else:
+            checked = list(swap.unsent)
+
         data = []
-        for subject in swap.subjects.iter():
-            data.append((subject.id, {'score': subject.score}))
+        sent = []
+        for id_ in checked:
+            subject = swap.subjects[id_]
+            score = subject.score
+            retired = subject.retired
+            last = swap.sent.get(id_)
+            if not full and last is not None and last[1] == retired and \
+                    (score == last[0] or abs(score - last[0]) < min_delta):
+                continue
+            data.append((id_, {'score': score}))
+            sent.append((id_, score, retired))
+        return data, sent, checked
+
+    @staticmethod
+    def batches(data, size):
+        """
+        Split reductions into batches of at most size items
+        """
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    @classmethod
+    def reduce(cls, batch, retries=3, backoff=1.):
+        """
+        Send one batch of reductions, retrying with exponential backoff
 
-        ce.Reducer.reduce(data)
+        Returns None on success, or the last exception
+        """
+        for attempt in range(retries + 1):
+            metrics.count('online_requests')
+            try:
+                cls.caesar.Reducer.reduce(batch)
+                return None
+            except Exception as e:
+                metrics.count('online_request_errors')
+                error = e
+                if attempt < retries:
+                    delay = backoff * 2 ** attempt * random.uniform(.5, 1)
+                    logger.warning('Sending %d reductions failed (%s), retrying in %.1fs',
+                                   len(batch), e, delay)
+                    time.sleep(delay)
+        return error
+
+    @classmethod
+    def submit(cls, batches, workers=4, retries=3, backoff=1.):
+        """
+        Send batches of reductions from a pool of threads
+
+        Returns the errors of the batches that failed after all retries,
+        None for the ones that were sent
+        """
+        if len(batches) == 0:
+            return []
+        if workers <= 1 or len(batches) == 1:
+            return [cls.reduce(b, retries, backoff) for b in batches]
+        with ThreadPoolExecutor(min(workers, len(batches))) as pool:
+            return list(pool.map(
+                lambda b: cls.reduce(b, retries, backoff), batches))
+
+    @classmethod
+    def prepare(cls, swap, full=None):
+        """
+        Collect the reductions to send, split into batches of
+        config.online_batch_size
+
+        full: (bool) Send every subject. By default every
+              config.online_resync-th send is a full one
+
+        Returns the batches and what to pass on to Online.finish
+        """
+        config = swap.config
+        if full is None:
+            resync = config.online_resync
+            full = resync > 0 and swap.sends % resync == 0
+
+        data, sent, checked = cls.changes(swap, full)
+        batches = cls.batches(data, config.online_batch_size)
+        logger.debug('Sending %d of %d subjects in %d batches%s', len(data),
+                     len(swap.subjects), len(batches),
+                     ' (full resync)' if full else '')
+        return batches, (sent, checked)
 
     @staticmethod
-    def receive(swap):
+    def finish(swap, batches, errors, sent, checked):
+        """
+        Record the subjects that were sent. Subjects in batches that could
+        not be sent stay marked as changed and are sent again next time.
+
+        Returns the number of batches that failed
+        """
+        failed = set()
+        for batch, error in zip(batches, errors):
+            if error is not None:
+                logger.error('Could not send %d reductions: %s', len(batch), error)
+                failed.update(id_ for id_, _ in batch)
+        if len(failed) > 0:
+            sent = [s for s in sent if s[0] not in failed]
+            checked = [id_ for id_ in checked if id_ not in failed]
+        swap.mark_sent(sent, checked)
+        return sum(error is not None for error in errors)
+
+    @classmethod
+    def send(cls, swap, full=None):
+        """
+        Send the reductions that changed since the last send to caesar
+
+        Reductions are sent in batches of config.online_batch_size by
+        config.online_workers threads.
+
+        full: (bool) Send every subject. By default every
+              config.online_resync-th send is a full one
+
+        Returns the number of batches that failed
+        """
         config = swap.config
-        parser = AnnotationParser(config)
+        with metrics.timer('online_send') as timer:
+            batches, args = cls.prepare(swap, full)
+            errors = cls.submit(batches, config.online_workers,
+                                config.online_retries, config.online_backoff)
+            failed = cls.finish(swap, batches, errors, *args)
+            timer.add(batches=len(batches), failed=failed)
+        return failed
+
+    @staticmethod
+    def fetch():
+        """
+        Next batch of classifications from the extractor, as a list
+        """
+        return list(Online.caesar.Extractor.next())
+
+    @staticmethod
+    def classify(swap, data):
+        """
+        Parse and classify a batch of extracted classifications
+
+        Returns True if the batch had any items
+        """
+        parser = AnnotationParser(swap.config)
 
-        data = ce.Extractor.next()
         haveItems = False
         for i, item in enumerate(data):
             logger.debug('Received annotation: Type ({}): {}'.format(type(item['annotations']), item['annotations']))
@@ -47,8 +198,218 @@ class Online:
             logger.debug('Received classification: {}'.format(cl))
 
             swap.classify(**cl)
+        return haveItems
 
-        if haveItems:
-            swap()
-            swap.retire()
+    @staticmethod
+    def receive(swap):
+        config = swap.config
+        with metrics.timer('online_receive') as timer:
+            data = Online.fetch()
+            haveItems = Online.classify(swap, data)
+            if haveItems:
+                swap()
+                swap.retire(config.p_retire_dud, config.p_retire_lens)
+            timer.add(classifications=len(data))
         return swap, haveItems
+
+
+class Stage:
+    """
+    Latency of one stage of the online pipeline
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.last = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def __str__(self):
+        return 'mean %.3fs last %.3fs max %.3fs (%d)' % \
+            (self.mean, self.last, self.max, self.count)
+
+
+class Pipeline:
+    """
+    Continuous online mode, with fetching, scoring, saving and sending
+    overlapped
+
+    Each cycle classifies the batch that was fetched, checkpoints swap and
+    the extractor position, and then scores the batch while the next one
+    is fetched. Reductions are sent in the background while the next
+    batch is fetched, classified and checkpointed, and the send is
+    recorded before that batch is scored, so swap is only ever changed
+    from the event loop or the one scoring or saving task. With
+    config.checkpoint 'fork', the send is recorded before the checkpoint
+    instead, which is taken from the event loop while no other stage
+    runs.
+
+    When nothing was fetched, the next fetch waits config.online_idle_min
+    seconds, doubling up to config.online_idle_max while the extractor
+    stays empty.
+
+    The latency of every stage is kept in stats, recorded as the
+    online_<stage> phase of swap.utils.metrics, and logged every
+    config.online_stats_interval cycles:
+        fetch: extractor call, wait: time the loop waited for a fetch,
+        idle: backoff sleeps, classify, save, score (including retire),
+        send: submitting all batches, cycle: a cycle with data
+    """
+    stages = ['fetch', 'wait', 'idle', 'classify', 'save',
+              'score', 'send', 'cycle']
+
+    def __init__(self, swap):
+        self.swap = swap
+        self.config = swap.config
+        # one thread each for fetching, sending, and scoring or saving
+        self.executor = ThreadPoolExecutor(3)
+        self.stats = {name: Stage() for name in self.stages}
+        self.cycles = 0
+        self.idle = self.config.online_idle_min
+
+        self.fetching = None
+        # scoring or saving task
+        self.busy = None
+        # (future, batches, args for Online.finish)
+        self.sending = None
+
+    def _record(self, stage, seconds):
+        self.stats[stage].add(seconds)
+        metrics.observe('online_' + stage, seconds)
+
+    def _timed(self, stage, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self._record(stage, time.perf_counter() - start)
+
+    def _submit(self, stage, function, *args):
+        return self.executor.submit(self._timed, stage, function, *args)
+
+    def checkpoint(self):
+        """
+        Save swap, and then the extractor position, so the position never
+        runs ahead of the saved classifications. With config.checkpoint
+        'fork', snapshots of the journal are written in the background.
+        """
+        self.swap.save(background=self.config.checkpoint == 'fork')
+        caesar_config = getattr(Online.caesar, 'Config', None)
+        if caesar_config is not None and caesar_config.instance() is not None:
+            caesar_config.instance().save()
+
+    def score(self):
+        config = self.config
+        self.swap()
+        self.swap.retire(config.p_retire_dud, config.p_retire_lens)
+
+    def fetch(self):
+        self.fetching = self._submit('fetch', Online.fetch)
+
+    def send(self):
+        config = self.config
+        batches, args = Online.prepare(self.swap)
+        future = self._submit(
+            'send', Online.submit, batches, config.online_workers,
+            config.online_retries, config.online_backoff)
+        self.sending = (future, batches, args)
+
+    def finish_send(self):
+        """
+        Record the result of the send in flight, blocks until it is done
+        """
+        if self.sending is None:
+            return
+        future, batches, args = self.sending
+        self.sending = None
+        if future.cancelled():
+            # never started, the subjects stay unsent
+            return
+        Online.finish(self.swap, batches, future.result(), *args)
+
+    async def _await_send(self):
+        if self.sending is not None:
+            await asyncio.wrap_future(self.sending[0])
+            self.finish_send()
+
+    async def _await(self, future):
+        self.busy = future
+        result = await asyncio.wrap_future(future)
+        self.busy = None
+        return result
+
+    async def cycle(self, data):
+        start = time.perf_counter()
+        self._timed('classify', Online.classify, self.swap, data)
+        if self.config.checkpoint == 'fork':
+            # snapshots are forked from this thread, with the send in
+            # flight finished so no other thread is running
+            await self._await_send()
+            self._timed('save', self.checkpoint)
+        else:
+            await self._await(self._submit('save', self.checkpoint))
+
+        self.fetch()
+        await self._await_send()
+        await self._await(self._submit('score', self.score))
+        self.send()
+        self._record('cycle', time.perf_counter() - start)
+
+        self.cycles += 1
+        if self.cycles % self.config.online_stats_interval == 0:
+            self.log_stats()
+
+    async def run(self):
+        """
+        Run until cancelled
+        """
+        self.fetch()
+        while True:
+            start = time.perf_counter()
+            data = await asyncio.wrap_future(self.fetching)
+            self.fetching = None
+            self._record('wait', time.perf_counter() - start)
+
+            if len(data) == 0:
+                await asyncio.sleep(self.idle)
+                self._record('idle', self.idle)
+                self.idle = min(self.idle * 2, self.config.online_idle_max)
+                self.fetch()
+                continue
+
+            self.idle = self.config.online_idle_min
+            await self.cycle(data)
+
+    def close(self):
+        """
+        Wait for the tasks in flight, classify a batch that was already
+        fetched, and save
+        """
+        if self.busy is not None and not self.busy.cancelled():
+            self.busy.result()
+            self.busy = None
+        if self.fetching is not None and not self.fetching.cancelled():
+            data = self.fetching.result()
+            self.fetching = None
+            if Online.classify(self.swap, data):
+                self.finish_send()
+                self.score()
+        self.finish_send()
+        self.checkpoint()
+        self.swap.flush()
+        self.executor.shutdown()
+        self.log_stats()
+
+    def log_stats(self):
+        for name in self.stages:
+            logger.info('%-8s %s', name, self.stats[name])
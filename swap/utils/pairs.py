@@ -0,0 +1,164 @@
+"""
+Compact set of (user, subject) pairs used to ignore repeat classifications.
+
+Users and subjects get dense indices and each pair is packed into one
+64-bit key. Keys live in a sorted numpy array, with new keys collected in
+a small python set that is merged into the array once it grows past a
+fraction of it.
+"""
+import numpy as np
+
+from swap.utils.columnar import IdIndex, MappedList, compact
+
+
+class PairSet:
+
+    # merge the buffer once it holds this many keys, or 1/16 of the keys
+    # in the sorted array, whichever is larger
+    merge_min = 1 << 16
+
+    def __init__(self, users=None, subjects=None, keys=None):
+        if users is None:
+            users = IdIndex()
+        if subjects is None:
+            subjects = IdIndex()
+        if keys is None:
+            keys = np.zeros(0, dtype=np.int64)
+
+        self.users = users
+        self.subjects = subjects
+        self.keys = keys
+        self.buffer = set()
+
+    @staticmethod
+    def pack(users, subjects):
+        return (users << 32) | subjects
+
+    def _key(self, user, subject):
+        return (self.users.add(user) << 32) | self.subjects.add(subject)
+
+    def _in_keys(self, keys):
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        i = np.searchsorted(self.keys, keys)
+        i = np.minimum(i, len(self.keys) - 1)
+        return self.keys[i] == keys
+
+    def _has_key(self, key):
+        if key in self.buffer:
+            return True
+        keys = self.keys
+        i = keys.searchsorted(key)
+        return i < len(keys) and keys[i] == key
+
+    def __contains__(self, pair):
+        user, subject = pair
+        if user not in self.users or subject not in self.subjects:
+            return False
+        return self._has_key(self._key(user, subject))
+
+    def add(self, user, subject):
+        """
+        Add a pair, returns True if it was not in the set yet
+        """
+        key = self._key(user, subject)
+        if self._has_key(key):
+            return False
+
+        self.buffer.add(key)
+        self._maybe_merge()
+        return True
+
+    def contains_many(self, users, subjects):
+        """
+        Boolean array marking which pairs are already in the set
+        """
+        keys = self.pack(self.users.add_many(users),
+                         self.subjects.add_many(subjects))
+        return self._contains_keys(keys)
+
+    def _contains_keys(self, keys):
+        found = self._in_keys(keys)
+        if len(self.buffer) > 0:
+            buffer = np.sort(np.fromiter(self.buffer, dtype=np.int64,
+                                         count=len(self.buffer)))
+            i = np.minimum(np.searchsorted(buffer, keys), len(buffer) - 1)
+            found |= buffer[i] == keys
+        return found
+
+    def add_many(self, users, subjects):
+        """
+        Add a batch of pairs
+
+        Returns a boolean array marking the pairs that were new, only the
+        first occurrence of a pair repeated within the batch counts as new
+        """
+        keys = self.pack(self.users.add_many(users),
+                         self.subjects.add_many(subjects))
+
+        new = ~self._contains_keys(keys)
+
+        # first occurrence of each key within the batch
+        order = np.argsort(keys, kind='stable')
+        ordered = keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = ordered[1:] != ordered[:-1]
+        unique = np.zeros(len(keys), dtype=bool)
+        unique[order[first]] = True
+        new &= unique
+
+        self.buffer.update(keys[new].tolist())
+        self._maybe_merge()
+        return new
+
+    def _maybe_merge(self):
+        if len(self.buffer) >= max(self.merge_min, len(self.keys) >> 4):
+            self.merge()
+
+    def merge(self):
+        """
+        Move the buffered keys into the sorted array
+        """
+        if len(self.buffer) == 0:
+            return
+        buffer = np.fromiter(self.buffer, dtype=np.int64,
+                             count=len(self.buffer))
+        self.keys = np.sort(np.concatenate([self.keys, buffer]))
+        self.buffer = set()
+
+    def __len__(self):
+        return len(self.keys) + len(self.buffer)
+
+    def dump(self):
+        self.merge()
+        # keys are sorted by user, so store the number of pairs per user
+        # and the 32-bit subject index of each pair
+        counts = np.bincount(self.keys >> 32, minlength=len(self.users))
+        return {
+            'users': compact(self.users.ids),
+            'subjects': compact(self.subjects.ids),
+            'counts': counts.astype(np.int32),
+            'pairs': (self.keys & 0xffffffff).astype(np.uint32),
+        }
+
+    @classmethod
+    def load(cls, data):
+        if 'pairs' in data:
+            users = np.repeat(np.arange(len(data['counts']), dtype=np.int64),
+                              data['counts'])
+            keys = cls.pack(users, data['pairs'].astype(np.int64))
+            return cls(IdIndex(MappedList(data['users'])),
+                       IdIndex(MappedList(data['subjects'])),
+                       keys)
+
+        # old format, a dict with (user, subject) keys
+        pairs = cls()
+        pairs.add_many([user for user, _ in data],
+                       [subject for _, subject in data])
+        return pairs
+
+    def __str__(self):
+        return '%d pairs' % len(self)
+
+    def __repr__(self):
+        return str(self)
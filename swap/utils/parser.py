@@ -1,5 +1,7 @@
 
 import json
+
+import swap.utils.metrics as metrics
 import logging
 logger = logging.getLogger(__name__)
 
@@ -19,6 +21,7 @@ class ClassificationParser:
         annotation = self.annotation.parse(cl['annotations'])
         if annotation is None:
             logger.error('Skipping classification %s', cl)
+            metrics.count('classifications_skipped')
             return None
         return {
             'user': user,
@@ -9,43 +9,35 @@ def thresholds_setting():
     p_bogus = 0.4
     return [p_real,p_bogus]
 
-def trajectory_plot(swap, path=None, subjects=200, logy=True):
+def trajectory_plot(swap, path=None, subjects=1000, logy=True):
+    """
+    Plot the score trajectories of subjects
+
+    subjects: number of subjects to draw at random, or a list of subject
+              ids
+    """
     import logging
     logging.getLogger('matplotlib').setLevel(logging.WARNING)
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import to_rgba_array
     import matplotlib.patches as mpatches
     import matplotlib.pyplot as plt
     import numpy as np
-    import logging
     logging.getLogger('matplotlib.font_manager').disabled = True
     logging.getLogger('matplotlib.ticker').disabled = True
     logging.getLogger('matplotlib').disabled = True
     logging.getLogger('matplotlib.matplotlib.loaded modules').disabled = True
     # get subjects
-    # max_seen is set by subject with max number of classifications
-    max_seen = 1
-    subjects_final = []
-    subjects=1000
     if type(subjects) == int:
-        # draw random numbers
-        while len(subjects_final) < subjects:
-            # note that there can be duplication.
-            indx = np.random.choice(len(swap.subjects.keys()))
-            subject = swap.subjects[swap.subjects.keys()[indx]]
-
-            # if subject.seen < 3:
-            #     continue
-
-            subjects_final.append(subject)
-            if subject.seen > max_seen:
-                max_seen = subject.seen
-    else:
-        # assume the subjects are their IDs, so get it from there
-        for i in subjects:
-            subject = swap.subjects[i]
-            subjects_final.append(subject)
-            if subject.seen > max_seen:
-                max_seen = subject.seen
-    subjects = subjects_final
+        # draw random subjects, without duplicates
+        keys = swap.subjects.keys()
+        indices = np.random.choice(
+            len(keys), min(subjects, len(keys)), replace=False)
+        subjects = [keys[i] for i in indices]
+    # assume the subjects are their IDs, so get it from there
+    subjects = [swap.subjects[i] for i in subjects]
+    # max_seen is set by subject with max number of classifications
+    max_seen = max([1] + [subject.seen for subject in subjects])
 
     fig, ax = plt.subplots(figsize=(5,5), dpi=300)
 
@@ -92,30 +84,41 @@ def trajectory_plot(swap, path=None, subjects=200, logy=True):
  #       p_real = 0.95
          p_real , p_bogus= thresholds_setting()
 
-    ax.axvline(x=subjects[0].prior, color=color_test, linestyle='dotted')
+    if len(subjects) > 0:
+        ax.axvline(x=subjects[0].prior, color=color_test, linestyle='dotted')
     ax.axvline(x=p_bogus, color=color_bogus, linestyle='dotted')
     ax.axvline(x=p_real, color=color_real, linestyle='dotted')
 
     ax.set_xlabel('Posterior Probability Pr(LENS|d)')
     ax.set_ylabel('No. of Classifications')
 
-    # plot history trajectories
-    for subject in subjects:
-        score, history = subject.update_score(history=True)
-        # clip history
-        history = np.array(history)
-        history = np.where(history < p_min, p_min, history)
-        history = np.where(history > p_max, p_max, history)
-        # trajectory
-        y = np.arange(len(history) + 1) + 1
-
-        # add initial value
-        history = np.append(subject.prior, history)
-
-        ax.plot(history, y, color=colors[subject.gold], alpha=alphas[subject.gold], linewidth=linewidths[subject.gold], linestyle='-')
+    # plot history trajectories, all scores are read from the trajectory
+    # cache or computed in one go
+    priors = np.array([subject.prior for subject in subjects])
+    offsets, scores = swap.trajectories(subjects)
+    # clip history
+    scores = np.clip(scores, p_min, p_max)
+
+    # add initial value, trajectory i then starts at starts[i]
+    lengths = np.diff(offsets) + 1
+    starts = offsets[:-1] + np.arange(len(priors))
+    x = np.insert(scores, offsets[:-1], priors)
+    y = np.arange(len(x)) - np.repeat(starts, lengths) + 1
+    points = np.column_stack([x, y])
+
+    if len(subjects) > 0:
+        # gold -1 (test) picks the last style
+        gold = np.array([subject.gold for subject in subjects])
+        rgba = to_rgba_array(colors)
+        rgba[:, 3] = alphas
+        ax.add_collection(LineCollection(
+            np.split(points, starts[1:]), colors=rgba[gold],
+            linewidths=np.array(linewidths)[gold], linestyles='-'))
 
         # a point at the end
-        ax.scatter(history[-1:], y[-1:], s=sizes[subject.gold], edgecolors=colors[subject.gold], facecolors=colors[subject.gold], alpha=1.0)
+        ends = points[starts + lengths - 1]
+        ax.scatter(ends[:, 0], ends[:, 1], s=np.array(sizes)[gold],
+                   c=to_rgba_array(colors)[gold], alpha=1.0)
 
     # add legend
     patches = []
@@ -0,0 +1,90 @@
+"""
+Streaming writer for SWAP reports.
+
+The subject and user sections of a report are written to the file in
+chunks as they are formatted, instead of being collected in one string
+first. Sections can be formatted by forked worker processes, which
+inherit the SWAP instance, and are written in order as the chunks come
+back. Reports whose path ends in .gz are gzip compressed.
+"""
+import gzip
+import multiprocessing
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# agents formatted per task
+chunksize = 1000
+
+# SWAP instance inherited by forked workers
+_swap = None
+
+
+def open_report(path, compress=None):
+    """
+    Open a report file for writing text
+
+    compress: (bool) gzip the report, by default when path ends in .gz
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, 'wt', compresslevel=6)
+    return open(path, 'w', buffering=1 << 20)
+
+
+def _format(swap, kind, keys, report_classifications):
+    if kind == 'subjects':
+        users = swap.score_source
+        subjects = [swap.subjects[key] for key in keys]
+        trajectories = [None] * len(subjects)
+        if report_classifications and swap.trajectory_cache.size > 0:
+            offsets, scores = swap.trajectories(subjects)
+            trajectories = np.split(scores, offsets[1:-1])
+        return ''.join(
+            subject.report(report_classifications=report_classifications,
+                           users=users, trajectory=trajectory)
+            for subject, trajectory in zip(subjects, trajectories))
+    return ''.join(
+        swap.users[key].report(report_classifications=report_classifications)
+        for key in keys)
+
+
+def _format_chunk(args):
+    return _format(_swap, *args)
+
+
+def write_sections(file, swap, kind, report_classifications=True, processes=1):
+    """
+    Write the report section of every subject or user to file
+
+    kind: 'subjects' or 'users'
+    processes: number of worker processes formatting sections
+    """
+    keys = getattr(swap, kind).keys()
+    chunks = [(kind, keys[i:i + chunksize], report_classifications)
+              for i in range(0, len(keys), chunksize)]
+
+    if processes > 1 and swap.config.backend == 'sqlite':
+        # the database connection can't be shared with forked workers
+        logger.debug('Formatting the sqlite backend report in one process')
+        processes = 1
+    if processes > 1 and \
+            'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+
+    if processes <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            file.write(_format(swap, *chunk))
+        return
+
+    global _swap
+    _swap = swap
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes) as pool:
+            for text in pool.imap(_format_chunk, chunks):
+                file.write(text)
+    finally:
+        _swap = None
@@ -0,0 +1,469 @@
+"""
+Subject-sharded scoring with forked worker processes.
+
+A call to SWAP forks config.shards workers, which inherit the SWAP
+instance, and runs in two rounds:
+
+    count   the dirty users are split into shards by a hash of their id,
+            and every worker counts the classifications in the histories
+            of its users by gold label. The parent sets the seen and
+            correct counters of the users from the counts (reduce), and
+            writes their new confusion matrices to memory shared with the
+            workers.
+    score   the dirty subjects and the subjects classified by a user whose
+            score changed are split into shards by a hash of their id, and
+            every worker scores the subjects of its shard with the shared
+            confusion matrices.
+
+Like scoring in one process, only the histories of these agents are read,
+so the cost of a call follows the size of the batch and not of the
+project. Workers score with the same floating point operations as
+Subject.update_score (see swap.utils.subject.update_scores), and the
+counters are summed exactly, so the scores are identical to scoring in
+one process. SWAP.retire splits all subjects over the shards the same
+way.
+
+Only the array and dict backends with full scoring are sharded, the
+sqlite connection can't be shared with forked workers. Nothing is forked
+while other threads are running, as in the online Pipeline. Without
+config.reference_history the scores copied into the subject histories
+are updated by the parent while the workers score the subjects.
+"""
+import mmap
+import multiprocessing
+import os
+import threading
+import traceback
+import zlib
+import numpy as np
+
+from swap.utils.columnar import ArrayCollection, compact, confusion_matrices
+from swap.utils.subject import update_scores, retirement
+import swap.utils.state as state
+import swap.utils.metrics as metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def available(swap):
+    """
+    Whether calls to swap are split over shard workers
+    """
+    config = swap.config
+    if getattr(config, 'shards', 1) <= 1 or config.scoring != 'full':
+        return False
+    if config.backend == 'sqlite':
+        logger.debug('Scoring the sqlite backend in one process')
+        return False
+    if not hasattr(os, 'fork'):
+        return False
+    # a forked child only gets the calling thread, locks held by other
+    # threads (logging, metrics) would never be released in it
+    if threading.current_thread() is not threading.main_thread() or \
+            threading.active_count() > 1:
+        logger.debug('Scoring in one process, other threads are running')
+        return False
+    return True
+
+
+def shard_of(ids, shards):
+    """
+    Shard of every id. Integer ids are hashed by multiplying with a 64 bit
+    constant, others with crc32 of their text, so the shards don't depend
+    on the hash seed of the process.
+    """
+    ids = compact(list(ids))
+    if ids.dtype != object:
+        h = ids.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        return ((h >> np.uint64(32)) % np.uint64(shards)).astype(np.int64)
+    return np.array([zlib.crc32(str(i).encode()) % shards
+                     for i in ids.tolist()], dtype=np.int64)
+
+
+class SharedArrays:
+    """
+    Arrays in one anonymous shared memory mapping. Processes forked after
+    the mapping was made see each other's writes to it.
+
+    arrays: name -> (shape, dtype)
+    """
+    align = 64
+
+    def __init__(self, **arrays):
+        layout = []
+        size = 0
+        for name, (shape, dtype) in arrays.items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            layout.append((name, shape, dtype, count, size))
+            size += -(-count * dtype.itemsize // self.align) * self.align
+
+        self.memory = mmap.mmap(-1, max(size, 1))
+        self.arrays = {}
+        for name, shape, dtype, count, offset in layout:
+            self.arrays[name] = np.frombuffer(
+                self.memory, dtype, count, offset).reshape(shape)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+
+class Workers:
+    """
+    One forked process per shard, running task(shard). A task that is a
+    generator function stops at every yield, hands the yielded value to
+    the parent, and goes on with the message the parent sends next. The
+    parent is free to do other work while the workers run.
+    """
+
+    def __init__(self, shards, task):
+        self.pipes = []
+        self.pids = []
+        try:
+            for shard in range(shards):
+                parent, child = multiprocessing.Pipe()
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        parent.close()
+                        self._run(task, shard, child)
+                        code = 0
+                    finally:
+                        os._exit(code)
+                child.close()
+                self.pipes.append(parent)
+                self.pids.append(pid)
+        except BaseException:
+            self.close()
+            raise
+
+    @staticmethod
+    def _run(task, shard, pipe):
+        try:
+            steps = task(shard)
+            if steps is None:
+                pipe.send(('done', None))
+                return
+            message = None
+            while True:
+                try:
+                    value = steps.send(message)
+                except StopIteration:
+                    pipe.send(('done', None))
+                    return
+                pipe.send(('step', value))
+                message = pipe.recv()
+        except BaseException:
+            pipe.send(('error', traceback.format_exc()))
+
+    def wait(self):
+        """
+        Wait for every worker to reach its next yield or finish
+
+        Returns the values the workers yielded, by shard
+        """
+        values = []
+        for shard, pipe in enumerate(self.pipes):
+            try:
+                status, value = pipe.recv()
+            except EOFError:
+                status, value = 'error', 'worker exited'
+            if status == 'error':
+                raise RuntimeError('Shard %d failed\n%s' % (shard, value))
+            values.append(value)
+        return values
+
+    def send(self, messages):
+        """
+        Send the workers on from their current yield, with one message
+        per shard
+        """
+        for pipe, message in zip(self.pipes, messages):
+            pipe.send(message)
+
+    def close(self):
+        # workers waiting at a yield exit when their pipe is closed
+        for pipe in self.pipes:
+            pipe.close()
+        for pid in self.pids:
+            os.waitpid(pid, 0)
+        self.pipes = []
+        self.pids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _histories(collection, ids):
+    """
+    Histories of the agents with these ids
+    """
+    if isinstance(collection, ArrayCollection):
+        table = collection.table
+        index = table.index
+        return [table.history[index[i]] for i in ids]
+    return [collection[i].history for i in ids]
+
+
+def _flatten(histories, *columns):
+    """
+    Columns of the entries of several histories, and offsets (history n
+    spans offsets[n]:offsets[n+1])
+    """
+    lengths = np.array([len(h) for h in histories], dtype=np.int64)
+    offsets = np.zeros(len(histories) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets, [[entry[c] for h in histories for entry in h]
+                     for c in columns]
+
+
+def _split(ids, shards):
+    """
+    Ids of every shard
+    """
+    shard = shard_of(ids, shards)
+    return [[ids[i] for i in np.flatnonzero(shard == n).tolist()]
+            for n in range(shards)]
+
+
+def score(swap, users):
+    """
+    Score the dirty users and subjects of swap with one worker per shard
+
+    users: ids of the users to score
+
+    Returns the ids of the users whose score changed, and the set of
+    subjects that were scored
+    """
+    shards = swap.config.shards
+    users = list(users)
+    dirty_subjects = swap.dirty_subjects
+    swap.dirty_subjects = set()
+    if len(users) == 0 and len(dirty_subjects) == 0:
+        return [], set()
+
+    # row of every user to score in the shared arrays
+    rows = {user: i for i, user in enumerate(users)}
+    user_shard = shard_of(users, shards)
+    shared = SharedArrays(
+        counts=((len(users), 5), np.int64),
+        confusions=((len(users), 2), np.float64))
+
+    def task(n):
+        rows_ = np.flatnonzero(user_shard == n)
+        shared['counts'][rows_] = _count(swap, [users[i] for i in rows_])
+        subjects = yield
+        yield _score(swap, subjects, rows, shared['confusions'])
+
+    with Workers(shards, task) as workers:
+        with metrics.timer('shards_count', users=len(users), shards=shards):
+            workers.wait()
+        with metrics.timer('shards_reduce', users=len(users)) as timer:
+            changed = _reduce(swap, users, shared['counts'])
+            timer.add(changed=len(changed))
+            # broadcast the new confusion matrices of the scored users,
+            # the workers still see the old ones from before the fork
+            shared['confusions'][:] = _confusions(swap.users, users)
+
+        subjects = dirty_subjects
+        for user in changed:
+            for subject, _, _ in swap.users[user].history:
+                subjects.add(subject)
+                swap.trajectory_cache.discard(subject)
+        if swap.score_counters:
+            for subject in subjects:
+                swap._score_changing(swap.subjects[subject])
+
+        with metrics.timer('shards_score', subjects=len(subjects),
+                           shards=shards):
+            split = _split(list(subjects), shards)
+            workers.send(split)
+            # the workers score with the broadcast confusion matrices,
+            # the copies in the histories are updated meanwhile
+            swap.apply_subjects(changed)
+            results = workers.wait()
+            for ids, (scores, classified) in zip(split, results):
+                _apply_scores(swap, ids, scores, classified)
+    return changed, subjects
+
+
+def _count(swap, users):
+    """
+    Classifications in the histories of users by gold label, one row per
+    user: seen bogus, real and other, correct bogus and real
+    """
+    offsets, (gold, cl) = _flatten(_histories(swap.users, users), 1, 2)
+    user = np.repeat(np.arange(len(users)), np.diff(offsets))
+    gold = np.array([-1 if g is None else g for g in gold], dtype=np.int64)
+    cl = np.array(cl, dtype=np.int64)
+
+    # like User.update_score
+    kind = np.where((gold == 0) | (gold == 1), gold, 2)
+    counts = np.zeros((len(users), 5), dtype=np.int64)
+    counts[:, :3] = np.bincount(
+        user * 3 + kind, minlength=3 * len(users)).reshape(-1, 3)
+    correct = (kind < 2) & (gold == cl)
+    counts[:, 3:] = np.bincount(
+        user[correct] * 2 + gold[correct],
+        minlength=2 * len(users)).reshape(-1, 2)
+    return counts
+
+
+def _reduce(swap, users, counts):
+    """
+    Set the counters of the users from their priors and counts, like
+    User.update_score
+
+    Returns the ids of the users whose score changed
+    """
+    # adding the counts at once only gives the same counters as adding
+    # them one at a time when the priors are whole numbers
+    exact = 2. ** 53
+    if isinstance(swap.users, ArrayCollection):
+        table = swap.users.table
+        index = np.array([table.index[u] for u in users], dtype=np.int64)
+        prior = np.hstack([table.prior_seen[index], table.prior_correct[index]])
+        whole = np.all((prior == np.floor(prior)) & (np.abs(prior) < exact),
+                       axis=1)
+        before = confusion_matrices(table.correct[index], table.seen[index])
+
+        i = index[whole]
+        table.seen[i] = prior[whole, :3] + counts[whole, :3]
+        table.correct[i] = prior[whole, 3:] + counts[whole, 3:]
+        for n in np.flatnonzero(~whole).tolist():
+            swap.users.view(index[n]).update_score()
+
+        after = confusion_matrices(table.correct[index], table.seen[index])
+        changed = np.any(before != after, axis=1)
+        return [users[n] for n in np.flatnonzero(changed).tolist()]
+
+    changed = []
+    for user, (s0, s1, s2, c0, c1) in zip(users, counts.tolist()):
+        user = swap.users[user]
+        score = user.score
+        correct, seen = user.prior
+        prior = list(correct) + list(seen)
+        if all(float(p).is_integer() and abs(p) < exact for p in prior):
+            user.seen = [seen[0] + s0, seen[1] + s1, seen[2] + s2]
+            user.correct = [correct[0] + c0, correct[1] + c1]
+        else:
+            user.update_score()
+        if user.score != score:
+            changed.append(user.id)
+    return changed
+
+
+def _confusions(users, ids):
+    """
+    Confusion matrices (PD, PL) of the users with these ids, which may
+    repeat
+    """
+    if isinstance(users, ArrayCollection):
+        table = users.table
+        index = table.index
+        i = np.array([index[u] for u in ids], dtype=np.int64)
+        return confusion_matrices(table.correct[i], table.seen[i])
+
+    # look up the score of every user once
+    distinct = {}
+    inverse = np.array([distinct.setdefault(u, len(distinct)) for u in ids],
+                       dtype=np.int64)
+    scores = np.array([users[u].score for u in distinct], dtype=np.float64)
+    return scores.reshape(-1, 2)[inverse]
+
+
+def _score(swap, subjects, rows, confusions):
+    """
+    Scores of subjects in a worker, and which of them have
+    classifications. Users with a row in the broadcast confusions are read
+    from there, the others haven't changed since the fork.
+    """
+    if isinstance(swap.subjects, ArrayCollection):
+        table = swap.subjects.table
+        index = np.array([table.index[i] for i in subjects], dtype=np.int64)
+        priors = table.prior[index]
+    else:
+        priors = np.array([swap.subjects[i].prior for i in subjects],
+                          dtype=np.float64)
+    offsets, (user, cl) = _flatten(_histories(swap.subjects, subjects), 0, 2)
+
+    matrices = _confusions(swap.users, user)
+    row = np.array([rows.get(u, -1) for u in user], dtype=np.int64)
+    broadcast = row >= 0
+    matrices[broadcast] = confusions[row[broadcast]]
+    scores = update_scores(priors, offsets, matrices[:, 0], matrices[:, 1],
+                           np.array(cl, dtype=np.int8))
+    return scores, np.diff(offsets) > 0
+
+
+def _apply_scores(swap, subjects, scores, classified):
+    """
+    Copy the scores of a shard back to the subjects
+    """
+    if isinstance(swap.subjects, ArrayCollection):
+        table = swap.subjects.table
+        index = np.array([table.index[i] for i in subjects], dtype=np.int64)
+        table.score[index] = scores
+        # update_score resets the retirement of classified subjects
+        table.retired[index[classified]] = -1
+        return
+    for subject, score, reset in zip(subjects, scores.tolist(),
+                                     classified.tolist()):
+        subject = swap.subjects[subject]
+        subject.score = score
+        if reset:
+            subject.retired = None
+
+
+def retire(swap, thresholds):
+    """
+    Retire the subjects of every shard in its own worker, like
+    SWAP.retire
+
+    Returns the ids of the subjects whose retirement changed
+    """
+    shards = swap.config.shards
+    ids = swap.subjects.keys()
+    shard = shard_of(ids, shards)
+    shared = SharedArrays(
+        retired=((len(ids),), np.int8),
+        changed=((len(ids),), np.bool_))
+
+    def task(n):
+        positions = np.flatnonzero(shard == n)
+        if isinstance(swap.subjects, ArrayCollection):
+            table = swap.subjects.table
+            score = table.score[positions]
+            retired = table.retired[positions]
+            if isinstance(table.history, state.RaggedHistory):
+                lengths = table.history.lengths()[positions]
+            else:
+                lengths = np.array([len(table.history[i])
+                                    for i in positions.tolist()])
+        else:
+            subjects = [swap.subjects[ids[i]] for i in positions.tolist()]
+            score = np.array([s.score for s in subjects], dtype=np.float64)
+            retired = np.array([-1 if s.retired is None else s.retired
+                                for s in subjects], dtype=np.int8)
+            lengths = np.array([len(s.history) for s in subjects])
+        new = retirement(score, retired, lengths > 0, thresholds)
+        shared['retired'][positions] = new
+        shared['changed'][positions] = new != retired
+
+    with Workers(shards, task) as workers:
+        workers.wait()
+
+    positions = np.flatnonzero(shared['changed'])
+    retired = shared['retired'][positions]
+    if isinstance(swap.subjects, ArrayCollection):
+        swap.subjects.table.retired[positions] = retired
+    else:
+        for i, value in zip(positions.tolist(), retired.tolist()):
+            swap.subjects[ids[i]].retired = None if value == -1 else value
+    return [ids[i] for i in positions.tolist()]
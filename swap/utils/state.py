@@ -0,0 +1,393 @@
+"""
+Memory-mapped snapshots of array backend state.
+
+A snapshot is a directory with one .npy file per column. Loading maps the
+files with numpy.load(mmap_mode='c'), so only the pages that are read are
+loaded and changes stay private to the process. Histories are stored as
+ragged arrays: the entries of all rows concatenated, and an offsets array
+where row i spans offsets[i]:offsets[i+1]. A row is turned back into a
+python list the first time it is read, and ids and user names are only
+turned into python objects when they are read (see MappedList).
+
+    <name>.state/
+        meta.pkl        config, thresholds, last_id, dirty agents, ...
+        users/          ids, names, counters and user histories
+        subjects/       ids, scores, gold, retired and subject histories
+        pairs/          seen (user, subject) pairs
+        classifications/  columns of the classification buffer
+"""
+import os
+import pickle
+import shutil
+import numpy as np
+
+from swap.utils.columnar import SubjectTable, UserTable, MappedList, compact
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _save(path, name, array):
+    with open(os.path.join(path, name + '.npy'), 'wb') as file:
+        np.save(file, np.asarray(array))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _load(path, name):
+    fname = os.path.join(path, name + '.npy')
+    try:
+        return np.load(fname, mmap_mode='c')
+    except ValueError:
+        # object arrays and empty arrays can't be mapped
+        return np.load(fname, allow_pickle=True)
+
+
+class RaggedHistory:
+    """
+    List-like view of the histories of all rows of a table
+
+    Rows that have been read or replaced are kept as python lists, rows
+    added after loading are appended to extra. Subclasses turn slices of
+    the stored columns into the entries of a row with decode(columns).
+    """
+    names = []
+
+    def __init__(self, offsets, columns):
+        self.offsets = offsets
+        self.columns = columns
+        self.rows = {}
+        self.extra = []
+        self.stored = len(offsets) - 1
+
+    @classmethod
+    def open(cls, path, *args):
+        columns = {name: _load(path, 'history_' + name) for name in cls.names}
+        return cls(_load(path, 'history_offsets'), columns, *args)
+
+    def __getitem__(self, i):
+        if i >= self.stored:
+            return self.extra[i - self.stored]
+        row = self.rows.get(i)
+        if row is None:
+            a, b = self.offsets[i], self.offsets[i + 1]
+            row = self.decode(
+                {name: c[a:b] for name, c in self.columns.items()})
+            self.rows[i] = row
+        return row
+
+    def __setitem__(self, i, row):
+        if i >= self.stored:
+            self.extra[i - self.stored] = row
+        else:
+            self.rows[i] = row
+
+    def append(self, row):
+        self.extra.append(row)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return self.stored + len(self.extra)
+
+    def lengths(self):
+        """
+        Number of entries in every row, without decoding the stored rows
+        """
+        lengths = np.empty(len(self), dtype=np.int64)
+        lengths[:self.stored] = np.diff(self.offsets)
+        lengths[self.stored:] = [len(row) for row in self.extra]
+        for i, row in self.rows.items():
+            lengths[i] = len(row)
+        return lengths
+
+    def segments(self):
+        """
+        Split the rows into ranges that are unchanged since loading,
+        yielded as (start, end) row ranges, and lists of python rows
+        """
+        start = 0
+        rows = []
+        for i in sorted(self.rows):
+            if i > start:
+                if len(rows) > 0:
+                    yield rows
+                    rows = []
+                yield (start, i)
+            rows.append(self.rows[i])
+            start = i + 1
+        if self.stored > start:
+            if len(rows) > 0:
+                yield rows
+                rows = []
+            yield (start, self.stored)
+        rows.extend(self.extra)
+        if len(rows) > 0:
+            yield rows
+
+
+class UserHistory(RaggedHistory):
+    """
+    User histories, entries are (subject id, gold, label)
+    """
+    names = ['subject', 'gold', 'cl']
+
+    def decode(self, columns):
+        return list(zip(columns['subject'].tolist(),
+                        columns['gold'].tolist(),
+                        columns['cl'].tolist()))
+
+    @staticmethod
+    def encode(entries):
+        return {
+            'subject': compact([h[0] for h in entries]),
+            'gold': np.array([h[1] for h in entries], dtype=np.int8),
+            'cl': np.array([h[2] for h in entries], dtype=np.int8),
+        }
+
+
+class SubjectHistory(RaggedHistory):
+    """
+    Subject histories, entries are (user id, user score, label). Users are
+    stored by their row in the user table, and a score that is only a
+    reference to the user (None) as nan.
+    """
+    names = ['user', 'u0', 'u1', 'cl']
+
+    def __init__(self, offsets, columns, users):
+        super().__init__(offsets, columns)
+        self.users = users
+
+    def decode(self, columns):
+        ids = self.users.ids
+        return [
+            (ids[u], None if u0 != u0 else [u0, u1], cl)
+            for u, u0, u1, cl in zip(columns['user'].tolist(),
+                                     columns['u0'].tolist(),
+                                     columns['u1'].tolist(),
+                                     columns['cl'].tolist())]
+
+    @staticmethod
+    def encoder(users):
+        index = users.index
+
+        def encode(entries):
+            scores = np.array(
+                [(np.nan, np.nan) if h[1] is None else h[1] for h in entries],
+                dtype=np.float64).reshape(-1, 2)
+            return {
+                'user': np.array([index[h[0]] for h in entries],
+                                 dtype=np.int64),
+                'u0': scores[:, 0],
+                'u1': scores[:, 1],
+                'cl': np.array([h[2] for h in entries], dtype=np.int8),
+            }
+        return encode
+
+
+def history_lengths(history):
+    """
+    Number of entries in every row of a table history, which is either a
+    list of rows or a RaggedHistory opened from a snapshot
+    """
+    if isinstance(history, RaggedHistory):
+        return history.lengths()
+    return np.array([len(row) for row in history], dtype=np.int64)
+
+
+def write_history(path, history, names, encode):
+    """
+    Write the histories of a table as ragged arrays. Rows of a
+    RaggedHistory that were never read are copied over without decoding.
+    """
+    if isinstance(history, RaggedHistory):
+        segments = history.segments()
+    else:
+        segments = [history]
+
+    lengths = []
+    pieces = {name: [] for name in names}
+    for segment in segments:
+        if type(segment) is tuple:
+            a, b = segment
+            offsets = history.offsets
+            lengths.append(np.diff(offsets[a:b + 1]))
+            for name in names:
+                pieces[name].append(
+                    history.columns[name][offsets[a]:offsets[b]])
+        else:
+            lengths.append(np.array([len(row) for row in segment],
+                                    dtype=np.int64))
+            columns = encode([h for row in segment for h in row])
+            for name in names:
+                pieces[name].append(columns[name])
+
+    offsets = np.zeros(sum(len(l) for l in lengths) + 1, dtype=np.int64)
+    if len(lengths) > 0:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    _save(path, 'history_offsets', offsets)
+    for name in names:
+        if len(pieces[name]) == 0:
+            pieces[name] = [encode([])[name]]
+        _save(path, 'history_' + name, np.concatenate(pieces[name]))
+
+
+def write_table(path, table, history_class, encode):
+    os.mkdir(path)
+    _save(path, 'ids', compact(table.ids))
+    for name in table.fields:
+        _save(path, name, table.column(name))
+    write_history(path, table.history, history_class.names, encode)
+
+
+def open_table(path, table_class, history_class, *args):
+    """
+    Open a table written by write_table, fields are memory-mapped
+    """
+    ids = _load(path, 'ids')
+    n = len(ids)
+    if n == 0:
+        table = table_class()
+    else:
+        table = table_class.empty()
+        table.capacity = n
+        for name, (dtype, shape, default) in table_class.fields.items():
+            if os.path.isfile(os.path.join(path, name + '.npy')):
+                setattr(table, name, _load(path, name))
+            else:
+                # field added after the snapshot was written
+                setattr(table, name,
+                        np.full((n,) + shape, default, dtype=dtype))
+    # ids stay in the mapped array, and the id lookup is only built when
+    # an agent is looked up by id
+    table.ids = MappedList(ids)
+    table.index = None
+    table.history = history_class.open(path, *args)
+    return table
+
+
+def write_names(path, names):
+    """
+    Write user names as a fixed width string array that can be mapped,
+    and which of them are not None
+    """
+    if isinstance(names, MappedList) and names.unchanged() and \
+            names.present is not None:
+        _save(path, 'names', names.array)
+        _save(path, 'named', names.present)
+        return
+    named = np.array([name is not None for name in names], dtype=bool)
+    _save(path, 'names', np.array(
+        ['' if name is None else name for name in names], dtype=str))
+    _save(path, 'named', named)
+
+
+def open_names(path):
+    names = _load(path, 'names')
+    if os.path.isfile(os.path.join(path, 'named.npy')):
+        return MappedList(names, _load(path, 'named'))
+    # snapshots written before names were mapped store them as objects
+    return MappedList(names)
+
+
+def write_state(path, meta, users, subjects, pairs, classifications):
+    """
+    Write a snapshot directory
+
+    The snapshot is written next to the old one and renamed into place,
+    the old one is removed afterwards.
+
+    meta: picklable dict of the remaining state
+    users: UserTable
+    subjects: SubjectTable
+    pairs: PairSet dump
+    classifications: ClassificationBuffer
+    """
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+
+    write_table(os.path.join(tmp, 'users'), users,
+                UserHistory, UserHistory.encode)
+    write_names(os.path.join(tmp, 'users'), users.names)
+    write_table(os.path.join(tmp, 'subjects'), subjects,
+                SubjectHistory, SubjectHistory.encoder(users))
+
+    os.mkdir(os.path.join(tmp, 'pairs'))
+    for key, value in pairs.items():
+        _save(os.path.join(tmp, 'pairs'), key, value)
+
+    # full width columns, so loading can map them without a conversion
+    directory = os.path.join(tmp, 'classifications')
+    os.mkdir(directory)
+    _save(directory, 'users', compact(classifications.users.ids))
+    _save(directory, 'subjects', compact(classifications.subjects.ids))
+    for name in classifications.fields:
+        _save(directory, name, classifications.column(name))
+
+    with open(os.path.join(tmp, 'meta.pkl'), 'wb') as file:
+        pickle.dump(meta, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+
+    install(tmp, path)
+
+
+def install(src, path):
+    """
+    Replace the snapshot directory at path with the one at src
+    """
+    old = path + '.old'
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(src, path)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+
+def exists(path):
+    return os.path.isdir(path) or os.path.isdir(path + '.old')
+
+
+def read_state(path):
+    """
+    Open a snapshot directory
+
+    Returns a dict shaped like a pickled snapshot, with the user and
+    subject tables already opened
+    """
+    if not os.path.isdir(path):
+        # interrupted while moving a new snapshot into place
+        logger.warning('Using previous snapshot %s.old', path)
+        path = path + '.old'
+
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as file:
+        data = pickle.load(file)
+
+    users = open_table(os.path.join(path, 'users'), UserTable, UserHistory)
+    users.names = open_names(os.path.join(path, 'users'))
+    subjects = open_table(os.path.join(path, 'subjects'), SubjectTable,
+                          SubjectHistory, users)
+
+    pairs = os.path.join(path, 'pairs')
+    data['users'] = users
+    data['subjects'] = subjects
+    data['seen_classifications'] = {
+        key: _load(pairs, key)
+        for key in ['users', 'subjects', 'counts', 'pairs']}
+
+    directory = os.path.join(path, 'classifications')
+    if os.path.isdir(directory):
+        data['classifications'] = {
+            key: _load(directory, key)
+            for key in ['users', 'subjects', 'user', 'subject', 'label', 'id']}
+    return data
+
+
+def remove(path):
+    for p in [path, path + '.old', path + '.tmp']:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
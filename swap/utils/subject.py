@@ -2,12 +2,179 @@
 from collections import OrderedDict
 
 from swap.utils.collection import Collection
+from swap.utils.columnar import ArrayCollection, SubjectTable
 
-from math import log10
+from math import log10, log, log1p, exp
+import numpy as np
 
 import logging
 logger = logging.getLogger(__name__)
 
+
+def logodds_term(confusion, cl):
+    """
+    Change in the log-odds of a subject being real after a classification
+    cl by a user with confusion matrix (PD, PL)
+    """
+    u0, u1 = confusion
+    if cl == 1:
+        return log(u1) - log(1 - u0)
+    return log(1 - u1) - log(u0)
+
+
+def posterior(prior, logodds):
+    """
+    Probability of a subject with the given prior after adding logodds
+    """
+    if not 0 < prior < 1:
+        # a prior of exactly 0 or 1 can't be moved by any evidence
+        return prior
+    x = log(prior) - log1p(-prior) + logodds
+    if x >= 0:
+        return 1 / (1 + exp(-x))
+    z = exp(x)
+    return z / (1 + z)
+
+
+def history_arrays(subjects, users=None):
+    """
+    Classification histories of several subjects as flat arrays
+
+    users: Read the current user scores from this collection instead of
+           the copies stored in the histories
+
+    Returns the priors, offsets (subject i's classifications are
+    offsets[i]:offsets[i+1]), and the user confusion matrix (u0, u1) and
+    label of every classification
+    """
+    priors = []
+    lengths = []
+    u0 = []
+    u1 = []
+    cl = []
+    for subject in subjects:
+        priors.append(subject.prior)
+        n = 0
+        for _, (a, b), c in subject.confusions(users):
+            u0.append(a)
+            u1.append(b)
+            cl.append(c)
+            n += 1
+        lengths.append(n)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return (np.array(priors, dtype=np.float64), offsets,
+            np.array(u0, dtype=np.float64), np.array(u1, dtype=np.float64),
+            np.array(cl, dtype=np.int8))
+
+
+def logodds_terms(u0, u1, cl):
+    """
+    Vectorized logodds_term, for arrays of user confusion matrices (u0,
+    u1) and labels. The confusion matrices are clipped to (0, 1), so every
+    term is finite.
+    """
+    tiny = np.finfo(np.float64).tiny
+    u0 = np.clip(u0, tiny, np.nextafter(1., 0.))
+    u1 = np.clip(u1, tiny, np.nextafter(1., 0.))
+    return np.where(cl == 1, np.log(u1) - np.log1p(-u0),
+                    np.log1p(-u1) - np.log(u0))
+
+
+def running_logodds(priors, offsets, u0, u1, cl):
+    """
+    Log-odds of every subject being real after each of its
+    classifications, for many subjects at once. Sums the log-odds terms of
+    each subject's history with one cumulative sum, instead of replaying
+    update_score.
+
+    Arguments are laid out like the output of history_arrays. Returns the
+    log-odds as one flat array in the same order as the classifications,
+    subjects with a prior of exactly 0 or 1 stay at -inf or inf.
+    """
+    lengths = np.diff(offsets)
+    # the terms are finite, an infinite one would spill into the running
+    # sums of the subjects after it
+    terms = logodds_terms(u0, u1, cl)
+
+    # restart the running sum at the first classification of every
+    # subject by taking off the total of the subject before it
+    starts = offsets[:-1][lengths > 0]
+    if len(starts) > 1:
+        totals = np.add.reduceat(terms, starts)
+        terms[starts[1:]] -= totals[:-1]
+    logodds = np.cumsum(terms)
+
+    prior = np.repeat(np.asarray(priors, dtype=np.float64), lengths)
+    with np.errstate(divide='ignore'):
+        return np.log(prior) - np.log1p(-prior) + logodds
+
+
+def logistic(x):
+    """
+    Probability for an array of log-odds
+    """
+    z = np.exp(-np.abs(x))
+    return np.where(x >= 0, 1 / (1 + z), z / (1 + z))
+
+
+def trajectories(priors, offsets, u0, u1, cl):
+    """
+    Score of every subject after each of its classifications, for many
+    subjects at once, as one flat array (see running_logodds)
+    """
+    return logistic(running_logodds(priors, offsets, u0, u1, cl))
+
+
+def update_scores(priors, offsets, u0, u1, cl):
+    """
+    Final score of many subjects at once, like Subject.update_score.
+    Each step updates the subjects that have another classification with
+    the same floating point operations as update_score, so the scores are
+    identical to scoring the subjects one by one.
+
+    Arguments are laid out like the output of history_arrays.
+    """
+    score = np.array(priors, dtype=np.float64)
+    lengths = np.diff(offsets)
+    if len(lengths) == 0 or lengths.max() == 0:
+        return score
+
+    # longest histories first, step k updates the subjects with more
+    # than k classifications, which are a prefix of this order
+    order = np.argsort(-lengths, kind='stable')
+    remaining = -lengths[order]
+    starts = offsets[:-1][order]
+    x = score[order]
+    for k in range(-remaining[0]):
+        n = np.searchsorted(remaining, -k, side='left')
+        i = starts[:n] + k
+        s = x[:n]
+        real = cl[i] == 1
+        a = np.where(real, s * u1[i], s * (1 - u1[i]))
+        b = np.where(real, (1 - s) * (1 - u0[i]), (1 - s) * u0[i])
+        d = a + b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # update_score leaves the score unchanged when a + b is 0
+            x[:n] = np.where(d != 0, a / d, s)
+    score[order] = x
+    return score
+
+
+def retirement(score, retired, classified, thresholds):
+    """
+    Retirement of many subjects at once, like update_score followed by
+    retire: subjects with classifications start out not retired, the
+    others keep their retirement, then subjects past a threshold retire.
+    Retirement is stored like in SubjectTable, -1 is not retired.
+    """
+    bogus, real = thresholds
+    retired = np.where(classified, -1, retired)
+    return np.where(score < bogus, 0,
+                    np.where(score > real, 1, retired)).astype(np.int8)
+
+
 class Subject:
     """
     Class to track an individual subject, its gold status, and its
@@ -15,7 +182,7 @@ class Subject:
     """
     p0 = 5.e-4
 
-    def __init__(self, subject, gold, score, prior, seen=0, retired=None, history=[]):
+    def __init__(self, subject, gold, score, prior, seen=0, retired=None, history=[], logodds=0.):
         self.id = subject
         self.gold = gold
         self.prior = prior
@@ -23,6 +190,7 @@ class Subject:
         self.seen = seen
         self.history = history
         self.retired = retired
+        self.logodds = logodds
 
     @classmethod
     def new(cls, subject, gold):
@@ -31,7 +199,7 @@ class Subject:
         """
         return cls(subject, gold, cls.p0, cls.p0, history=[])
 
-    def classify(self, user, cl):
+    def classify(self, user, cl, reference=False):
         """
         Add a classification to this subject
 
@@ -40,21 +208,43 @@ class Subject:
 
         user: user that made the classification
         cl: classification, 1 or 0
+        reference: (bool) Only store a reference to the user instead of
+                   a copy of its score
         """
         # Add classification to history
         self.seen += 1
-        self.history.append((user.id, user.score, cl))
+        if reference:
+            self.history.append((user.id, None, cl))
+        else:
+            self.history.append((user.id, user.score, cl))
 
     def update_user(self, user):
         """
         Update the history of this subject when a user's score has changed
         """
+        id_ = user.id
         for i in range(len(self.history)):
             h = self.history[i]
-            if h[0] == user.id:
+            if h[0] == id_:
                 self.history[i] = (h[0], user.score, h[2])
 
-    def update_score(self, thresholds=None, history=False):
+    def confusions(self, users=None):
+        """
+        Iterate over the classification history with the score of the user
+        that made each classification
+
+        Params
+        ------
+
+        users: Read the current user scores from this collection instead
+               of the copies stored in the history
+        """
+        for user, score, cl in self.history:
+            if users is not None:
+                score = users[user].score
+            yield user, score, cl
+
+    def update_score(self, thresholds=None, history=False, users=None):
         """
         Recalculate the score for this subject from its stored classification
         history.
@@ -65,10 +255,12 @@ class Subject:
         thresholds: Also update retirement status of this subject given
                     threshold parameters. (bogus, real)
         history: (bool) Return list of score history
+        users: Read user scores from this collection at scoring time
+               (needed when history only stores user references)
         """
         score = self.prior
         _history = []
-        for _, (u0, u1), cl in self.history:
+        for _, (u0, u1), cl in self.confusions(users):
             if cl == 1:
                 a = score * u1
                 b = (1-score) * (1-u0)
@@ -102,6 +294,15 @@ class Subject:
             return score, _history
         return score
 
+    def add_logodds(self, logodds):
+        """
+        Incremental scoring: add a log-odds term to the running sum and
+        update the score from it
+        """
+        self.logodds += logodds
+        self.score = posterior(self.prior, self.logodds)
+        self.retired = None
+
     def retire(self, thresholds):
         bogus, real = thresholds
         if self.score < bogus:
@@ -121,24 +322,53 @@ class Subject:
             ('history', self.history),
             ('retired', self.retired),
             ('seen', self.seen),
+            ('logodds', self.logodds),
         ])
 
-    def report(self, report_classifications=True):
+    def trajectory(self, users=None):
+        """
+        Score of this subject after each classification in its history,
+        computed like update_score without changing the subject
+        """
+        return [h[3] for h in self._trajectory(self.prior, self.confusions(users))]
+
+    @staticmethod
+    def _trajectory(score, confusions):
+        """
+        Iterate over (user, user score, classification, subject score)
+        """
+        for user, (u0, u1), cl in confusions:
+            if cl == 1:
+                a = score * u1
+                b = (1-score) * (1-u0)
+            elif cl == 0:
+                a = score*(1-u1)
+                b = (1-score)*(u0)
+
+            try:
+                score = a / (a + b)
+            # leave score unchanged
+            except ZeroDivisionError:
+                pass
+            yield user, (u0, u1), cl, score
+
+    def report(self, report_classifications=True, users=None, trajectory=None):
+        """
+        trajectory: Scores of this subject after each classification, as
+                    returned by SWAP.trajectory, instead of computing them
+        """
         string = '# subject id: {0},'.format(self.id)
         string += ' gold: %d, score: %.3f, seen: %d\n' % \
                 (self.gold, self.score, self.seen)
         if report_classifications and len(self.history) > 0:
             string += '# User ID, PBogus, PReal, Classification, dlogP\n'
-            old_score = self.score
-            score, score_history = self.update_score(history=True)
-            self.score = old_score
             old_score = self.prior
-            for s, score_s in zip(self.history, score_history):
-                id = s[0]
-                pbogus = s[1][0]
-                preal = s[1][1]
-                classification = s[2]
-
+            if trajectory is None:
+                rows = self._trajectory(self.prior, self.confusions(users))
+            else:
+                rows = (h + (score,) for h, score in
+                        zip(self.confusions(users), trajectory.tolist()))
+            for id, (pbogus, preal), classification, score_s in rows:
                 dlogP = log10(score_s) - log10(old_score)
                 old_score = score_s
                 string += '{0}, {1:.2f}, {2:.2f}, {3}, {4:+.4f}\n'.format(id, preal, pbogus, classification, dlogP)
@@ -152,6 +382,7 @@ class Subject:
         current score."""
         self.prior = self.score
         self.history = []
+        self.logodds = 0.
 
     @classmethod
     def load(cls, data):
@@ -205,6 +436,301 @@ class Subjects(Collection):
         return self.subset(subjects)
 
 
+class SubjectView(Subject):
+    """
+    Subject backed by a row of a SubjectTable
+    """
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def id(self):
+        return self._table.ids[self._index]
+
+    @property
+    def gold(self):
+        return int(self._table.gold[self._index])
+
+    @gold.setter
+    def gold(self, value):
+        self._table.gold[self._index] = value
+
+    @property
+    def score(self):
+        return float(self._table.score[self._index])
+
+    @score.setter
+    def score(self, value):
+        self._table.score[self._index] = value
+
+    @property
+    def prior(self):
+        return float(self._table.prior[self._index])
+
+    @prior.setter
+    def prior(self, value):
+        self._table.prior[self._index] = value
+
+    @property
+    def seen(self):
+        return int(self._table.seen[self._index])
+
+    @seen.setter
+    def seen(self, value):
+        self._table.seen[self._index] = value
+
+    @property
+    def retired(self):
+        retired = int(self._table.retired[self._index])
+        if retired == -1:
+            return None
+        return retired
+
+    @retired.setter
+    def retired(self, value):
+        if value is None:
+            value = -1
+        self._table.retired[self._index] = value
+
+    @property
+    def history(self):
+        return self._table.history[self._index]
+
+    @history.setter
+    def history(self, value):
+        self._table.history[self._index] = value
+
+    @property
+    def logodds(self):
+        return float(self._table.logodds[self._index])
+
+    @logodds.setter
+    def logodds(self, value):
+        self._table.logodds[self._index] = value
+
+
+class ArraySubjects(ArrayCollection, Subjects):
+    """
+    Collection of Subjects stored in a SubjectTable
+    """
+    table_class = SubjectTable
+    view_class = SubjectView
+    dict_class = Subjects
+
+    def _new(self, subject):
+        i = self.table.add(subject)
+        self.table.score[i] = Subject.p0
+        self.table.prior[i] = Subject.p0
+        return i
+
+    def _insert(self, data):
+        subject = self.view(self.table.add(data['subject']))
+        for key in ['gold', 'score', 'prior', 'retired', 'seen', 'logodds']:
+            if key in data:
+                setattr(subject, key, data[key])
+        subject.history = data.get('history', [])
+
+    def retired(self):
+        retired = self.table.column('retired')
+        return self.subset(
+            [self.table.ids[i] for i in np.flatnonzero(retired >= 0)])
+
+    def gold(self):
+        gold = self.table.column('gold')
+        return self.subset(
+            [self.table.ids[i] for i in np.flatnonzero(gold >= 0)])
+
+    def truncate(self):
+        self.table.column('prior')[:] = self.table.column('score')
+        self.table.column('logodds')[:] = 0
+        self.table.history = [[] for _ in self.table.ids]
+
+    @property
+    def sent(self):
+        """
+        Score and retirement of each subject as last sent to caesar
+        """
+        return SentColumns(self.table)
+
+
+class SentColumns:
+    """
+    Score and retirement of subjects as last sent to caesar, kept in the
+    sent_score and sent_retired columns of a SubjectTable. Used like the
+    dict of subject id -> (score, retired) of the dict backend.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, id_, default=None):
+        table = self.table
+        i = table.index.get(id_)
+        if i is None:
+            return default
+        retired = int(table.sent_retired[i])
+        if retired == -2:
+            return default
+        return (float(table.sent_score[i]), None if retired == -1 else retired)
+
+    def __getitem__(self, id_):
+        value = self.get(id_)
+        if value is None:
+            raise KeyError(id_)
+        return value
+
+    def __setitem__(self, id_, value):
+        self.update({id_: value})
+
+    def update(self, sent):
+        """
+        Record (score, retired) for each subject id in a dict
+        """
+        if len(sent) == 0:
+            return
+        table = self.table
+        index = table.index
+        rows = np.array([index[id_] for id_ in sent], dtype=np.int64)
+        table.sent_score[rows] = [score for score, _ in sent.values()]
+        table.sent_retired[rows] = [
+            -1 if retired is None else retired for _, retired in sent.values()]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.table.column('sent_retired') != -2))
+
+
+def score_arrays(subjects):
+    """
+    Gold labels and scores of all subjects in a collection, as arrays
+    """
+    if isinstance(subjects, ArrayCollection):
+        table = subjects.table
+        return (table.column('gold').astype(np.int64),
+                table.column('score').astype(np.float64))
+
+    return scores_of(subjects.iter(), len(subjects))
+
+
+def scores_of(subjects, n):
+    """
+    Gold labels and scores of n subjects from an iterable, as arrays
+    """
+    # filled in place, a list of tuples makes the garbage collector walk
+    # every history
+    gold = np.empty(n, dtype=np.int64)
+    score = np.empty(n, dtype=np.float64)
+    for i, subject in enumerate(subjects):
+        gold[i] = subject.gold
+        score[i] = subject.score
+    return gold, score
+
+
+class ScoreCounter:
+    """
+    Counts of subjects by gold label and score region, with the sums of
+    their scores and squared scores, for one pair of thresholds. Updated
+    with the old and new values of the subjects whose score or gold label
+    changed, so the threshold statistics cost constant time.
+
+    Regions: 0 score < bogus, 1 score == bogus, 2 between the thresholds,
+    3 score == real, 4 score > real
+    """
+    regions = 5
+
+    def __init__(self, bogus, real):
+        self.bogus = bogus
+        self.real = real
+        # rows are gold 0, 1 and -1 (unknown)
+        self.n = np.zeros((3, self.regions), dtype=np.int64)
+        self.sum = np.zeros((3, self.regions))
+        self.sumsq = np.zeros((3, self.regions))
+
+    @classmethod
+    def from_subjects(cls, subjects, bogus, real):
+        """
+        Count all subjects of a collection
+        """
+        counter = cls(bogus, real)
+        counter.add(*score_arrays(subjects))
+        return counter
+
+    @property
+    def size(self):
+        return int(self.n.sum())
+
+    def add(self, gold, score, sign=1):
+        """
+        Count subjects, or take them off with sign -1
+
+        gold, score: arrays of gold labels and scores
+        """
+        gold = np.asarray(gold, dtype=np.int64)
+        score = np.asarray(score, dtype=np.float64)
+        if len(score) == 0:
+            return
+        region = (score >= self.bogus).astype(np.int64) + \
+            (score > self.bogus) + (score >= self.real) + (score > self.real)
+        # gold -1 goes to the last row
+        bins = np.where(gold < 0, 2, gold) * self.regions + region
+        size = 3 * self.regions
+        self.n += sign * np.bincount(bins, minlength=size).reshape(3, -1)
+        self.sum += sign * np.bincount(
+            bins, score, minlength=size).reshape(3, -1)
+        self.sumsq += sign * np.bincount(
+            bins, score * score, minlength=size).reshape(3, -1)
+
+    def update(self, old, new):
+        """
+        Replace the (gold, score) arrays old of some subjects by new
+        """
+        self.add(*old, sign=-1)
+        self.add(*new)
+
+    def low(self):
+        """
+        Number of subjects of gold 0, 1 and -1 with score <= bogus
+        """
+        return self._counts(self.n[:, 0:2].sum(axis=1))
+
+    def high(self):
+        """
+        Number of subjects of gold 0, 1 and -1 with score >= real
+        """
+        return self._counts(self.n[:, 3:5].sum(axis=1))
+
+    def total(self):
+        return self._counts(self.n.sum(axis=1))
+
+    @staticmethod
+    def _counts(n):
+        return {0: int(n[0]), 1: int(n[1]), -1: int(n[2])}
+
+    def mean_squared_error(self, retirement=False):
+        """
+        Mean squared error of the scores of gold subjects. With retirement,
+        scores below bogus count as 0 and scores above real as 1.
+        """
+        n = self.n[:2].sum()
+        if n == 0:
+            return None
+        # sum of (gold - p)^2 per region, for gold 0 and gold 1
+        error = np.array([
+            self.sumsq[0],
+            self.n[1] - 2 * self.sum[1] + self.sumsq[1]])
+        if retirement:
+            error[:, 0] = [0, self.n[1, 0]]
+            error[:, 4] = [self.n[0, 4], 0]
+        return float(error.sum() / n)
+
+    def __str__(self):
+        return 'low %s high %s total %s' % (self.low(), self.high(), self.total())
+
+    def __repr__(self):
+        return str(self)
+
+
 class Thresholds:
     """
     Class to determine retirement thresholds
@@ -247,13 +773,9 @@ class Thresholds:
         """
         Generate sorted list of subject scores and gold labels
         """
-        scores = []
-        for subject in self.subjects.iter():
-            # if len(subject.history) > 0:
-            scores.append((subject.gold, subject.score))
-
-        scores = sorted(scores, key=lambda item: item[1])
-        return scores
+        gold, score = score_arrays(self.subjects)
+        order = np.argsort(score, kind='stable')
+        return list(zip(gold[order].tolist(), score[order].tolist()))
 
     def get_counts(self, scores):
         """
@@ -277,9 +799,14 @@ class Thresholds:
 
 class ScoreStats:
 
-    def __init__(self, subjects, thresholds):
+    def __init__(self, subjects, thresholds, counter=None):
+        """
+        counter: ScoreCounter of the subjects at the thresholds, counted
+                 from the subjects when not given
+        """
         self.subjects = subjects
         self.thresholds = thresholds
+        self.counter = counter
 
         self.tpr = None
         self.tnr = None
@@ -300,22 +827,15 @@ class ScoreStats:
     def completeness(self):
         return self.tpr
 
-    def get_scores(self):
-        scores = []
-        for subject in self.subjects.iter():
-            if subject.gold in [0, 1]:
-                scores.append((subject.gold, subject.score))
-
-        scores = sorted(scores, key=lambda item: item[1])
-        return scores
-
     def calculate(self):
-        scores = self.get_scores()
         bogus, real = self.thresholds()
+        counter = self.counter
+        if counter is None:
+            counter = ScoreCounter.from_subjects(self.subjects, bogus, real)
 
-        low = self.counts(scores, 0, bogus)
-        high = self.counts(scores, real, 1)
-        total = self.counts(scores)
+        low = counter.low()
+        high = counter.high()
+        total = counter.total()
 
         logger.debug('low %s high %s total %s', low, high, total)
 
@@ -338,48 +858,18 @@ class ScoreStats:
             (high[1] + low[0]), (self.total(low) + self.total(high)))
 
         # Calculate mean squared error
-        self.mse = self.mean_squared_error(scores)
-        self.mse_t = self.mean_squared_error(scores, True)
+        self.mse = counter.mean_squared_error()
+        self.mse_t = counter.mean_squared_error(True)
 
         # self.completeness = self.tpr
         self.mdr = 1 - self.tpr
 
         return stats
 
-    def mean_squared_error(self, scores, retirement=False):
-        bogus, real = self.thresholds()
-        error = 0
-        n = 0
-
-        for gold, p in scores:
-            if gold in [0, 1]:
-                if retirement:
-                    if p < bogus:
-                        p = 0
-                    elif p > real:
-                        p = 1
-
-                error += (gold - p) ** 2
-                n += 1
-
-        error = error / n
-        return error
-
     @staticmethod
     def total(counts):
         return counts[0] + counts[1]
 
-    @staticmethod
-    def counts(scores, left=0, right=1):
-        counts = {-1: 0, 0: 0, 1: 0}
-        for gold, p in scores:
-            if gold == -1 or p is None or p < left or p > right:
-                continue
-
-            counts[gold] += 1
-
-        return counts
-
     def dict(self):
         keys = [
             'tpr', 'tnr', 'fpr', 'fnr', 'mse', 'mse_t',
@@ -0,0 +1,180 @@
+"""
+Synthetic Panoptes-style classification dumps, for benchmarks.
+
+A Workload draws a hidden truth for every subject and a confusion matrix
+for every user, and then writes classifications the users make with those
+confusion matrices. The rows are written in blocks, so dumps of tens of
+millions of classifications fit in memory.
+
+    users       PD ~ Beta(*confusion[0]), PL ~ Beta(*confusion[1]), and a
+                fraction of spammers that label at random. Some users are
+                not logged in and are only known by name.
+    activity    users classify with probability proportional to a Pareto
+                weight with shape activity, so a few users make most
+                classifications
+    duplicates  fraction of rows that repeat a (user, subject) pair
+                classified earlier in the same block
+
+The dump has the columns of a Panoptes export that swap reads, along with
+workflow_id and created_at, and golds are written as (subject, gold).
+"""
+import csv
+import json
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+header = ['classification_id', 'user_name', 'user_id', 'workflow_id',
+          'created_at', 'annotations', 'subject_ids']
+
+
+class Workload:
+    """
+    Parameters and hidden state of a synthetic classification dump
+
+    classifications: number of rows in the dump
+    users, subjects: number of users and subjects
+    real: fraction of real subjects
+    confusion: Beta distribution parameters of PD and PL
+    spammers: fraction of users that label at random
+    anonymous: fraction of users that are not logged in
+    activity: Pareto shape of the user activity, smaller is more skewed
+    duplicates: fraction of rows that repeat an earlier (user, subject)
+    task: annotation task of the classifications
+    """
+    # rows generated at once
+    block = 1 << 20
+    first_user = 1
+    first_subject = 1000000
+    workflow = 1
+
+    def __init__(self, classifications, users, subjects, real=.2,
+                 confusion=((8., 2.), (6., 2.)), spammers=.05,
+                 anonymous=.02, activity=1.2, duplicates=.01, task='T0',
+                 seed=0):
+        self.classifications = classifications
+        self.users = users
+        self.subjects = subjects
+        self.real = real
+        self.confusion = confusion
+        self.spammers = spammers
+        self.anonymous = anonymous
+        self.activity = activity
+        self.duplicates = duplicates
+        self.task = task
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.truth = (rng.random(subjects) < real).astype(np.int8)
+
+        # PD and PL of every user
+        self.skill = np.column_stack([
+            rng.beta(*confusion[0], size=users),
+            rng.beta(*confusion[1], size=users)])
+        self.skill[rng.random(users) < spammers] = .5
+
+        weights = rng.pareto(activity, size=users) + 1
+        self.weights = weights / weights.sum()
+        self.logged_in = rng.random(users) >= anonymous
+
+    def user_columns(self):
+        """
+        user_name and user_id fields of every user
+        """
+        ids = np.arange(self.users) + self.first_user
+        names = np.array(['user%d' % i for i in ids], dtype=object)
+        user_ids = np.array([str(i) for i in ids], dtype=object)
+        anonymous = np.flatnonzero(~self.logged_in)
+        names[anonymous] = ['not-logged-in-%08x' % (i * 2654435761 % 2**32)
+                            for i in anonymous]
+        user_ids[anonymous] = ''
+        return names, user_ids
+
+    def blocks(self):
+        """
+        Yield the classifications in blocks of rows, as arrays of user
+        index, subject index, label and classification id
+        """
+        rng = np.random.default_rng(self.seed + 1)
+        for start in range(0, self.classifications, self.block):
+            n = min(self.block, self.classifications - start)
+            users = rng.choice(self.users, size=n, p=self.weights)
+            subjects = rng.integers(self.subjects, size=n)
+
+            # repeat the pair of a random earlier row of the block
+            duplicate = np.flatnonzero(rng.random(n) < self.duplicates)
+            duplicate = duplicate[duplicate > 0]
+            earlier = (rng.random(len(duplicate)) * duplicate).astype(np.int64)
+            users[duplicate] = users[earlier]
+            subjects[duplicate] = subjects[earlier]
+
+            truth = self.truth[subjects]
+            correct = rng.random(n) < self.skill[users, truth]
+            labels = np.where(correct, truth, 1 - truth).astype(np.int8)
+            ids = np.arange(start, start + n, dtype=np.int64) + 1
+            yield users, subjects, labels, ids
+
+    def annotations(self):
+        """
+        annotations field for a label of 0 and of 1
+        """
+        return np.array([
+            json.dumps([{'task': self.task, 'value': value}])
+            for value in [[], ['x']]], dtype=object)
+
+    def write_classifications(self, path):
+        """
+        Write the classification dump to a csv file
+        """
+        names, user_ids = self.user_columns()
+        annotations = self.annotations()
+        start = np.datetime64('2018-04-09T00:00:00')
+        subject_ids = np.arange(self.subjects) + self.first_subject
+
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            for users, subjects, labels, ids in self.blocks():
+                # one classification every few seconds
+                created = np.datetime_as_string(
+                    start + (ids * 3).astype('timedelta64[s]'))
+                created = np.char.add(np.char.replace(created, 'T', ' '), ' UTC')
+                writer.writerows(zip(
+                    ids.tolist(), names[users].tolist(),
+                    user_ids[users].tolist(),
+                    [self.workflow] * len(ids), created.tolist(),
+                    annotations[labels].tolist(),
+                    subject_ids[subjects].tolist()))
+                logger.debug('Wrote %d classifications', ids[-1])
+
+    def write_golds(self, path, fraction=.1):
+        """
+        Write the true label of a random fraction of the subjects as a
+        golds csv
+        """
+        rng = np.random.default_rng(self.seed + 2)
+        n = int(round(fraction * self.subjects))
+        subjects = np.sort(rng.choice(self.subjects, size=n, replace=False))
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['subject', 'gold'])
+            writer.writerows(zip(
+                (subjects + self.first_subject).tolist(),
+                self.truth[subjects].tolist()))
+
+    def dump(self):
+        return {
+            'classifications': self.classifications,
+            'users': self.users,
+            'subjects': self.subjects,
+            'real': self.real,
+            'confusion': self.confusion,
+            'spammers': self.spammers,
+            'anonymous': self.anonymous,
+            'activity': self.activity,
+            'duplicates': self.duplicates,
+            'task': self.task,
+            'seed': self.seed,
+        }
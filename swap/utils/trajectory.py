@@ -0,0 +1,176 @@
+"""
+Cache of subject score trajectories.
+
+The trajectory of a subject is its score after each classification in its
+history. Reports, trajectory plots and the trajectory export read them
+from this cache instead of replaying the history of every subject.
+
+Every cached subject keeps its running log-odds as a float32 array, which
+holds scores that are far closer to 0 or 1 than a float32 probability
+could. SWAP appends to the row of a cached subject when the subject gets
+a classification, and drops the row when the score of a user that
+classified the subject changes. The cache holds at most size scores in
+total, and evicts whole rows when it is full:
+
+    'lru'   least recently read or written subject first
+    'fifo'  subject that was cached first
+
+Snapshots store the cache as ragged arrays, so it survives save and load.
+"""
+from collections import OrderedDict
+import numpy as np
+
+from swap.utils.columnar import compact
+from swap.utils.subject import logistic
+
+import logging
+logger = logging.getLogger(__name__)
+
+policies = ['lru', 'fifo']
+
+
+class TrajectoryCache:
+    """
+    Running log-odds of recently used subjects, by subject id
+
+    size: largest number of scores to keep, 0 disables the cache
+    policy: eviction policy, 'lru' or 'fifo'
+    """
+    dtype = np.float32
+
+    def __init__(self, size=0, policy='lru'):
+        if policy not in policies:
+            raise ValueError('Unknown trajectory cache policy %s' % policy)
+        self.size = size
+        self.policy = policy
+        self.rows = OrderedDict()
+        self.used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, subject):
+        return subject in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, subject):
+        """
+        Cached log-odds of a subject, or None
+        """
+        row = self.rows.get(subject)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == 'lru':
+            self.rows.move_to_end(subject)
+        return row
+
+    def store(self, subject, logodds):
+        """
+        Cache the log-odds of a subject, returns them as they are kept in
+        the cache
+        """
+        if self.size <= 0:
+            return logodds
+        row = np.asarray(logodds, dtype=self.dtype)
+        self.discard(subject)
+        if len(row) > self.size:
+            return row
+        self.rows[subject] = row
+        self.used += len(row)
+        self._evict()
+        return row
+
+    def extend(self, subject, term):
+        """
+        Add the log-odds term of a new classification to the row of a
+        cached subject
+        """
+        row = self.rows.get(subject)
+        if row is None:
+            return
+        if len(row) == 0:
+            # the prior is not kept with the row
+            self.discard(subject)
+            return
+        self.rows[subject] = np.append(row, self.dtype(row[-1] + term))
+        self.used += 1
+        if self.policy == 'lru':
+            self.rows.move_to_end(subject)
+        self._evict()
+
+    def discard(self, subject):
+        row = self.rows.pop(subject, None)
+        if row is not None:
+            self.used -= len(row)
+
+    def invalidate(self, subjects):
+        for subject in subjects:
+            self.discard(subject)
+
+    def clear(self):
+        self.rows = OrderedDict()
+        self.used = 0
+
+    def _evict(self):
+        while self.used > self.size:
+            _, row = self.rows.popitem(last=False)
+            self.used -= len(row)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'subjects': len(self.rows),
+            'scores': self.used,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def dump(self):
+        """
+        Ragged arrays of the cached rows: subject ids, offsets (row i spans
+        offsets[i]:offsets[i+1]) and the log-odds of all rows concatenated,
+        in eviction order
+        """
+        offsets = np.zeros(len(self.rows) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in self.rows.values()], out=offsets[1:])
+        if len(self.rows) > 0:
+            logodds = np.concatenate(list(self.rows.values()))
+        else:
+            logodds = np.zeros(0, dtype=self.dtype)
+        return {
+            'ids': compact(list(self.rows)),
+            'offsets': offsets,
+            'logodds': logodds,
+        }
+
+    @classmethod
+    def load(cls, data, size=0, policy='lru'):
+        cache = cls(size, policy)
+        if data is None or size <= 0:
+            return cache
+        offsets = data['offsets']
+        logodds = np.asarray(data['logodds'], dtype=cls.dtype)
+        for i, subject in enumerate(data['ids'].tolist()):
+            # copies, so evicted rows don't keep the whole array alive
+            cache.rows[subject] = logodds[offsets[i]:offsets[i + 1]].copy()
+            cache.used += int(offsets[i + 1] - offsets[i])
+        cache._evict()
+        return cache
+
+    def __str__(self):
+        return 'trajectory cache %(subjects)d subjects %(scores)d scores ' \
+               '%(hits)d hits %(misses)d misses %(evictions)d evictions' % \
+               self.stats()
+
+
+def scores(logodds):
+    """
+    Scores for cached log-odds
+    """
+    return logistic(np.asarray(logodds, dtype=np.float64))
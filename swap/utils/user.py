@@ -1,12 +1,15 @@
 
 from collections import OrderedDict
+import numpy as np
 
 from swap.utils.collection import Collection
+from swap.utils.columnar import ArrayCollection, UserTable, counts
+from swap.utils.state import RaggedHistory
 
 
 class User:
 
-    def __init__(self, user, username, correct, seen, prior, history=[]):
+    def __init__(self, user, username, correct, seen, prior, history=[], applied=None):
         self.id = user
         self.name = username
         self.history = history
@@ -14,6 +17,8 @@ class User:
         self.prior = prior
         self.correct = correct
         self.seen = seen
+        # score used for this user's terms in incremental subject scoring
+        self.applied = applied
 
     @classmethod
     def new(cls, user, username):
@@ -27,7 +32,17 @@ class User:
         # Add classification to history
         self.history.append((subject.id, subject.gold, cl))
 
-    def update_subject(self, subject):
+    def update_subject(self, subject, position=None):
+        """
+        Update the gold label of subject in this user's history. If the
+        position of the subject in the history is known, only that entry
+        is updated instead of scanning the whole history.
+        """
+        if position is not None:
+            h = self.history[position]
+            self.history[position] = (h[0], subject.gold, h[2])
+            return
+
         for i in range(len(self.history)):
             h = self.history[i]
             if h[0] == subject.id:
@@ -47,8 +62,9 @@ class User:
         return score
 
     def update_score(self):
-        correct = self.prior[0]
-        seen = self.prior[1]
+        # copy the prior so repeated updates don't count history twice
+        correct = list(self.prior[0])
+        seen = list(self.prior[1])
         for _, gold, cl in self.history:
             if gold in [0, 1]:
                 seen[gold] += 1
@@ -69,6 +85,7 @@ class User:
             ('correct', self.correct),
             ('seen', self.seen),
             ('prior', self.prior),
+            ('applied', self.applied),
         ])
 
     def report(self, report_classifications=True):
@@ -104,10 +121,238 @@ class User:
 
 class Users(Collection):
 
+    # subject id -> [(user id, position in user history), ...]
+    # built lazily from the user histories
+    _subject_index = None
+
     @staticmethod
     def new(user):
         return User.new(user, None)
 
+    @property
+    def subject_index(self):
+        """
+        Inverted index from each subject to the user history entries that
+        refer to it
+        """
+        if self._subject_index is None:
+            self._subject_index = self._index_history()
+        return self._subject_index
+
+    def _index_history(self):
+        index = {}
+        for user in self.iter():
+            for i, (subject, _, _) in enumerate(user.history):
+                index.setdefault(subject, []).append((user.id, i))
+        return index
+
+    def positions(self, subject):
+        """
+        List of (user id, history position) pairs that refer to subject
+        """
+        return self.subject_index.get(subject, [])
+
+    def set_golds(self, users, positions, golds):
+        """
+        Set the gold label of user history entries, given as parallel
+        lists of user id, history position and gold label
+        """
+        updates = {}
+        for user, i, gold in zip(users, positions, golds):
+            updates.setdefault(user, []).append((i, gold))
+        for user, entries in updates.items():
+            history = self[user].history
+            for i, gold in entries:
+                h = history[i]
+                history[i] = (h[0], gold, h[2])
+
+    def classified(self, user, subject):
+        """
+        Record the newest history entry of user in the subject index
+        """
+        if self._subject_index is not None:
+            self._subject_index.setdefault(subject.id, []).append(
+                (user.id, len(user.history) - 1))
+
+    def truncate(self):
+        super().truncate()
+        self._subject_index = {}
+
     @classmethod
     def _load_item(cls, data):
         return User.load(data)
+
+
+class UserView(User):
+    """
+    User backed by a row of a UserTable
+    """
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def id(self):
+        return self._table.ids[self._index]
+
+    @property
+    def name(self):
+        return self._table.names[self._index]
+
+    @name.setter
+    def name(self, value):
+        self._table.names[self._index] = value
+
+    @property
+    def correct(self):
+        return counts(self._table.correct[self._index])
+
+    @correct.setter
+    def correct(self, value):
+        self._table.correct[self._index] = value
+
+    @property
+    def seen(self):
+        return counts(self._table.seen[self._index])
+
+    @seen.setter
+    def seen(self, value):
+        self._table.seen[self._index] = value
+
+    @property
+    def prior(self):
+        return [counts(self._table.prior_correct[self._index]),
+                counts(self._table.prior_seen[self._index])]
+
+    @prior.setter
+    def prior(self, value):
+        correct, seen = value
+        self._table.prior_correct[self._index] = correct
+        self._table.prior_seen[self._index] = seen
+
+    @property
+    def history(self):
+        return self._table.history[self._index]
+
+    @history.setter
+    def history(self, value):
+        self._table.history[self._index] = value
+
+    @property
+    def applied(self):
+        applied = self._table.applied[self._index]
+        if np.isnan(applied[0]):
+            return None
+        return applied.tolist()
+
+    @applied.setter
+    def applied(self, value):
+        if value is None:
+            value = np.nan
+        self._table.applied[self._index] = value
+
+
+class ArrayUsers(ArrayCollection, Users):
+    """
+    Collection of Users stored in a UserTable
+    """
+    table_class = UserTable
+    view_class = UserView
+    dict_class = Users
+
+    # stored user history entries sorted by subject, (subjects, rows,
+    # positions), when the histories were opened from a snapshot
+    _sorted = None
+
+    def _insert(self, data):
+        user = self.view(self.table.add(data['user']))
+        for key in ['username', 'correct', 'seen', 'prior', 'applied']:
+            if key in data:
+                setattr(user, {'username': 'name'}.get(key, key), data[key])
+        user.history = data.get('history', [])
+
+    def scores(self):
+        """
+        Confusion matrices of all users as an array, ordered like keys()
+        """
+        return self.table.scores()
+
+    def _index_history(self):
+        """
+        Index the user histories opened from a snapshot without decoding
+        them: their stored entries are sorted by subject once, and only
+        the entries added since loading go in the subject index dict
+        """
+        history = self.table.history
+        if not isinstance(history, RaggedHistory) or \
+                history.columns['subject'].dtype == object:
+            return super()._index_history()
+
+        subjects = history.columns['subject']
+        offsets = history.offsets
+        lengths = np.diff(offsets)
+        rows = np.repeat(np.arange(history.stored), lengths)
+        positions = np.arange(len(subjects)) - offsets[rows]
+        order = np.argsort(subjects, kind='stable')
+        self._sorted = (subjects[order], rows[order], positions[order])
+
+        ids = self.table.ids
+        index = {}
+        for row, entries in history.rows.items():
+            for i in range(lengths[row], len(entries)):
+                index.setdefault(entries[i][0], []).append((ids[row], i))
+        for j, entries in enumerate(history.extra):
+            for i, (subject, _, _) in enumerate(entries):
+                index.setdefault(subject, []).append(
+                    (ids[history.stored + j], i))
+        return index
+
+    def positions(self, subject):
+        found = super().positions(subject)
+        if self._sorted is None or \
+                not isinstance(subject, (int, np.integer)):
+            return found
+        subjects, rows, positions = self._sorted
+        a = np.searchsorted(subjects, subject, 'left')
+        b = np.searchsorted(subjects, subject, 'right')
+        ids = self.table.ids
+        return [(ids[row], i) for row, i in
+                zip(rows[a:b].tolist(), positions[a:b].tolist())] + found
+
+    def set_golds(self, users, positions, golds):
+        """
+        Set the gold label of user history entries. Entries of histories
+        opened from a snapshot that were not read yet are written to the
+        mapped gold column with one assignment, the others are python
+        tuples and are rewritten in place.
+        """
+        index = self.table.index
+        rows = np.array([index[u] for u in users], dtype=np.int64)
+        positions = np.array(positions, dtype=np.int64)
+        golds = np.array(golds, dtype=np.int8)
+
+        history = self.table.history
+        if isinstance(history, RaggedHistory):
+            stored = rows < history.stored
+            if len(history.rows) > 0:
+                stored &= ~np.isin(rows, list(history.rows))
+            entries = history.offsets[rows[stored]] + positions[stored]
+            history.columns['gold'][entries] = golds[stored]
+            rows = rows[~stored]
+            positions = positions[~stored]
+            golds = golds[~stored]
+
+        for row, i, gold in zip(rows.tolist(), positions.tolist(),
+                                golds.tolist()):
+            entries = history[row]
+            h = entries[i]
+            entries[i] = (h[0], gold, h[2])
+
+    def truncate(self):
+        table = self.table
+        table.column('prior_correct')[:] = table.column('correct')
+        table.column('prior_seen')[:] = table.column('seen')
+        table.history = [[] for _ in table.ids]
+        self._subject_index = {}
+        self._sorted = None
@@ -0,0 +1,91 @@
+import csv
+
+import pytest
+
+import swap.data
+from swap.utils.control import SWAP, Config
+from swap.utils.ingest import read_classifications
+from swap.utils.synthetic import Workload
+
+
+@pytest.fixture(scope='session')
+def dump(tmp_path_factory):
+    """
+    Small synthetic classification dump and its golds, as file paths
+    """
+    directory = tmp_path_factory.mktemp('dump')
+    classifications = str(directory / 'classifications.csv')
+    golds = str(directory / 'golds.csv')
+    # some users are only known by name, so user ids are mixed
+    workload = Workload(3000, 60, 300, anonymous=.1, seed=1)
+    workload.write_classifications(classifications)
+    workload.write_golds(golds, .2)
+    return classifications, golds
+
+
+@pytest.fixture(scope='session')
+def chunks(dump):
+    return list(read_classifications(dump[0], Config(), 1000))
+
+
+@pytest.fixture(scope='session')
+def golds(dump):
+    with open(dump[1]) as file:
+        return [(int(row['subject']), int(row['gold']))
+                for row in csv.DictReader(file)]
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    # saved states go to a directory of their own for every test
+    monkeypatch.setattr(swap.data, 'dir', lambda: str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def run(chunks, golds):
+    """
+    Function that feeds the dump to a new SWAP in cycles of classify,
+    score and retire, with half of the golds applied after the first
+    chunk and the other half one by one after the second. With reload,
+    the state is saved and loaded again after every cycle.
+    """
+    def run(name, reload=False, **config):
+        swp = SWAP(name, Config(**config))
+        half = len(golds) // 2
+        for i, chunk in enumerate(chunks):
+            swp.classify_many(
+                chunk.users, chunk.subjects, chunk.labels, chunk.ids)
+            if i == 0:
+                swp.apply_golds(golds[:half])
+            elif i == 1:
+                for subject, gold in golds[half:]:
+                    swp.apply_gold(subject, gold)
+            swp()
+            swp.retire(.01, .9)
+            if reload:
+                swp.save()
+                swp = SWAP.load(name)
+        return swp
+    return run
+
+
+def agents(swp):
+    """
+    State of every user and subject, to compare two SWAP instances
+    """
+    users = {}
+    for user in swp.users.iter():
+        users[user.id] = (list(user.score), list(user.seen),
+                          list(user.correct), list(user.history))
+    subjects = {}
+    for subject in swp.subjects.iter():
+        subjects[subject.id] = (subject.score, subject.gold,
+                                subject.retired, subject.seen,
+                                list(subject.history))
+    return users, subjects
+
+
+@pytest.fixture
+def state():
+    return agents
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from swap.utils.em import expectation_maximization
+from swap.utils.subject import Subject
+
+modes = [
+    {},
+    {'unsupervised': True},
+    {'ignore_gold_status': True},
+]
+
+
+def loop(users, subjects, labels, golds, confusions, probabilities, p0,
+         unsupervised=False, ignore_gold_status=False,
+         N_min=40, N_max=1000, epsilon_min=1e-8, gamma=1):
+    # one classification at a time, as SWAP.offline used to do it
+    confusions = np.array(confusions, dtype=float)
+    probabilities = np.array(probabilities, dtype=float)
+    classifications = list(zip(users, subjects, labels, golds))
+
+    epsilon_taus = 10
+    N_try = 0
+    while (epsilon_taus > epsilon_min) * (N_try < N_max) + (N_try < N_min):
+        old_probabilities = probabilities.copy()
+
+        p_real = np.zeros_like(probabilities)
+        p_bogus = np.zeros_like(probabilities)
+        n_observations = np.zeros_like(probabilities)
+        for uid, sid, cid, gold in classifications:
+            p_real[sid] += (confusions[uid, 1] ** cid *
+                            (1 - confusions[uid, 1]) ** (1 - cid) * p0)
+            p_bogus[sid] += ((1 - confusions[uid, 0]) ** cid *
+                             confusions[uid, 0] ** (1 - cid) * (1 - p0))
+            n_observations[sid] += 1.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probabilities = np.where(
+                n_observations > 0,
+                p_real / (p_real + p_bogus) / n_observations,
+                old_probabilities)
+        epsilon_taus = np.sum(
+            np.abs(probabilities - old_probabilities) / len(probabilities))
+
+        numer = np.zeros_like(confusions)
+        denom = np.zeros_like(confusions)
+        for uid, sid, cid, gold in classifications:
+            if not unsupervised and gold == -1:
+                continue
+            if ignore_gold_status or gold == -1:
+                pi = probabilities[sid]
+            else:
+                pi = gold
+            numer[uid, 0] += (1 - cid) * (1 - pi)
+            numer[uid, 1] += cid * pi
+            denom[uid, 0] += 1 - pi
+            denom[uid, 1] += pi
+        confusions = (gamma + numer) / (2 * gamma + denom)
+        N_try += 1
+
+    return confusions, probabilities, N_try, epsilon_taus
+
+
+def classifications(seed, n=800, n_users=30, n_subjects=60):
+    rng = np.random.default_rng(seed)
+    users = rng.integers(0, n_users, n)
+    subjects = rng.integers(0, n_subjects, n)
+    labels = rng.integers(0, 2, n)
+    gold = np.where(rng.random(n_subjects) < .3,
+                    rng.integers(0, 2, n_subjects), -1)
+    confusions = rng.uniform(.2, .8, (n_users, 2))
+    probabilities = rng.uniform(.01, .99, n_subjects)
+    return users, subjects, labels, gold[subjects], confusions, probabilities
+
+
+@pytest.mark.parametrize('mode', modes)
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_loop(mode, seed):
+    args = classifications(seed) + (Subject.p0,)
+    expected = loop(*args, **mode)
+    result = expectation_maximization(*args, **mode)
+
+    np.testing.assert_allclose(result[0], expected[0], rtol=1e-12)
+    np.testing.assert_allclose(result[1], expected[1], rtol=1e-12)
+    assert result[2] == expected[2]
+
+
+def test_subject_without_classifications_keeps_score():
+    users, subjects, labels, golds, confusions, probabilities = \
+        classifications(2, n_subjects=10)
+    probabilities = np.append(probabilities, .25)
+
+    result = expectation_maximization(
+        users, subjects, labels, golds, confusions, probabilities,
+        Subject.p0)
+
+    assert result[1][-1] == .25
+
+
+@pytest.mark.parametrize('mode', modes)
+def test_offline_backends(run, mode):
+    # offline EM gives the same scores on every backend
+    results = []
+    for backend in ['dict', 'array']:
+        swp = run('em_' + backend, backend=backend)
+        swp.offline(**mode)
+        results.append((
+            {s.id: s.score for s in swp.subjects.iter()},
+            {u.id: list(u.score) for u in swp.users.iter()}))
+
+    dict_, array = results
+    assert dict_[0].keys() == array[0].keys()
+    for key, score in dict_[0].items():
+        assert array[0][key] == pytest.approx(score, rel=1e-12)
+    for key, score in dict_[1].items():
+        assert array[1][key] == pytest.approx(score, rel=1e-12)
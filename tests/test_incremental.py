@@ -0,0 +1,67 @@
+import pytest
+
+backends = [
+    {'backend': 'dict'},
+    {'backend': 'array'},
+    {'backend': 'sqlite', 'cache_size': 50},
+]
+
+reloads = [
+    {'backend': 'dict'},
+    {'backend': 'dict', 'journal': True, 'snapshot_interval': 3},
+    {'backend': 'array'},
+    {'backend': 'array', 'storage': 'mmap'},
+    {'backend': 'array', 'storage': 'mmap', 'journal': True,
+     'snapshot_interval': 3},
+    {'backend': 'sqlite', 'cache_size': 50},
+]
+
+
+def assert_scores(swp, expected):
+    users, subjects = expected
+    assert sorted(swp.users.keys(), key=str) == sorted(users, key=str)
+    assert sorted(swp.subjects.keys()) == sorted(subjects)
+    for user in swp.users.iter():
+        assert user.score == pytest.approx(users[user.id][0], rel=1e-9)
+    for subject in swp.subjects.iter():
+        score, gold, retired = subjects[subject.id][:3]
+        assert subject.score == pytest.approx(score, rel=1e-9, abs=1e-12)
+        assert subject.gold == gold
+        assert subject.retired == retired
+
+
+@pytest.fixture
+def full(run, state):
+    return state(run('full', backend='dict'))
+
+
+@pytest.mark.parametrize('config', backends)
+def test_incremental_matches_full(run, full, config):
+    swp = run('incremental', scoring='incremental', **config)
+    assert_scores(swp, full)
+
+
+@pytest.mark.parametrize('config', backends)
+def test_full_backends(run, state, full, config):
+    swp = run('full_' + config['backend'], **config)
+    users, subjects = state(swp)
+    assert users == full[0]
+    assert subjects == full[1]
+
+
+@pytest.mark.parametrize('scoring', ['full', 'incremental'])
+@pytest.mark.parametrize('config', reloads)
+def test_reload(run, full, scoring, config):
+    swp = run('reload', reload=True, scoring=scoring, **config)
+    assert_scores(swp, full)
+
+
+def test_logodds_after_reload(run):
+    # the running sums saved with the state match sums rebuilt from the
+    # histories
+    swp = run('logodds', reload=True, scoring='incremental',
+              backend='array', storage='mmap')
+    saved = {s.id: s.logodds for s in swp.subjects.iter()}
+    swp.rebuild_logodds()
+    for subject in swp.subjects.iter():
+        assert subject.logodds == pytest.approx(saved[subject.id], abs=1e-9)
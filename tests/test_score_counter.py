@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from swap.utils.control import SWAP, Config
+from swap.utils.subject import ScoreCounter
+
+configs = [
+    {'backend': 'dict'},
+    {'backend': 'array'},
+    {'backend': 'array', 'scoring': 'incremental'},
+    {'backend': 'sqlite', 'cache_size': 50},
+]
+
+
+def reference(swp):
+    # threshold statistics from a sorted list of the gold subjects, as
+    # ScoreStats computed them before the score counters
+    bogus, real = swp.thresholds()
+    scores = sorted([(s.gold, s.score) for s in swp.subjects.iter()
+                     if s.gold in [0, 1]], key=lambda item: item[1])
+
+    def counts(left=0, right=1):
+        counts = {0: 0, 1: 0}
+        for gold, p in scores:
+            if left <= p <= right:
+                counts[gold] += 1
+        return counts
+
+    def mean_squared_error(retirement=False):
+        error = 0
+        for gold, p in scores:
+            if retirement:
+                if p < bogus:
+                    p = 0
+                elif p > real:
+                    p = 1
+            error += (gold - p) ** 2
+        return error / len(scores)
+
+    low = counts(0, bogus)
+    high = counts(real, 1)
+    total = counts()
+    retired = low[0] + low[1] + high[0] + high[1]
+    return {
+        'tpr': high[1] / total[1],
+        'tnr': low[0] / total[0],
+        'fpr': high[0] / total[0],
+        'fnr': low[1] / total[1],
+        'purity': high[1] / (high[0] + high[1]) if high[0] + high[1] else None,
+        'retired': retired / len(swp.subjects),
+        'retired_correct': (high[1] + low[0]) / retired if retired else None,
+        'mse': mean_squared_error(),
+        'mse_t': mean_squared_error(True),
+    }
+
+
+def assert_counters(counter, expected):
+    np.testing.assert_array_equal(counter.n, expected.n)
+    np.testing.assert_allclose(counter.sum, expected.sum, atol=1e-9)
+    np.testing.assert_allclose(counter.sumsq, expected.sumsq, atol=1e-9)
+
+
+@pytest.mark.parametrize('config', configs)
+def test_counters_follow_updates(chunks, golds, config):
+    # counters made after the first cycle and updated afterwards match
+    # counters made from scratch, and so do the statistics read from them
+    swp = SWAP('counter', Config(**config))
+    half = len(golds) // 2
+    for i, chunk in enumerate(chunks):
+        swp.classify_many(
+            chunk.users, chunk.subjects, chunk.labels, chunk.ids)
+        if i == 1:
+            swp.apply_golds(golds[:half])
+        elif i == 2:
+            for subject, gold in golds[half:]:
+                swp.apply_gold(subject, gold)
+        swp()
+        swp.retire(.01, .9)
+        bogus, real = swp.thresholds()
+
+        assert_counters(swp.score_counts(bogus, real),
+                        ScoreCounter.from_subjects(swp.subjects, bogus, real))
+        if i == 0:
+            continue
+        performance = swp.performance
+        for key, value in reference(swp).items():
+            assert getattr(performance, key) == pytest.approx(value, abs=1e-12)
+
+    swp.offline()
+    bogus, real = swp.thresholds()
+    assert_counters(swp.score_counts(bogus, real),
+                    ScoreCounter.from_subjects(swp.subjects, bogus, real))
+
+
+def test_counters_after_reload(run):
+    swp = run('counter', reload=True, backend='array', storage='mmap')
+    performance = swp.performance
+    for key, value in reference(swp).items():
+        assert getattr(performance, key) == pytest.approx(value, abs=1e-12)
+
+
+def test_counter_regions():
+    counter = ScoreCounter(.2, .8)
+    counter.add([0, 0, 1, 1, -1, 1], [.1, .2, .5, .8, .9, .95])
+    assert counter.low() == {0: 2, 1: 0, -1: 0}
+    assert counter.high() == {0: 0, 1: 2, -1: 1}
+    assert counter.total() == {0: 2, 1: 3, -1: 1}
+
+    counter.update(([1], [.95]), ([0], [.05]))
+    assert counter.low() == {0: 3, 1: 0, -1: 0}
+    assert counter.high() == {0: 0, 1: 1, -1: 1}
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from swap.utils import shards
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, 'fork'), reason='sharding forks worker processes')
+
+configs = [
+    {'backend': 'dict'},
+    {'backend': 'dict', 'reference_history': True},
+    {'backend': 'array'},
+    {'backend': 'array', 'reference_history': True},
+]
+
+
+def exports(swp, directory):
+    """
+    Text of the csv exports of a SWAP instance
+    """
+    texts = []
+    for name in ['subjects', 'users', 'classifications']:
+        path = str(directory / ('%s_%s.csv' % (swp.name, name)))
+        getattr(swp, 'export_' + name)(path, 'csv')
+        with open(path) as file:
+            texts.append(file.read())
+    return texts
+
+
+@pytest.mark.parametrize('config', configs)
+def test_sharded_matches_single(run, state, data_dir, config):
+    single = run('single', **config)
+    sharded = run('sharded', shards=3, **config)
+    assert shards.available(sharded)
+
+    assert state(sharded) == state(single)
+    assert exports(sharded, data_dir) == exports(single, data_dir)
+
+
+@pytest.mark.parametrize('shards_', [2, 4])
+def test_shard_counts(run, state, shards_):
+    single = run('single', backend='array')
+    sharded = run('sharded', backend='array', shards=shards_)
+    assert state(sharded) == state(single)
+
+
+@pytest.mark.parametrize('storage', ['pickle', 'mmap'])
+def test_sharded_reload(run, state, storage):
+    # sharded workers read agents of a state loaded from a snapshot
+    single = run('single', backend='array')
+    sharded = run('sharded', reload=True, backend='array', storage=storage,
+                  shards=3)
+    assert state(sharded) == state(single)
+
+
+def test_sharded_retire(run):
+    # retiring with looser thresholds changes the same subjects
+    single = run('single', backend='array')
+    sharded = run('sharded', backend='array', shards=3)
+    for swp in [single, sharded]:
+        swp.retire(.05, .7)
+
+    retired = [{s.id: s.retired for s in swp.subjects.iter()}
+               for swp in [single, sharded]]
+    assert retired[0] == retired[1]
+
+
+def test_unavailable(run):
+    assert not shards.available(run('single', backend='array'))
+    assert not shards.available(
+        run('sqlite', backend='sqlite', shards=3))
+    assert not shards.available(
+        run('incremental', backend='array', scoring='incremental', shards=3))